@@ -1,24 +1,72 @@
 # Description: This file is the entry point of the application. It creates the Flask app and registers the blueprints.
 from flask import Flask
-from pymongo import MongoClient
+import globals
+from config import Config
 from blueprints.reviews.reviews import reviews_bp
 from blueprints.auth.auth import auth_bp
 from blueprints.listings.listings import listings_bp
 from blueprints.admin.admin import admin_bp
+from blueprints.metrics.metrics import metrics_bp
+from indexes import ensure_indexes
+from json_provider import MongoJSONProvider
+import compression
+import metrics
+import ratelimit
+from passwords import passwords
+from listing_cache import listing_cache
+from view_counter import view_counter
 
-# Create the Flask app
-app = Flask(__name__)
+# Application factory. config may be a mapping or an object whose upper-case
+# attributes override the defaults in config.Config (which read the environment).
+# The MongoDB client is not created here: each worker process creates its own
+# on first use, so this is safe to call before a pre-forking server forks.
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.from_mapping(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    # Serialize ObjectId, datetime and Decimal128 straight from pymongo documents
+    app.json = MongoJSONProvider(app)
+
+    # Request timing and MongoDB command metrics. Registered first so the
+    # timing includes the other after_request hooks.
+    metrics.init_app(app)
+
+    # Per-client token buckets and the in-flight request limit, checked
+    # before any other work is done for a request
+    ratelimit.init_app(app)
+
+    # gzip/brotli responses above COMPRESS_MIN_SIZE
+    compression.init_app(app)
 
-# MongoDB Connection
-client = MongoClient("mongodb://localhost:27017/")
-db = client["ebay_used_cars"]
+    # MongoDB Connection
+    globals.configure(app.config)
 
-# Register Blueprints
-app.register_blueprint(reviews_bp)
-app.register_blueprint(auth_bp)
-app.register_blueprint(listings_bp)
-app.register_blueprint(admin_bp)
+    # Password hashing pool
+    passwords.configure(app.config)
+
+    # Listing detail cache
+    listing_cache.configure(app.config)
+
+    # View count buffering
+    view_counter.configure(app.config)
+
+    # Register Blueprints
+    app.register_blueprint(reviews_bp)
+    app.register_blueprint(auth_bp)
+    app.register_blueprint(listings_bp)
+    app.register_blueprint(admin_bp)
+    app.register_blueprint(metrics_bp)
+    return app
+
+# Create the Flask app
+app = create_app()
 
 # Run the application
 if __name__ == '__main__':
+    # Make sure every index the endpoints rely on exists before serving
+    ensure_indexes()
     app.run(debug=True, port=5001)
@@ -0,0 +1,216 @@
+# Description: Async serving mode for the read-heavy endpoints (listing search,
+# listing detail, reviews and stats). A plain ASGI application built on pymongo's
+# AsyncMongoClient, so a worker keeps serving other requests while it waits on
+# MongoDB. It shares request parsing, configuration and JSON encoding with the
+# Flask app; writes and authenticated endpoints are only served by app.py.
+#
+# Run with:  uvicorn async_app:app --port 5002   (or: python async_app.py)
+import asyncio
+import re
+from urllib.parse import parse_qsl
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from werkzeug.datastructures import MultiDict
+import compression
+import globals
+import metrics
+import stats
+import view_counter
+from app import create_app
+from cache import AsyncSingleFlight
+from ratelimit import limiter, Rejected
+from listing_query import parse_listing_page, parse_fields, ListingQueryError
+from blueprints.reviews.reviews import (parse_review_page, review_page_response, ReviewPageError,
+                                        REVIEW_SUMMARY_PROJECTION, REVIEW_PROJECTION, REVIEW_SORT)
+
+# The Flask app is only used for its configuration and JSON provider
+flask_app = create_app()
+json_provider = flask_app.json
+
+_stats_flight = AsyncSingleFlight()
+
+
+# ---- handlers: each returns (status, payload) ----
+
+async def get_listings(args):
+    try:
+        page = parse_listing_page(args)
+    except ListingQueryError as e:
+        return 400, {"error": str(e)}
+
+    listings = globals.get_async_db().listings
+    cursor = listings.find(page.filter, page.projection)
+    if page.sort:
+        cursor = cursor.sort(page.sort)
+    listings_list = await cursor.skip(page.skip).limit(page.limit).to_list()
+
+    total_count = None
+    if page.include_total:
+        if page.use_estimated_count:
+            total_count = await listings.estimated_document_count()
+        else:
+            total_count = await listings.count_documents(page.query.filters)
+    return 200, page.response(listings_list, total_count)
+
+
+async def get_listing(args, id):
+    try:
+        projection = parse_fields(args)
+    except ListingQueryError as e:
+        return 400, {"error": str(e)}
+    try:
+        query = {"_id": ObjectId(id)}
+    except Exception as e:
+        return 400, {"error": "Invalid listing ID", "details": str(e)}
+
+    listings = globals.get_async_db().listings
+    if view_counter.view_counter.exact:
+        listing = await listings.find_one_and_update(query, {"$inc": {"views": 1}}, projection,
+                                                     return_document=ReturnDocument.AFTER)
+    else:
+        # Never flush from the event loop; the counter's timer thread does it
+        listing = view_counter.count_view(await listings.find_one(query, projection), autoflush=False)
+    if not listing:
+        return 404, {"error": "Listing not found"}
+    return 200, listing
+
+
+async def get_reviews(args, l_id):
+    try:
+        page_size, seek = parse_review_page(args)
+    except ReviewPageError as e:
+        return 400, {"error": e.error, "details": e.details}
+
+    try:
+        listing_id = ObjectId(l_id)
+    except Exception as e:
+        return 400, {"error": "Invalid listing ID", "details": str(e)}
+
+    db = globals.get_async_db()
+    listing = await db.listings.find_one({"_id": listing_id}, REVIEW_SUMMARY_PROJECTION)
+    if not listing:
+        return 404, {"error": "Listing not found"}
+
+    query = {"listing_id": listing_id}
+    if seek:
+        query["_id"] = seek
+    reviews_list = await db.reviews.find(query, REVIEW_PROJECTION).sort(REVIEW_SORT).limit(page_size + 1).to_list()
+    return 200, review_page_response(listing, reviews_list, page_size)
+
+
+async def _load_counters():
+    db = globals.get_async_db()
+    reads = globals.get_async_db("MONGO_STATS_READ_PREFERENCE")
+    state = await db.stats_state.find_one({"_id": "listing_stats"}) if stats.STATS_USE_COUNTERS else None
+    if stats.STATS_USE_COUNTERS and stats.recompute_due(state):
+        # Rebuilt by the synchronous implementation on its own thread
+        stats.recompute_in_background()
+    if not stats.STATS_USE_COUNTERS or not state:
+        docs = await (await reads.listings.aggregate(stats.active_stats_pipeline())).to_list()
+    else:
+        docs = await reads.listing_stats.find().to_list()
+    return stats.store_counters(docs)
+
+
+async def get_counters():
+    # Shares the in-memory stats cache with the sync code; concurrent misses coalesce
+    docs = stats.cached_counters()
+    if docs is not None:
+        return docs
+    return await _stats_flight.do("counters", _load_counters)
+
+
+async def average_price_by_type(args):
+    try:
+        return 200, {"stats": stats.average_price_by_type(await get_counters())}
+    except Exception as e:
+        return 500, {"error": "Aggregation error", "details": str(e)}
+
+
+async def listings_summary(args):
+    try:
+        return 200, stats.summary(await get_counters())
+    except Exception as e:
+        return 500, {"error": "Aggregation error", "details": str(e)}
+
+
+# Checked in order, so the fixed stats paths come before /listings/<id>. The
+# Flask endpoint each route mirrors sets its rate limit cost.
+ROUTES = [
+    (re.compile(r"^/listings$"), get_listings, "listings.get_listings"),
+    (re.compile(r"^/listings/stats/average_price_by_type$"), average_price_by_type, "listings.average_price_by_type"),
+    (re.compile(r"^/listings/stats/summary$"), listings_summary, "listings.listings_summary"),
+    (re.compile(r"^/listings/(?P<l_id>[^/]+)/reviews$"), get_reviews, "reviews_bp.get_reviews"),
+    (re.compile(r"^/listings/(?P<id>[^/]+)$"), get_listing, "listings.get_listing"),
+]
+
+
+# ---- ASGI plumbing ----
+
+async def send_json(send, status, payload, coding=None, extra_headers=()):
+    body = json_provider.dumps_bytes(payload) + b"\n"
+    headers = [(b"content-type", b"application/json"), (b"vary", b"Accept-Encoding"), *extra_headers]
+    # Same rules as the Flask app's compression
+    if coding and len(body) >= flask_app.config["COMPRESS_MIN_SIZE"]:
+        body = compression.compress(body, coding, flask_app.config["COMPRESS_GZIP_LEVEL"],
+                                    flask_app.config["COMPRESS_BROTLI_QUALITY"])
+        headers.append((b"content-encoding", coding.encode()))
+    headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Don't lose buffered views
+            await asyncio.to_thread(view_counter.view_counter.close)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+
+    for pattern, handler, endpoint in ROUTES:
+        match = pattern.match(scope["path"])
+        if match:
+            break
+    else:
+        return await send_json(send, 404, {"error": "Not found"})
+
+    if scope["method"] != "GET":
+        return await send_json(send, 405, {"error": "Method not allowed"})
+
+    args = MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+    accept_encoding = dict(scope["headers"]).get(b"accept-encoding", b"").decode("latin-1")
+    # Labelled like the Flask endpoints, with an "async." prefix
+    metrics.start_request(f"async.{handler.__name__}")
+    status = 500
+    slot = None
+    try:
+        # These endpoints are public, so only the client's IP is rate limited
+        try:
+            slot = limiter.enter()
+            limiter.check_rate(endpoint, (scope.get("client") or ("unknown",))[0])
+        except Rejected as e:
+            metrics.rejected_requests.inc((endpoint, e.reason))
+            status = e.status
+            return await send_json(send, status, {"error": e.error},
+                                   extra_headers=[(b"retry-after", str(e.retry_after).encode())])
+        status, payload = await handler(args, **match.groupdict())
+        await send_json(send, status, payload, compression.negotiate_header(accept_encoding))
+    finally:
+        limiter.leave(slot)
+        metrics.finish_request(scope["method"], status)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run("async_app:app", port=5002)
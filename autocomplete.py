@@ -0,0 +1,156 @@
+# Description: Prefix autocomplete for vehicle_model and location. The distinct
+# values of active listings, with how many listings use each, are kept in the
+# autocomplete_terms collection and updated by the listing write paths. Each
+# process answers from a sorted in-memory copy of the terms, reloaded
+# periodically, so typeahead requests never query the listings collection.
+import bisect
+import threading
+import time
+from pymongo import UpdateOne
+import globals
+from cache import SingleFlight
+
+# One document per (field, value): {_id: "<field>:<value>", field, value, count}
+terms_collection = globals.db.autocomplete_terms
+
+AUTOCOMPLETE_FIELDS = ["vehicle_model", "location"]
+# Terms added or removed by other processes show up within this many seconds
+AUTOCOMPLETE_REFRESH_INTERVAL = 30
+AUTOCOMPLETE_DEFAULT_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+# Results for prefixes up to this length match many terms, so they are memoized
+AUTOCOMPLETE_MEMO_PREFIX_LENGTH = 2
+
+_flight = SingleFlight()
+_lock = threading.Lock()
+_loaded = {"index": None, "at": 0}
+
+
+def normalize(text):
+    """Case-fold and collapse whitespace, so "  toyota  COROLLA" matches "Toyota Corolla"."""
+    return " ".join(text.casefold().split())
+
+
+def term_id(field, value):
+    return f"{field}:{value}"
+
+
+# ---- write path hooks ----
+
+def _terms_of(listing):
+    if listing is None or listing.get("status") != "active":
+        return []
+    return [(field, listing[field]) for field in AUTOCOMPLETE_FIELDS
+            if isinstance(listing.get(field), str) and listing[field].strip()]
+
+
+def _apply(deltas):
+    # deltas maps (field, value) to a change in its listing count
+    deltas = {term: delta for term, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    terms_collection.bulk_write([
+        UpdateOne({"_id": term_id(field, value)},
+                  {"$inc": {"count": delta}, "$setOnInsert": {"field": field, "value": value}},
+                  upsert=True)
+        for (field, value), delta in deltas.items()
+    ], ordered=False)
+    removed = [term_id(field, value) for (field, value), delta in deltas.items() if delta < 0]
+    if removed:
+        terms_collection.delete_many({"_id": {"$in": removed}, "count": {"$lte": 0}})
+
+
+def record_added_many(listings):
+    deltas = {}
+    for listing in listings:
+        for term in _terms_of(listing):
+            deltas[term] = deltas.get(term, 0) + 1
+    _apply(deltas)
+
+
+def record_added(listing):
+    record_added_many([listing])
+
+
+def record_removed(listing):
+    _apply({term: -1 for term in _terms_of(listing)})
+
+
+def record_changed(before, after):
+    deltas = {}
+    for term in _terms_of(before):
+        deltas[term] = deltas.get(term, 0) - 1
+    for term in _terms_of(after):
+        deltas[term] = deltas.get(term, 0) + 1
+    # Terms on both sides cancel out and are not written
+    _apply(deltas)
+
+
+# ---- lookups ----
+
+class PrefixIndex:
+    """
+    Sorted keys for binary search. A value is indexed under every word it
+    contains, so "cor" finds "Toyota Corolla" as well as "Corsa".
+    """
+
+    def __init__(self, terms):
+        entries = []
+        for term in terms:
+            words = normalize(term["value"]).split(" ")
+            for position in range(len(words)):
+                entries.append((" ".join(words[position:]), term["field"], term["value"], term["count"]))
+        entries.sort()
+        self.keys = [entry[0] for entry in entries]
+        self.entries = entries
+        self._memo = {}
+
+    def _matches(self, prefix, field):
+        best = {}
+        position = bisect.bisect_left(self.keys, prefix)
+        while position < len(self.keys) and self.keys[position].startswith(prefix):
+            _, term_field, value, count = self.entries[position]
+            if field is None or term_field == field:
+                best[(term_field, value)] = count
+            position += 1
+        return sorted(({"field": f, "value": v, "count": c} for (f, v), c in best.items()),
+                      key=lambda suggestion: (-suggestion["count"], suggestion["value"]))
+
+    def search(self, prefix, field=None, limit=AUTOCOMPLETE_DEFAULT_LIMIT):
+        prefix = normalize(prefix)
+        if len(prefix) > AUTOCOMPLETE_MEMO_PREFIX_LENGTH:
+            return self._matches(prefix, field)[:limit]
+        key = (prefix, field)
+        if key not in self._memo:
+            self._memo[key] = self._matches(prefix, field)[:AUTOCOMPLETE_MAX_LIMIT]
+        return self._memo[key][:limit]
+
+
+def load_index():
+    index = PrefixIndex(terms_collection.find({"count": {"$gt": 0}}, {"_id": 0, "field": 1, "value": 1, "count": 1}))
+    with _lock:
+        _loaded["index"] = index
+        _loaded["at"] = time.monotonic()
+    return index
+
+
+def get_index():
+    with _lock:
+        index = _loaded["index"]
+        fresh = index is not None and time.monotonic() - _loaded["at"] < AUTOCOMPLETE_REFRESH_INTERVAL
+    if fresh:
+        return index
+    # Concurrent requests share one reload
+    return _flight.do("load", load_index)
+
+
+def index_size():
+    """Keys in this process's loaded index, 0 before the first lookup."""
+    with _lock:
+        index = _loaded["index"]
+    return 0 if index is None else len(index.keys)
+
+
+def suggest(prefix, field=None, limit=AUTOCOMPLETE_DEFAULT_LIMIT):
+    """The most used values of field (or of every field) with a word starting with prefix."""
+    return get_index().search(prefix, field, limit)
@@ -0,0 +1,66 @@
+# Description: Requests/sec of the read endpoints served by the Flask app (threaded
+# WSGI server) and by async_app (uvicorn) against the same local mongod.
+# Usage: python -m benchmarks.async_vs_sync [--listings N] [--concurrency N] [--duration S]
+# Requires a running mongod (MONGO_URI) and uvicorn; uses the benchmark dataset
+# (see benchmarks/dataset.py), seeding it if needed.
+import argparse
+import json
+import sys
+import globals
+from benchmarks.dataset import use_benchmark_db, seed_dataset
+from benchmarks.loadgen import run_load, start_server
+
+HOST = "127.0.0.1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sync and async serving of the read endpoints")
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--sync-port", type=int, default=5101)
+    parser.add_argument("--async-port", type=int, default=5102)
+    parser.add_argument("--reset", action="store_true", help="Regenerate the benchmark dataset")
+    args = parser.parse_args()
+
+    use_benchmark_db()
+    seed_dataset(listings=args.listings, reset=args.reset)
+    ids = [str(doc["_id"]) for doc in globals.db.listings.find({}, {"_id": 1}).limit(200)]
+    endpoints = {
+        "get_listings": ["/listings?page_size=20", "/listings?page_size=20&sort=price"],
+        "get_listing": [f"/listings/{listing_id}" for listing_id in ids],
+        "get_reviews": [f"/listings/{listing_id}/reviews" for listing_id in ids],
+        "stats_summary": ["/listings/stats/summary"],
+        "stats_average_price_by_type": ["/listings/stats/average_price_by_type"],
+    }
+
+    servers = {
+        "sync": ([sys.executable, "-c",
+                  "from werkzeug.serving import run_simple; from app import app; "
+                  f"run_simple('{HOST}', {args.sync_port}, app, threaded=True)"], args.sync_port),
+        "async": ([sys.executable, "-m", "uvicorn", "async_app:app", "--host", HOST,
+                   "--port", str(args.async_port), "--log-level", "warning"], args.async_port),
+    }
+
+    results = {}
+    for mode, (command, port) in servers.items():
+        process = start_server(command, HOST, port)
+        try:
+            results[mode] = {
+                name: run_load(f"http://{HOST}:{port}", paths, args.concurrency, args.duration)
+                for name, paths in endpoints.items()
+            }
+        finally:
+            process.terminate()
+            process.wait()
+
+    print(json.dumps({
+        "listings": args.listings,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "results": results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
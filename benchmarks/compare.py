@@ -0,0 +1,47 @@
+# Description: Compare two benchmark reports written by benchmarks/suite.py,
+# printing each endpoint's throughput and latency percentiles side by side with
+# the relative change.
+# Usage: python -m benchmarks.compare baseline.json candidate.json
+import argparse
+import json
+
+METRICS = ["requests_per_second", "p50_ms", "p95_ms", "p99_ms"]
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return "n/a"
+    return f"{(new - old) / old * 100:+.1f}%"
+
+
+def compare(baseline, candidate):
+    """Yield (mode, scenario, metric, old, new, change) for every result in either report."""
+    for mode in sorted(set(baseline["results"]) | set(candidate["results"])):
+        old_results = baseline["results"].get(mode, {})
+        new_results = candidate["results"].get(mode, {})
+        for name in sorted(set(old_results) | set(new_results)):
+            for metric in METRICS:
+                old = old_results.get(name, {}).get(metric)
+                new = new_results.get(name, {}).get(metric)
+                yield mode, name, metric, old, new, change(old, new)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diff two benchmark reports")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    for key in ("git_commit", "dataset"):
+        print(f"{key}: {baseline['meta'].get(key)} -> {candidate['meta'].get(key)}")
+    print(f"{'mode':<10}{'scenario':<40}{'metric':<22}{'baseline':>12}{'candidate':>12}{'change':>10}")
+    for mode, name, metric, old, new, delta in compare(baseline, candidate):
+        print(f"{mode:<10}{name:<40}{metric:<22}{str(old):>12}{str(new):>12}{delta:>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# Description: Reproducible synthetic dataset for the benchmarks: users, listings
+# and reviews with a skewed number of reviews per listing, written to a local
+# mongod in batches. The same --seed always produces the same data.
+# Usage: python -m benchmarks.dataset [--listings N] [--users N] [--reviews-mean N] [--seed N] [--reset]
+# Writes to MONGO_DB_NAME if set, otherwise to ebay_used_cars_bench.
+import argparse
+import datetime
+import os
+import random
+import bcrypt
+from bson.objectid import ObjectId
+import globals
+import price_rollups
+import stats
+from indexes import ensure_indexes
+from migrations import rebuild_autocomplete_terms
+
+MAKES = {
+    "Toyota": ["Corolla", "Yaris", "RAV4", "Prius", "Auris", "Aygo"],
+    "Ford": ["Focus", "Fiesta", "Kuga", "Puma", "Mondeo"],
+    "Volkswagen": ["Golf", "Polo", "Tiguan", "Passat", "T-Roc"],
+    "BMW": ["320d", "118i", "X1", "X3", "520d"],
+    "Vauxhall": ["Corsa", "Astra", "Mokka", "Insignia"],
+    "Honda": ["Civic", "Jazz", "CR-V", "HR-V"],
+    "Nissan": ["Qashqai", "Juke", "Micra", "Leaf"],
+    "Kia": ["Sportage", "Ceed", "Picanto", "Niro"],
+}
+CAR_TYPES = ["Hatchback", "Sedan", "SUV", "Estate", "Coupe", "Convertible", "MPV"]
+# Listings are concentrated in the big cities
+LOCATIONS = ["London"] * 8 + ["Manchester"] * 4 + ["Birmingham"] * 4 + ["Leeds"] * 3 + ["Glasgow"] * 3 + [
+    "Belfast", "Cardiff", "Bristol", "Edinburgh", "Liverpool", "Newcastle", "Sheffield", "Nottingham",
+    "Southampton", "Leicester", "Brighton", "Aberdeen", "Derry", "Swansea", "York", "Exeter", "Norwich"]
+STATUSES = ["active"] * 90 + ["sold"] * 8 + ["reported"] * 2
+
+BENCH_DB_NAME = "ebay_used_cars_bench"
+
+# Reviews per listing follow a Pareto distribution: most listings have none or
+# a few, a handful have thousands
+REVIEW_PARETO_ALPHA = 1.5
+MAX_REVIEWS_PER_LISTING = 10000
+BATCH_SIZE = 1000
+REVIEW_BATCH_SIZE = 5000
+# Every generated user has this password
+PASSWORD = "benchmark"
+
+
+def use_benchmark_db():
+    """
+    Point this process, and servers it starts, at the benchmark database.
+    Rate limiting is turned off for them: the load comes from one client.
+    """
+    os.environ.setdefault("MONGO_DB_NAME", BENCH_DB_NAME)
+    os.environ.setdefault("RATELIMIT_ENABLED", "0")
+    globals.configure({"MONGO_DB_NAME": os.environ["MONGO_DB_NAME"]})
+    return os.environ["MONGO_DB_NAME"]
+
+
+def review_count(rng, mean):
+    # (X - 1) for X ~ Pareto(alpha) has mean 1 / (alpha - 1)
+    count = int((rng.paretovariate(REVIEW_PARETO_ALPHA) - 1) * mean * (REVIEW_PARETO_ALPHA - 1))
+    return min(count, MAX_REVIEWS_PER_LISTING)
+
+
+def make_users(rng, count):
+    # One low-cost hash shared by everyone; logging in is not what is measured
+    password = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(4))
+    users = [{"_id": ObjectId(), "username": "admin", "password": password, "role": "admin"}]
+    for n in range(count):
+        users.append({"_id": ObjectId(), "username": f"user{n}", "password": password,
+                      "role": "seller" if rng.random() < 0.6 else "buyer"})
+    return users
+
+
+def make_listing(rng, sellers, now):
+    make = rng.choice(list(MAKES))
+    return {
+        "_id": ObjectId(),
+        "vehicle_model": f"{make} {rng.choice(MAKES[make])}",
+        "price": round(rng.lognormvariate(9.3, 0.6), 2),
+        "mileage": int(rng.gammavariate(2.0, 25000)),
+        "location": rng.choice(LOCATIONS),
+        "car_type": rng.choice(CAR_TYPES),
+        "listing_age": int(rng.expovariate(1 / 45)),
+        "views": int(rng.expovariate(1 / 200)),
+        "user_id": str(rng.choice(sellers)["_id"]),
+        "status": rng.choice(STATUSES),
+        "version": 1,
+        "created_at": now,
+    }
+
+
+def make_reviews(rng, listing, count, usernames, now):
+    reviews = []
+    for _ in range(count):
+        reviews.append({
+            "_id": ObjectId(),
+            "listing_id": listing["_id"],
+            "user": rng.choice(usernames),
+            "review_text": rng.choice(["Great car", "As described", "Smooth sale", "Not as pictured",
+                                       "Would buy again", "Seller was slow to reply"]),
+            "rating": rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 6, 8])[0],
+            "created_at": now - datetime.timedelta(minutes=rng.randint(0, 525600)),
+        })
+    rating_sum = sum(review["rating"] for review in reviews)
+    listing["review_count"] = count
+    listing["rating_sum"] = rating_sum
+    listing["average_rating"] = round(rating_sum / count, 2) if count else None
+    return reviews
+
+
+def seed_dataset(listings=10000, users=1000, reviews_mean=2.0, seed=42, reset=False):
+    """
+    Populate the benchmark database unless it already holds a dataset
+    generated with the same parameters. Returns the dataset parameters.
+    """
+    db = globals.db
+    params = {"listings": listings, "users": users, "reviews_mean": reviews_mean, "seed": seed}
+    meta = db.benchmark_meta.find_one({"_id": "dataset"})
+    if meta and meta.get("params") == params and meta.get("complete") and not reset:
+        return params
+    if meta and not reset:
+        raise RuntimeError(f"The database holds a different or incomplete dataset ({meta.get('params')}); "
+                           f"pass --reset to replace it")
+
+    db_name = globals.get_db().name
+    if "bench" not in db_name:
+        raise RuntimeError(f"Refusing to reset {db_name}: the benchmark database name must contain 'bench'")
+    for name in ["users", "listings", "reviews", "listing_stats", "stats_state", "autocomplete_terms",
+                 "price_rollups", "versions", "blacklist", "benchmark_meta"]:
+        db[name].drop()
+    ensure_indexes()
+    db.benchmark_meta.insert_one({"_id": "dataset", "params": params, "complete": False})
+
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    user_docs = make_users(rng, users)
+    db.users.insert_many(user_docs, ordered=False)
+    sellers = [user for user in user_docs if user["role"] == "seller"] or user_docs
+    usernames = [user["username"] for user in user_docs]
+
+    written = review_total = 0
+    while written < listings:
+        batch = [make_listing(rng, sellers, now) for _ in range(min(BATCH_SIZE, listings - written))]
+        reviews = []
+        for listing in batch:
+            reviews.extend(make_reviews(rng, listing, review_count(rng, reviews_mean), usernames, now))
+        db.listings.insert_many(batch, ordered=False)
+        for start in range(0, len(reviews), REVIEW_BATCH_SIZE):
+            db.reviews.insert_many(reviews[start:start + REVIEW_BATCH_SIZE], ordered=False)
+        written += len(batch)
+        review_total += len(reviews)
+        print(f"Seeded {written}/{listings} listings, {review_total} reviews")
+
+    # Derived data the write paths would otherwise have maintained
+    stats.recompute_all()
+    rebuild_autocomplete_terms()
+    price_rollups.rebuild_all()
+    db.benchmark_meta.update_one({"_id": "dataset"}, {"$set": {"complete": True, "reviews": review_total}})
+    return params
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Seed the benchmark database with synthetic data")
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--reviews-mean", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reset", action="store_true", help="Drop and regenerate the benchmark collections")
+    args = parser.parse_args()
+    use_benchmark_db()
+    seed_dataset(args.listings, args.users, args.reviews_mean, args.seed, args.reset)
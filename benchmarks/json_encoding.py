@@ -0,0 +1,78 @@
+# Description: Micro-benchmark of listing page serialization: the old
+# convert_object_ids + jsonify path against MongoJSONProvider.
+# Usage: python -m benchmarks.json_encoding [--listings N] [--reviews N] [--repeat N]
+import argparse
+import datetime
+import json
+import random
+import timeit
+from bson.objectid import ObjectId
+from flask import Flask, jsonify
+from json_provider import MongoJSONProvider, orjson
+from utils import convert_object_ids
+
+
+def make_listing(review_count):
+    now = datetime.datetime.utcnow()
+    return {
+        "_id": ObjectId(),
+        "vehicle_model": random.choice(["Toyota Corolla", "Ford Focus", "BMW 320d", "Honda Civic"]),
+        "price": round(random.uniform(1000, 40000), 2),
+        "mileage": random.randint(0, 200000),
+        "location": random.choice(["London", "Leeds", "Belfast", "Glasgow"]),
+        "car_type": random.choice(["SUV", "Sedan", "Hatchback"]),
+        "listing_age": random.randint(0, 365),
+        "views": random.randint(0, 5000),
+        "user_id": str(ObjectId()),
+        "status": "active",
+        "reviews": [{
+            "_id": ObjectId(),
+            "user": f"user{i}",
+            "review_text": "Great car, would buy again.",
+            "rating": random.randint(1, 5),
+            "created_at": now
+        } for i in range(review_count)]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare listing page serialization paths")
+    parser.add_argument("--listings", type=int, default=100)
+    parser.add_argument("--reviews", type=int, default=20, help="embedded reviews per listing")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    page = [make_listing(args.reviews) for _ in range(args.listings)]
+    payload = {"listings": page, "page": 1, "page_size": len(page), "total_count": len(page)}
+
+    legacy_app = Flask("legacy")
+    provider_app = Flask("provider")
+    provider_app.json = MongoJSONProvider(provider_app)
+
+    def legacy():
+        with legacy_app.app_context():
+            body = dict(payload, listings=[convert_object_ids(listing) for listing in page])
+            return jsonify(body).get_data()
+
+    def provider():
+        with provider_app.app_context():
+            return jsonify(payload).get_data()
+
+    # Both paths must produce the same document
+    assert json.loads(legacy()) == json.loads(provider())
+
+    results = {}
+    for name, func in (("convert_object_ids+jsonify", legacy), ("MongoJSONProvider", provider)):
+        seconds = min(timeit.repeat(func, number=args.repeat, repeat=3)) / args.repeat
+        results[name] = seconds * 1000
+    print(json.dumps({
+        "listings": args.listings,
+        "reviews_per_listing": args.reviews,
+        "encoder": "orjson" if orjson is not None else "json",
+        "ms_per_page": {name: round(ms, 3) for name, ms in results.items()},
+        "speedup": round(results["convert_object_ids+jsonify"] / results["MongoJSONProvider"], 2)
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# Description: Minimal closed-loop HTTP load generator used by the benchmarks.
+# Each worker thread keeps one persistent connection and issues requests back
+# to back for the given duration.
+import http.client
+import socket
+import subprocess
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (in milliseconds) for one run."""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3) if latencies else None,
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+    }
+
+
+def run_load(base_url, paths, concurrency=8, duration=10.0, headers=None):
+    """
+    Request paths (cycled per worker) against base_url from `concurrency`
+    threads for `duration` seconds. Non-2xx/3xx responses count as errors.
+    """
+    parts = urlsplit(base_url)
+    deadline = time.perf_counter() + duration
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker(offset):
+        connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+        local_latencies = []
+        local_errors = 0
+        i = offset
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=30)
+                ok = False
+            if ok:
+                local_latencies.append(time.perf_counter() - started)
+            else:
+                local_errors += 1
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def time_calls(func, duration=10.0):
+    """
+    Call func() back to back on this thread for `duration` seconds. func
+    returns False (or raises) to count a call as an error.
+    """
+    latencies = []
+    errors = 0
+    started = time.perf_counter()
+    deadline = started + duration
+    while time.perf_counter() < deadline:
+        call_started = time.perf_counter()
+        try:
+            ok = func() is not False
+        except Exception:
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - call_started)
+        else:
+            errors += 1
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def wait_for_port(host, port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on {host}:{port} did not start within {timeout}s")
+
+
+def start_server(command, host, port, env=None):
+    """Start a server process and wait until it accepts connections."""
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+    try:
+        wait_for_port(host, port)
+    except RuntimeError:
+        process.terminate()
+        raise
+    return process
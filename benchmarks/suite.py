@@ -0,0 +1,196 @@
+# Description: Endpoint benchmark suite. Seeds (or reuses) the synthetic dataset,
+# then measures each scenario through the Flask test client (in process, one
+# request at a time) and through a threaded HTTP server under concurrent load,
+# plus the stats pipeline on its own. Writes requests/sec and p50/p95/p99
+# latency per endpoint as JSON; diff two runs with benchmarks/compare.py.
+# Usage: python -m benchmarks.suite [--listings N] [--modes client,http,pipelines] [--duration S]
+#        [--concurrency N] [--only name,...] [--output results.json]
+# Requires a running mongod (MONGO_URI).
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import uuid
+import jwt
+import pymongo
+import globals
+import price_rollups
+import stats
+from app import create_app
+from json_provider import orjson
+from benchmarks.dataset import use_benchmark_db, seed_dataset, MAKES, CAR_TYPES
+from benchmarks.loadgen import run_load, start_server, time_calls
+
+HOST = "127.0.0.1"
+# Distinct request paths generated per scenario; requests cycle through them
+PATHS_PER_SCENARIO = 200
+
+
+def price_range_path(rng):
+    low = rng.randint(1000, 30000)
+    return f"/listings?price_min={low}&price_max={low + 2000}&page_size=20"
+
+
+# Each scenario builds one request path from the sample data; "auth" scenarios
+# send a valid token
+SCENARIOS = [
+    ("get_listings[page]", False, lambda s, rng: f"/listings?page={rng.randint(1, 50)}&page_size=20"),
+    ("get_listings[deep page]", False, lambda s, rng: f"/listings?page={rng.randint(1000, 2000)}&page_size=20"),
+    ("get_listings[cursor, sort=price]", False, lambda s, rng: "/listings?cursor=&page_size=20&sort=price"),
+    ("get_listings[car_type, sort=-price]", False,
+     lambda s, rng: f"/listings?car_type={rng.choice(CAR_TYPES)}&sort=-price&page_size=20"),
+    ("get_listings[price range]", False, lambda s, rng: price_range_path(rng)),
+    ("get_listings[fields=*]", False, lambda s, rng: f"/listings?page={rng.randint(1, 50)}&page_size=20&fields=*"),
+    ("search_listings", False, lambda s, rng: f"/listings/search?q={rng.choice(s['model_words'])}"),
+    ("autocomplete", False, lambda s, rng: f"/listings/autocomplete?prefix={rng.choice(s['model_words'])[:2]}"),
+    ("get_listing", False, lambda s, rng: f"/listings/{rng.choice(s['listing_ids'])}"),
+    ("similar_listings", False, lambda s, rng: f"/listings/{rng.choice(s['listing_ids'])}/similar"),
+    ("get_reviews[popular listing]", False, lambda s, rng: f"/listings/{rng.choice(s['popular_ids'])}/reviews"),
+    ("stats.summary", False, lambda s, rng: "/listings/stats/summary"),
+    ("stats.average_price_by_type", False, lambda s, rng: "/listings/stats/average_price_by_type"),
+    ("stats.price_distribution", False,
+     lambda s, rng: f"/listings/stats/price_distribution?by={rng.choice(['car_type', 'location'])}"),
+    ("jwt_required[profile]", True, lambda s, rng: "/auth/profile"),
+]
+
+# Measured in process by calling the function directly
+PIPELINES = [
+    ("stats.aggregate_stats", stats.aggregate_stats),
+    ("price_rollups.rebuild_all", price_rollups.rebuild_all),
+]
+
+
+def sample_data():
+    """Listing ids and words the scenarios draw their paths from."""
+    listings = globals.db.listings
+    return {
+        "listing_ids": [str(doc["_id"]) for doc in listings.aggregate([{"$sample": {"size": 500}},
+                                                                       {"$project": {"_id": 1}}])],
+        "popular_ids": [str(doc["_id"]) for doc in listings.find({}, {"_id": 1}).sort("review_count", -1).limit(20)],
+        "model_words": sorted({word.lower() for make, models in MAKES.items() for word in [make] + models}),
+    }
+
+
+def make_token():
+    user = globals.db.users.find_one({"username": "user0"})
+    return jwt.encode({
+        "user": user["username"],
+        "role": user["role"],
+        "jti": uuid.uuid4().hex,
+        "exp": datetime.datetime.utcnow() + datetime.timedelta(hours=6)
+    }, globals.SECRET_KEY, algorithm="HS256")
+
+
+def build_paths(samples, seed):
+    rng = random.Random(seed)
+    return {name: (auth, [build(samples, rng) for _ in range(PATHS_PER_SCENARIO)])
+            for name, auth, build in SCENARIOS}
+
+
+def run_client(app, paths, headers, duration):
+    client = app.test_client()
+    position = [0]
+
+    def request():
+        path = paths[position[0] % len(paths)]
+        position[0] += 1
+        return client.get(path, headers=headers).status_code < 400
+    return time_calls(request, duration)
+
+
+def run_client_mode(app, scenarios, token, args):
+    results = {}
+    for name, (auth, paths) in scenarios.items():
+        headers = {"x-access-token": token} if auth else {}
+        run_client(app, paths, headers, args.warmup)
+        results[name] = run_client(app, paths, headers, args.duration)
+        print(f"client  {name}: {results[name]['requests_per_second']} req/s", file=sys.stderr)
+    return results
+
+
+def run_http_mode(scenarios, token, args, db_name):
+    command = [sys.executable, "-c", "from werkzeug.serving import run_simple; from app import app; "
+               f"run_simple('{HOST}', {args.port}, app, threaded=True)"]
+    process = start_server(command, HOST, args.port, env={**os.environ, "MONGO_DB_NAME": db_name})
+    results = {}
+    try:
+        base_url = f"http://{HOST}:{args.port}"
+        for name, (auth, paths) in scenarios.items():
+            headers = {"x-access-token": token} if auth else {}
+            run_load(base_url, paths, args.concurrency, args.warmup, headers)
+            results[name] = run_load(base_url, paths, args.concurrency, args.duration, headers)
+            print(f"http    {name}: {results[name]['requests_per_second']} req/s", file=sys.stderr)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints against a synthetic dataset")
+    parser.add_argument("--listings", type=int, default=10000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--reviews-mean", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--reset", action="store_true", help="Regenerate the benchmark dataset")
+    parser.add_argument("--modes", default="client,http,pipelines", help="Comma-separated: client, http, pipelines")
+    parser.add_argument("--only", help="Comma-separated scenario names to run")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds measured per scenario")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Seconds of unmeasured load per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="Client threads in http mode")
+    parser.add_argument("--port", type=int, default=5103)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    db_name = use_benchmark_db()
+    dataset = seed_dataset(args.listings, args.users, args.reviews_mean, args.seed, args.reset)
+    scenarios = build_paths(sample_data(), args.seed)
+    if args.only:
+        wanted = set(args.only.split(","))
+        scenarios = {name: scenario for name, scenario in scenarios.items() if name in wanted}
+    token = make_token()
+    modes = args.modes.split(",")
+
+    report = {
+        "meta": {
+            "started_at": datetime.datetime.utcnow().isoformat() + "Z",
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pymongo": pymongo.version,
+            "orjson": orjson is not None,
+            "dataset": dataset,
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+        },
+        "results": {}
+    }
+    if "client" in modes:
+        app = create_app({"MONGO_DB_NAME": db_name, "RATELIMIT_ENABLED": False})
+        report["results"]["client"] = run_client_mode(app, scenarios, token, args)
+    if "http" in modes:
+        report["results"]["http"] = run_http_mode(scenarios, token, args, db_name)
+    if "pipelines" in modes:
+        report["results"]["pipelines"] = {name: time_calls(func, args.duration) for name, func in PIPELINES}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,136 @@
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, Response, current_app, request, jsonify, make_response, stream_with_context
+from bson.errors import InvalidId
 from bson.objectid import ObjectId
-from decorators import admin_required
+from pymongo.errors import PyMongoError
+from cache import SingleFlight, TTLCache
+from decorators import admin_required, invalidate_user
 import globals
-from utils import convert_object_ids
+from listing_query import parse_listing_filters, parse_fields, ListingQueryError, LISTING_PROJECTION, MAX_PAGE_SIZE
+from repositories import listing_repository, RepositoryError, INACTIVE_STATUSES, SELLER_SUMMARY_SORTS
+from utils import encode_cursor, decode_cursor
 
 
 admin_bp = Blueprint('admin_bp', __name__)
 
 # Use the existing MongoDB connection from globals
-listings = globals.db.listings
 users = globals.db.users
 
-# Retrieve all reported or sold listings (excluding active listings)
+# Documents fetched per round trip when streaming exports
+EXPORT_BATCH_SIZE = 1000
+
+# Fields of GET /admin/listings unless fields= asks for others
+ADMIN_LISTING_FIELDS = ["vehicle_model", "status", "user_id"]
+
+ADMIN_DEFAULT_PAGE_SIZE = 50
+USER_ROLES = ["buyer", "seller", "admin"]
+
+# The sellers summary aggregates every listing, so results are kept for a few seconds
+SELLER_SUMMARY_TTL = 30
+SELLER_SUMMARY_DEFAULT_LIMIT = 100
+SELLER_SUMMARY_MAX_LIMIT = 1000
+seller_summary_cache = TTLCache(maxsize=64, ttl=SELLER_SUMMARY_TTL)
+_seller_summary_flight = SingleFlight()
+
+class AdminPageError(ValueError):
+    pass
+
+
+# Parse page_size and cursor into (page_size, filter on _id or None). Admin
+# lists are newest first, so the next page continues below the last _id.
+def parse_admin_page(args):
+    try:
+        page_size = int(args.get("page_size", ADMIN_DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise AdminPageError("Invalid pagination parameters")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise AdminPageError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+
+    token = args.get("cursor")
+    if not token:
+        return page_size, None
+    try:
+        return page_size, {"$lt": ObjectId(decode_cursor(token)["id"])}
+    except Exception:
+        raise AdminPageError("Invalid cursor")
+
+
+# One page of results (fetched with one extra document to detect a next page)
+def admin_page(name, docs, page_size):
+    has_more = len(docs) > page_size
+    docs = docs[:page_size]
+    return {
+        name: docs,
+        "page_size": page_size,
+        "next_cursor": encode_cursor({"id": str(docs[-1]["_id"])}) if has_more else None
+    }
+
+
+# Retrieve reported or sold listings (excluding active listings), newest first
 @admin_bp.route('/admin/listings', methods=['GET'])
 @admin_required
 def get_reported_listings(current_user):
-    # Query to retrieve all listings except active ones
-    query = {"status": {"$in": ["reported", "sold"]}}
+    # Query to retrieve all listings except active ones, or only one of those statuses
+    status = request.args.get("status")
+    if status is not None and status not in INACTIVE_STATUSES:
+        return make_response(jsonify({"error": f"Invalid status, expected one of: {', '.join(INACTIVE_STATUSES)}"}),
+                             400)
+    query = {"status": status or {"$in": INACTIVE_STATUSES}}
 
     # Filter by seller ID if provided
     seller_id = request.args.get("seller_id")
     if seller_id:
         query["user_id"] = seller_id
 
-    # Fetch listings from MongoDB
-    results = list(listings.find(query, {
-        "vehicle_model": 1,
-        "status": 1,
-        "user_id": 1  # Include seller reference
-    }))
-    
-    results = convert_object_ids(results)
-    for result in results:
-        result["seller_id"] = result.pop("user_id", "Unknown")
+    try:
+        page_size, seek = parse_admin_page(request.args)
+        projection = parse_fields(request.args, ADMIN_LISTING_FIELDS)
+    except (AdminPageError, ListingQueryError) as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    if seek:
+        query["_id"] = seek
 
+    # Fetch one page from MongoDB, served by the status_id / user_id_status_id indexes
+    results = listing_repository.find_newest(query, projection, page_size + 1)
+    page = admin_page("listings", results, page_size)
 
-    return make_response(jsonify(results), 200)
+    # Seller reference, unless other fields were asked for
+    if projection.get("user_id") == 1 or 1 not in projection.values():
+        for result in page["listings"]:
+            result["seller_id"] = result.pop("user_id", "Unknown")
+
+    return make_response(jsonify(page), 200)
+
+
+# Per seller listing counts for moderation, the sellers with the most reported
+# listings first (or sort=active, sold or total)
+@admin_bp.route('/admin/sellers/summary', methods=['GET'])
+@admin_required
+def get_sellers_summary(current_user):
+    sort = request.args.get("sort", "reported")
+    if sort not in SELLER_SUMMARY_SORTS:
+        return make_response(jsonify({"error": f"Invalid sort, expected one of: {', '.join(SELLER_SUMMARY_SORTS)}"}),
+                             400)
+    try:
+        limit = int(request.args.get("limit", SELLER_SUMMARY_DEFAULT_LIMIT))
+        if not 1 <= limit <= SELLER_SUMMARY_MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        return make_response(jsonify({"error": f"limit must be between 1 and {SELLER_SUMMARY_MAX_LIMIT}"}), 400)
+
+    key = (sort, limit)
+    sellers = seller_summary_cache.get(key)
+    if sellers is None:
+        def load():
+            result = listing_repository.seller_summary(sort, limit)
+            seller_summary_cache.set(key, result)
+            return result
+        try:
+            # Concurrent misses share one aggregation
+            sellers = _seller_summary_flight.do(key, load)
+        except Exception as e:
+            return make_response(jsonify({"error": "Aggregation error", "details": str(e)}), 500)
+
+    return make_response(jsonify({"sellers": sellers, "sort": sort}), 200)
 
 
 # Remove a specific reported or inactive listing by ID
@@ -43,52 +138,56 @@ def get_reported_listings(current_user):
 @admin_required
 def delete_listing(current_user, id):
     try:
-        # Check if the listing exists
-        listing = listings.find_one({"_id": ObjectId(id)})
-        if not listing:
-            return make_response(jsonify({"error": "Invalid listing ID", "details": str(e)}), 400)
-
-        # Ensure listing is either "reported" or "inactive" (sold)
-        if listing["status"] not in ["reported", "sold"]:
-            return make_response(jsonify({"error": "Only reported or inactive listings can be deleted"}), 403)
-
-        # Delete the listing
-        delete_result = listings.delete_one({"_id": ObjectId(id)})
-        if delete_result.deleted_count == 0:
-            return make_response(jsonify({"error": "Failed to delete listing"}), 500)
-
+        # Only matches a listing that is either "reported" or "inactive" (sold)
+        listing_repository.delete_inactive(id)
         return make_response(jsonify({"message": "Listing deleted successfully"}), 200)
-
+    except RepositoryError as e:
+        return make_response(jsonify({"error": str(e)}), e.status)
     except Exception as e:
         return make_response(jsonify({"error": "Invalid listing ID", "details": str(e)}), 400)
     
 
-# Retrieve all users
+# Retrieve users, newest first, optionally only those with a given role
 @admin_bp.route('/admin/users', methods=['GET'])
 @admin_required
 def get_users(current_user):
-    user_list = list(users.find({}, {
+    query = {}
+    role = request.args.get("role")
+    if role is not None:
+        if role not in USER_ROLES:
+            return make_response(jsonify({"error": f"Invalid role, expected one of: {', '.join(USER_ROLES)}"}), 400)
+        query["role"] = role
+
+    try:
+        page_size, seek = parse_admin_page(request.args)
+    except AdminPageError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    if seek:
+        query["_id"] = seek
+
+    user_list = list(users.find(query, {
         "_id": 1,
         "username": 1,
         "role": 1
-    }))
-    
-    user_list = convert_object_ids(user_list)
+    }).sort([("_id", -1)]).limit(page_size + 1))
 
-    return make_response(jsonify(user_list), 200)
+    return make_response(jsonify(admin_page("users", user_list, page_size)), 200)
 
 # Delete a user account
 @admin_bp.route('/admin/users/<id>', methods=['DELETE'])
 @admin_required
 def delete_user(current_user, id):
     try:
-        delete_result = users.delete_one({"_id": ObjectId(id)})
-        if delete_result.deleted_count == 0:
+        deleted_user = users.find_one_and_delete({"_id": ObjectId(id)}, {"username": 1})
+        if deleted_user is None:
             return make_response(jsonify({"error": "User not found"}), 404)
+        invalidate_user(deleted_user["username"])
 
         return make_response(jsonify({"message": "User deleted"}), 200)
-    except:
+    except InvalidId as e:
         return make_response(jsonify({"error": "Invalid user ID", "details": str(e)}), 400)
+    except PyMongoError as e:
+        return make_response(jsonify({"error": "Database error", "details": str(e)}), 500)
 
 # Update user role (e.g., promote to admin)
 @admin_bp.route('/admin/users/<id>/role', methods=['PUT'])
@@ -97,18 +196,57 @@ def update_user_role(current_user, id):
     data = request.json
     new_role = data.get("role")
 
-    if not new_role or new_role not in ["buyer", "seller", "admin"]:
+    if not new_role or new_role not in USER_ROLES:
         return make_response(jsonify({"error": "Invalid role"}), 400)
 
     try:
-        update_result = users.update_one(
+        # Returns the document as it was, so an unchanged role can still be detected
+        previous = users.find_one_and_update(
             {"_id": ObjectId(id)},
-            {"$set": {"role": new_role}}
+            {"$set": {"role": new_role}},
+            {"username": 1, "role": 1}
         )
-        
-        if update_result.modified_count == 0:
+
+        if previous is None or previous.get("role") == new_role:
             return make_response(jsonify({"error": "User not found or no changes made"}), 404)
+        invalidate_user(previous["username"])
 
         return make_response(jsonify({"message": "User role updated"}), 200)
-    except:
-        return make_response(jsonify({"error": "Invalid user ID", "details": str(e)}), 400)
\ No newline at end of file
+    except InvalidId as e:
+        return make_response(jsonify({"error": "Invalid user ID", "details": str(e)}), 400)
+    except PyMongoError as e:
+        return make_response(jsonify({"error": "Database error", "details": str(e)}), 500)
+
+# Stream every document of a cursor as newline-delimited JSON
+def stream_ndjson(cursor, filename):
+    def generate():
+        dumps = current_app.json.dumps
+        for doc in cursor:
+            yield dumps(doc) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+# Export listings as NDJSON, accepting the same filters as GET /listings
+@admin_bp.route('/admin/export/listings', methods=['GET'])
+@admin_required
+def export_listings(current_user):
+    try:
+        filters, _ = parse_listing_filters(request.args)
+    except ListingQueryError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+
+    cursor = listing_repository.find(filters, LISTING_PROJECTION).batch_size(EXPORT_BATCH_SIZE)
+    return stream_ndjson(cursor, "listings.ndjson")
+
+# Export users as NDJSON (password hashes are never included)
+@admin_bp.route('/admin/export/users', methods=['GET'])
+@admin_required
+def export_users(current_user):
+    query = {}
+    if request.args.get("role"):
+        query["role"] = request.args["role"]
+
+    cursor = users.find(query, {"password": 0}).batch_size(EXPORT_BATCH_SIZE)
+    return stream_ndjson(cursor, "users.ndjson")
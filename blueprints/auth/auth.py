@@ -1,17 +1,25 @@
 from flask import Blueprint, request, jsonify, make_response
-from decorators import jwt_required
+from decorators import jwt_required, invalidate_token, invalidate_user
 import jwt
 import datetime
-import bcrypt
+import uuid
 import globals
+from passwords import passwords, PasswordPoolBusy
+from revocation import revocations
 
 
 auth_bp = Blueprint('auth_bp', __name__)
 
-blacklist = globals.db.blacklist
 users = globals.db.users
 SECRET_KEY = globals.SECRET_KEY
 
+
+# Shed load when the password workers are saturated instead of stalling
+def password_pool_busy():
+    response = make_response(jsonify({"error": "Server busy, please retry"}), 503)
+    response.headers["Retry-After"] = "1"
+    return response
+
 # User Registration
 @auth_bp.route('/auth/register', methods=['POST'])
 def register():
@@ -26,7 +34,10 @@ def register():
     if users.find_one({"username": username}):
         return jsonify({"error": "User already exists"}), 400
 
-    hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+    try:
+        hashed_pw = passwords.hash(password)
+    except PasswordPoolBusy:
+        return password_pool_busy()
     users.insert_one({"username": username, "password": hashed_pw, "role": role})
     return jsonify({"message": "User registered successfully"}), 201
 
@@ -45,13 +56,23 @@ def login():
         return make_response(jsonify({'error': 'User not found'}), 404)
 
     # Verify password
-    if not bcrypt.checkpw(auth.password.encode('utf-8'), user['password']):
+    try:
+        valid, new_hash = passwords.verify(auth.password, user['password'])
+    except PasswordPoolBusy:
+        return password_pool_busy()
+    if not valid:
         return make_response(jsonify({'message': 'Invalid password'}), 401)
 
+    # The stored hash used an outdated work factor: replace it, unless it changed meanwhile
+    if new_hash is not None:
+        users.update_one({'_id': user['_id'], 'password': user['password']}, {'$set': {'password': new_hash}})
+        invalidate_user(auth.username)
+
     # Generate JWT token
     token = jwt.encode({
         'user': auth.username,
         'role': user['role'],
+        'jti': uuid.uuid4().hex,  # Identifies the token if it is revoked
         'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=1)  # Token valid for 1 hour
     }, globals.SECRET_KEY, algorithm='HS256')
 
@@ -69,6 +90,7 @@ def profile(current_user):
 @jwt_required
 def delete_account(current_user):
     users.delete_one({"username": current_user["username"]})
+    invalidate_user(current_user["username"])
     return jsonify({"message": "User account deleted"}), 200
 
 # User Logout
@@ -79,5 +101,6 @@ def logout(current_user):
     if not token:
         return jsonify({"error": "Token missing"}), 400
 
-    blacklist.insert_one({'token': token})
+    revocations.revoke(token)
+    invalidate_token(token)
     return make_response(jsonify({'message': 'Logged out successfully'}), 200)
@@ -1,93 +1,220 @@
 from flask import Blueprint, request, jsonify, make_response
+import json
 from bson.objectid import ObjectId
 from decorators import jwt_required
-import globals
-from utils import convert_object_ids
+import stats
+import autocomplete
+import price_rollups
+import similar
+import versions
+from etags import make_etag, query_key, not_modified, tag_response
+from listing_query import parse_listing_page, parse_search_page, parse_fields, ListingQueryError
+from repositories import listing_repository, RepositoryError
 
 # Initialize Blueprint
 listings_bp = Blueprint('listings', __name__)
 
-# Use the existing MongoDB connection from globals
-listings_collection = globals.db.listings
+DUPLICATE_KEY = 11000
 
-# Create a new car listing
-@listings_bp.route('/listings', methods=['POST'])
-@jwt_required
-def create_listing(current_user):
-    data = request.json
-    required_fields = ["vehicle_model", "price", "mileage", "location", "car_type", "listing_age"]
-    
-    if not all(field in data for field in required_fields):
-        return jsonify({"error": "Missing required fields"}), 400
+REQUIRED_FIELDS = ["vehicle_model", "price", "mileage", "location", "car_type", "listing_age"]
+# What an owner may change with PUT; everything else (user_id, status, version,
+# views and the review summary) is maintained by the server
+EDITABLE_FIELDS = REQUIRED_FIELDS
+
+# Bulk ingestion: documents per insert_many, and the most accepted per request
+BULK_CHUNK_SIZE = 500
+BULK_MAX_ITEMS = 50000
 
-    # Ensure "reviews" field exists; if not, initialize with an empty list
-    if "reviews" not in data:
-        data["reviews"] = []
+# Fill in the fields every new listing starts with
+def apply_listing_defaults(data, current_user):
+    # Reviews live in their own collection; the listing only keeps a summary
+    data.pop("reviews", None)
+    data["review_count"] = 0
+    data["rating_sum"] = 0
+    data["average_rating"] = None
 
     # Auto-generate views field with default value of 0
     data["views"] = 0
+    # Bumped by every write, for ETags
+    data["version"] = 1
 
     # Associate listing with current user and set default status
     data["user_id"] = str(current_user["_id"])
     data["status"] = "active"
+    return data
+
+# Create a new car listing
+@listings_bp.route('/listings', methods=['POST'])
+@jwt_required
+def create_listing(current_user):
+    data = request.json
+    
+    if not all(field in data for field in REQUIRED_FIELDS):
+        return jsonify({"error": "Missing required fields"}), 400
+
+    apply_listing_defaults(data, current_user)
     
-    listing_id = listings_collection.insert_one(data).inserted_id
+    listing_id = listing_repository.insert(data)
     return jsonify({"message": "Listing created", "listing_id": str(listing_id)}), 201
 
-# GET Listings with Pagination
-@listings_bp.route('/listings', methods=['GET'])
-def get_listings():
-    filters = {}
-    # For numeric fields
-    for key in ["price", "mileage"]:
-        if key in request.args:
+class BulkTooLarge(ValueError):
+    pass
+
+# Yield (index, item) pairs from a JSON array body or an NDJSON stream; items
+# that cannot be parsed are yielded as None so they get reported per row
+def read_bulk_items():
+    if request.mimetype == "application/x-ndjson":
+        index = 0
+        for line in request.stream:
+            if not line.strip():
+                continue
             try:
-                filters[key] = float(request.args[key])
+                item = json.loads(line)
             except ValueError:
-                filters[key] = request.args[key]
-    # For string fields
-    for key in ["vehicle_model", "location", "car_type"]:
-        if key in request.args:
-            filters[key] = request.args[key]
-    
-    # Pagination parameters: page (default 1) and page_size (default 10)
+                item = None
+            yield index, item
+            index += 1
+        return
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array or an application/x-ndjson body")
+    # Checked before the first row is inserted
+    if len(data) > BULK_MAX_ITEMS:
+        raise BulkTooLarge(f"At most {BULK_MAX_ITEMS} listings per request")
+    yield from enumerate(data)
+
+# Insert one chunk unordered and record the outcome of every row in it
+def insert_listing_chunk(chunk, results):
+    # chunk is a list of (index, document); pymongo assigns each document's _id
+    failed = listing_repository.insert_many([doc for _, doc in chunk])
+
+    for position, (index, doc) in enumerate(chunk):
+        error = failed.get(position)
+        if error is None:
+            results.append({"index": index, "status": "created", "listing_id": str(doc["_id"])})
+        elif error.get("code") == DUPLICATE_KEY:
+            results.append({"index": index, "status": "duplicate", "error": error.get("errmsg")})
+        else:
+            results.append({"index": index, "status": "failed", "error": error.get("errmsg")})
+    return len(chunk) - len(failed)
+
+# Create many listings at once from a JSON array or NDJSON stream
+@listings_bp.route('/listings/bulk', methods=['POST'])
+@jwt_required
+def create_listings_bulk(current_user):
+    results = []
+    chunk = []
+    created = 0
+    truncated = False
     try:
-        page = int(request.args.get("page", 1))
-        page_size = int(request.args.get("page_size", 10))
-    except ValueError:
-        return make_response(jsonify({"error": "Invalid pagination parameters"}), 400)
-    
-    skip = (page - 1) * page_size
-    cursor = listings_collection.find(filters).skip(skip).limit(page_size)
-    listings_list = list(cursor)
+        for index, item in read_bulk_items():
+            # An NDJSON stream's length is only known once read: stop here and
+            # report the rows before the limit, which are inserted below
+            if index >= BULK_MAX_ITEMS:
+                truncated = True
+                break
+            if not isinstance(item, dict):
+                results.append({"index": index, "status": "invalid", "error": "Item is not a JSON object"})
+                continue
+            if not all(field in item for field in REQUIRED_FIELDS):
+                missing = [field for field in REQUIRED_FIELDS if field not in item]
+                results.append({"index": index, "status": "invalid",
+                                "error": "Missing required fields", "missing": missing})
+                continue
 
-    listings_list = [convert_object_ids(listing) for listing in listings_list]
+            chunk.append((index, apply_listing_defaults(item, current_user)))
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                created += insert_listing_chunk(chunk, results)
+                chunk = []
+    except BulkTooLarge as e:
+        return jsonify({"error": str(e)}), 413
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    total_count = listings_collection.count_documents(filters)
+    if chunk:
+        created += insert_listing_chunk(chunk, results)
+
+    results.sort(key=lambda result: result["index"])
     response = {
-        "listings": listings_list,
-        "page": page,
-        "page_size": page_size,
-        "total_count": total_count,
-        "total_pages": (total_count + page_size - 1) // page_size
+        "created": created,
+        "failed": len(results) - created,
+        "results": results
     }
-    return make_response(jsonify(response), 200)
+    if truncated:
+        response["error"] = (f"At most {BULK_MAX_ITEMS} listings per request; "
+                             f"items from index {BULK_MAX_ITEMS} on were not read")
+        return jsonify(response), 413
+    return jsonify(response), 201 if created else 400
+
+# GET Listings with Pagination (page numbers, or keyset pages with "cursor")
+@listings_bp.route('/listings', methods=['GET'])
+def get_listings():
+    try:
+        page = parse_listing_page(request.args)
+    except ListingQueryError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+
+    return listing_page_response("listings", page)
+
+# Serve a page of listings, or 304 if no listing changed since the client fetched it.
+# View counts are not versioned, so a 304 may hide newer counts and the ETag is weak.
+# Only unconditional requests use the cached version: a 304 needs the current one.
+def listing_page_response(name, page):
+    version = versions.current(versions.LISTINGS) if request.if_none_match else versions.recent(versions.LISTINGS)
+    etag = make_etag(name, version, query_key(request.args))
+    cached = not_modified(etag, weak=True)
+    if cached:
+        return cached
+
+    listings_list = listing_repository.find_page(page)
+    total_count = listing_repository.count(page) if page.include_total else None
+    return tag_response(make_response(jsonify(page.response(listings_list, total_count)), 200), etag, weak=True)
+
+# Full-text search over vehicle_model and location, with the filters and pagination of GET /listings
+@listings_bp.route('/listings/search', methods=['GET'])
+def search_listings():
+    try:
+        page = parse_search_page(request.args)
+    except ListingQueryError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+
+    return listing_page_response("search", page)
+
+# Typeahead suggestions for vehicle_model and location, served from memory
+@listings_bp.route('/listings/autocomplete', methods=['GET'])
+def autocomplete_listings():
+    prefix = request.args.get("prefix", "")
+    field = request.args.get("field")
+    if not autocomplete.normalize(prefix):
+        return jsonify({"error": "Missing prefix"}), 400
+    if field is not None and field not in autocomplete.AUTOCOMPLETE_FIELDS:
+        return jsonify({"error": f"Invalid field, expected one of: {', '.join(autocomplete.AUTOCOMPLETE_FIELDS)}"}), 400
+    try:
+        limit = int(request.args.get("limit", autocomplete.AUTOCOMPLETE_DEFAULT_LIMIT))
+        if not 1 <= limit <= autocomplete.AUTOCOMPLETE_MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"limit must be between 1 and {autocomplete.AUTOCOMPLETE_MAX_LIMIT}"}), 400
+
+    return jsonify({"prefix": prefix, "suggestions": autocomplete.suggest(prefix, field, limit)}), 200
+
+# Build a stats response from the cached counters, tagged with the listings
+# version they reflect (unknown if the async app loaded them)
+def stats_response(name, build):
+    counters, version = stats.get_versioned_counters()
+    if version is None:
+        return make_response(jsonify(build(counters)), 200)
+    etag = make_etag(name, version)
+    return not_modified(etag) or tag_response(make_response(jsonify(build(counters)), 200), etag)
 
 # Aggregation Endpoint: Average Price by Car Type for Active Listings
 @listings_bp.route('/listings/stats/average_price_by_type', methods=['GET'])
 def average_price_by_type():
     try:
-        pipeline = [
-            {"$match": {"status": "active"}},
-            {"$group": {"_id": "$car_type", "average_price": {"$avg": "$price"}}},
-            {"$sort": {"average_price": 1}}
-        ]
-        stats = list(listings_collection.aggregate(pipeline))
-        # Convert ObjectId to string and round average_price to 2 decimal places
-        for stat in stats:
-            stat["_id"] = str(stat["_id"])
-            stat["average_price"] = round(stat["average_price"], 2)
-        return jsonify({"stats": stats}), 200
+        # Served from the incrementally maintained per car_type counters
+        return stats_response("average_price_by_type",
+                              lambda counters: {"stats": stats.average_price_by_type(counters)})
     except Exception as e:
         return jsonify({"error": "Aggregation error", "details": str(e)}), 500
     
@@ -95,36 +222,18 @@ def average_price_by_type():
 @listings_bp.route('/listings/stats/summary', methods=['GET'])
 def listings_summary():
     try:
-        pipeline = [
-            {"$match": {"status": "active"}},
-            {"$group": {
-                "_id": None,
-                "total_listings": {"$sum": 1},
-                "average_price": {"$avg": "$price"},
-                "max_price": {"$max": "$price"},
-                "min_price": {"$min": "$price"}
-            }},
-            {"$project": {
-                "_id": 0,
-                "total_listings": 1,
-                "average_price": {"$round": ["$average_price", 2]},
-                "max_price": {"$round": ["$max_price", 2]},
-                "min_price": {"$round": ["$min_price", 2]}
-            }}
-        ]
-        summary = list(listings_collection.aggregate(pipeline))
-        
-        # Additionally, count listings per car type
-        pipeline_by_type = [
-            {"$match": {"status": "active"}},
-            {"$group": {"_id": "$car_type", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
-        ]
-        counts_by_type = list(listings_collection.aggregate(pipeline_by_type))
-        for item in counts_by_type:
-            item["_id"] = str(item["_id"])
-
-        return make_response(jsonify({"summary": summary[0] if summary else {}, "counts_by_type": counts_by_type}), 200)
+        return stats_response("summary", stats.summary)
+    except Exception as e:
+        return make_response(jsonify({"error": "Aggregation error", "details": str(e)}), 500)
+
+# Aggregation Endpoint: Price and Mileage Distributions per car_type or location,
+# served from the periodically refreshed rollups
+@listings_bp.route('/listings/stats/price_distribution', methods=['GET'])
+def price_distribution():
+    try:
+        return make_response(jsonify(price_rollups.price_distribution(request.args)), 200)
+    except price_rollups.PriceDistributionError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
     except Exception as e:
         return make_response(jsonify({"error": "Aggregation error", "details": str(e)}), 500)
 
@@ -132,37 +241,75 @@ def listings_summary():
 @listings_bp.route('/listings/<id>', methods=['GET'])
 def get_listing(id):
     try:
-        listing = listings_collection.find_one({"_id": ObjectId(id)})
+        projection = parse_fields(request.args)
+    except ListingQueryError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        # Revalidation only reads the version; the view still counts
+        fields = query_key(request.args)
+        if request.if_none_match:
+            version = listing_repository.get_version(id)
+            if version is not None:
+                cached = not_modified(make_etag("listing", id, version, fields), weak=True)
+                if cached:
+                    listing_repository.count_view(id)
+                    return cached
+
+        # The version is needed for the ETag even when the client didn't ask for it
+        hide_version = 1 in projection.values() and "version" not in projection
+        if hide_version:
+            projection["version"] = 1
+
+        # Fetch the listing and count the view (buffered unless exact counts are configured)
+        listing = listing_repository.get_for_view(id, projection)
         if not listing:
             return jsonify({"error": "Listing not found"}), 404
 
-        # Increment views
-        listings_collection.update_one({"_id": ObjectId(id)}, {"$inc": {"views": 1}})
-
-        listing = convert_object_ids(listing)
+        etag = make_etag("listing", id, listing.get("version", 0), fields)
+        if hide_version:
+            listing.pop("version", None)
+        # Weak: the view count changes without the version
+        return tag_response(make_response(jsonify(listing), 200), etag, weak=True)
+    except Exception as e:
+        return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
 
-        return jsonify(listing), 200
+# Active listings most like this one, scored in memory against every active listing
+@listings_bp.route('/listings/<id>/similar', methods=['GET'])
+def similar_listings(id):
+    try:
+        limit = int(request.args.get("limit", similar.SIMILAR_DEFAULT_LIMIT))
+        if not 1 <= limit <= similar.SIMILAR_MAX_LIMIT:
+            raise ValueError
+    except ValueError:
+        return jsonify({"error": f"limit must be between 1 and {similar.SIMILAR_MAX_LIMIT}"}), 400
+    try:
+        ObjectId(id)
     except Exception as e:
         return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
 
-# Update a listing
+    try:
+        return jsonify(similar.similar_to(id, limit)), 200
+    except similar.ListingNotFound as e:
+        return jsonify({"error": str(e)}), 404
+
+# Update a listing (ownership is checked by the update itself)
 @listings_bp.route('/listings/<id>', methods=['PUT'])
 @jwt_required
 def update_listing(current_user, id):
-    try:
-        listing = listings_collection.find_one({"_id": ObjectId(id)})
-        if not listing:
-            return jsonify({"error": "Listing not found"}), 404
-
-        if listing.get("user_id") != str(current_user["_id"]):
-            return jsonify({"error": "Unauthorized"}), 403
-
-        data = request.json
-        update_result = listings_collection.update_one({"_id": ObjectId(id)}, {"$set": data})
-        if update_result.modified_count == 0:
-            return jsonify({"error": "No updates made"}), 400
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, dict) or not changes:
+        return jsonify({"error": "Expected a JSON object with the fields to update"}), 400
+    not_editable = sorted(field for field in changes if field not in EDITABLE_FIELDS)
+    if not_editable:
+        return jsonify({"error": f"Fields cannot be updated: {', '.join(not_editable)}",
+                        "editable": EDITABLE_FIELDS}), 400
 
+    try:
+        listing_repository.update_owned(id, str(current_user["_id"]), changes)
         return jsonify({"message": "Listing updated"}), 200
+    except RepositoryError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
 
@@ -171,38 +318,22 @@ def update_listing(current_user, id):
 @jwt_required
 def mark_listing_sold(current_user, id):
     try:
-        listing = listings_collection.find_one({"_id": ObjectId(id)})
-        if not listing:
-            return jsonify({"error": "Listing not found"}), 404
-
-        if listing.get("user_id") != str(current_user["_id"]):
-            return jsonify({"error": "Unauthorized"}), 403
-
-        update_result = listings_collection.update_one(
-            {"_id": ObjectId(id)},
-            {"$set": {"status": "sold"}}
-        )
-        if update_result.modified_count == 0:
-            return jsonify({"error": "No changes made"}), 400
-
+        listing_repository.mark_sold(id, str(current_user["_id"]))
         return jsonify({"message": "Listing marked as sold"}), 200
+    except RepositoryError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
 
-# Delete a listing
+# Delete a listing and its reviews
 @listings_bp.route('/listings/<id>', methods=['DELETE'])
 @jwt_required
 def delete_listing(current_user, id):
     try:
-        listing = listings_collection.find_one({"_id": ObjectId(id)})
-        if not listing:
-            return jsonify({"error": "Listing not found"}), 404
-
-        if listing.get("user_id") != str(current_user["_id"]):
-            return jsonify({"error": "Unauthorized"}), 403
-
-        delete_result = listings_collection.delete_one({"_id": ObjectId(id)})
+        listing_repository.delete_owned(id, str(current_user["_id"]))
         return jsonify({"message": "Listing deleted"}), 200
+    except RepositoryError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
 
@@ -211,18 +342,9 @@ def delete_listing(current_user, id):
 @jwt_required
 def report_listing(current_user, id):
     try:
-        listing = listings_collection.find_one({"_id": ObjectId(id)})
-        if not listing:
-            return jsonify({"error": "Listing not found"}), 404
-
-        update_result = listings_collection.update_one(
-            {"_id": ObjectId(id)},
-            {"$set": {
-                "status": "reported",
-                "reported_by": str(current_user["_id"])
-            }}
-        )
+        listing_repository.report(id, str(current_user["_id"]))
         return jsonify({"message": "Listing reported successfully"}), 200
+    except RepositoryError as e:
+        return jsonify({"error": str(e)}), e.status
     except Exception as e:
         return jsonify({"error": "Invalid listing ID", "details": str(e)}), 400
-
@@ -0,0 +1,22 @@
+import hmac
+from flask import Blueprint, Response, current_app, jsonify, request
+import metrics
+
+
+metrics_bp = Blueprint('metrics_bp', __name__)
+
+# Prometheus text exposition format
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Request, MongoDB command, cache and pool metrics of this worker process.
+# Only served to scrapers sending "Authorization: Bearer <METRICS_TOKEN>";
+# without a METRICS_TOKEN the endpoint doesn't exist.
+@metrics_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        return jsonify({"error": "Not found"}), 404
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(credentials.strip().encode(), token.encode()):
+        return jsonify({"error": "Invalid or missing metrics token"}), 401, {"WWW-Authenticate": "Bearer"}
+    return Response(metrics.render(), content_type=PROMETHEUS_CONTENT_TYPE)
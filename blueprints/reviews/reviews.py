@@ -1,44 +1,95 @@
 from flask import Blueprint, request, jsonify, make_response
-from decorators import jwt_required, admin_required
+from decorators import jwt_required, admin_required, decode_token, load_user
 from bson import ObjectId
-import globals
 import datetime
-import jwt
-from utils import convert_object_ids
+from utils import encode_cursor, decode_cursor
+from repositories import review_repository, RepositoryError
+from etags import make_etag, query_key, not_modified, tag_response
+from listing_query import MAX_PAGE_SIZE
 
 
 reviews_bp = Blueprint('reviews_bp', __name__)
 
-# Use globals.db for database access
-listings = globals.db.listings
-
 # Function to fetch user details from JWT token
 def get_current_user_from_token():
     token = request.headers.get('x-access-token')
     try:
-        data = jwt.decode(token, globals.SECRET_KEY, algorithms=['HS256'])
-        user = globals.db.users.find_one({
-            'username': {'$regex': f'^{data.get("user")}$', '$options': 'i'}
-        })
-        return user
+        data = decode_token(token)
+        return load_user(data.get('user'))
     except Exception:
         return None
 
-# Get reviews for a specific car listing
+# Review pages: newest first, one extra review fetched to detect a next page
+REVIEW_SUMMARY_PROJECTION = {'review_count': 1, 'average_rating': 1, 'version': 1}
+REVIEW_PROJECTION = {'listing_id': 0}
+REVIEW_SORT = [('_id', -1)]
+
+
+class ReviewPageError(ValueError):
+    def __init__(self, error, details):
+        super().__init__(error)
+        self.error = error
+        self.details = details
+
+
+# Parse page_size and cursor into (page_size, filter on review _id or None)
+def parse_review_page(args):
+    try:
+        page_size = int(args.get('page_size', 10))
+        if page_size < 1:
+            raise ValueError('page_size must be positive')
+        if page_size > MAX_PAGE_SIZE:
+            raise ValueError(f'page_size is limited to {MAX_PAGE_SIZE}')
+    except ValueError as e:
+        raise ReviewPageError('Invalid pagination parameters', str(e))
+
+    token = args.get('cursor')
+    if not token:
+        return page_size, None
+    try:
+        return page_size, {'$lt': ObjectId(decode_cursor(token)['id'])}
+    except Exception as e:
+        raise ReviewPageError('Invalid cursor', str(e))
+
+
+def review_page_response(listing, reviews_list, page_size):
+    has_more = len(reviews_list) > page_size
+    reviews_list = reviews_list[:page_size]
+    return {
+        'reviews': reviews_list,
+        'page_size': page_size,
+        'next_cursor': encode_cursor({'id': str(reviews_list[-1]['_id'])}) if has_more else None,
+        'review_count': listing.get('review_count', 0),
+        'average_rating': listing.get('average_rating')
+    }
+
+
+# Get reviews for a specific car listing, newest first, a page at a time
 @reviews_bp.route('/listings/<string:l_id>/reviews', methods=['GET'])
 def get_reviews(l_id):
     try:
-        listing = listings.find_one({'_id': ObjectId(l_id)}, {'reviews': 1, '_id': 0})
+        page_size, seek = parse_review_page(request.args)
+    except ReviewPageError as e:
+        return make_response(jsonify({'error': e.error, 'details': e.details}), 400)
+
+    try:
+        listing_id = ObjectId(l_id)
     except Exception as e:
         return make_response(jsonify({'error': 'Invalid listing ID', 'details': str(e)}), 400)
-    
+
+    listing = review_repository.listing_summary(listing_id, REVIEW_SUMMARY_PROJECTION)
     if not listing:
         return make_response(jsonify({'error': 'Listing not found'}), 404)
 
-    reviews_list = convert_object_ids(listing.get('reviews', []))
+    # Every review write bumps the listing's version, so it also versions its reviews
+    etag = make_etag('reviews', l_id, listing.get('version', 0), query_key(request.args))
+    cached = not_modified(etag)
+    if cached:
+        return cached
 
+    reviews_list = review_repository.find_page(listing_id, seek, page_size + 1, REVIEW_PROJECTION, REVIEW_SORT)
 
-    return make_response(jsonify(reviews_list), 200)
+    return tag_response(make_response(jsonify(review_page_response(listing, reviews_list, page_size)), 200), etag)
 
 # Add a review to a car listing
 @reviews_bp.route('/listings/<string:l_id>/reviews', methods=['POST'])
@@ -57,21 +108,23 @@ def add_review(current_user, l_id):
     if not review_text or not isinstance(rating, int) or rating < 1 or rating > 5:
         return make_response(jsonify({'error': 'Invalid review data'}), 400)
 
+    try:
+        listing_id = ObjectId(l_id)
+    except Exception as e:
+        return make_response(jsonify({'error': 'Invalid listing ID', 'details': str(e)}), 400)
+
     review = {
         '_id': ObjectId(),
+        'listing_id': listing_id,
         'user': current_user['username'],
         'review_text': review_text,
         'rating': rating,
         'created_at': datetime.datetime.utcnow()
     }
-
     try:
-        update_result = listings.update_one({'_id': ObjectId(l_id)}, {'$push': {'reviews': review}})
-    except Exception as e:
-        return make_response(jsonify({'error': 'Invalid listing ID', 'details': str(e)}), 400)
-    
-    if update_result.matched_count == 0:
-        return make_response(jsonify({'error': 'Listing not found'}), 404)
+        review_repository.add(review)
+    except RepositoryError as e:
+        return make_response(jsonify({'error': str(e)}), e.status)
 
     return make_response(jsonify({
         'message': 'Review added successfully',
@@ -102,65 +155,36 @@ def update_review(current_user, l_id, r_id):
         return make_response(jsonify({'error': 'Invalid review data'}), 400)
 
     try:
-        listing = listings.find_one({'_id': ObjectId(l_id), 'reviews._id': ObjectId(r_id)})
+        listing_id = ObjectId(l_id)
+        review_id = ObjectId(r_id)
     except Exception as e:
         return make_response(jsonify({'error': 'Invalid ID format', 'details': str(e)}), 400)
-    
-    if not listing:
-        return make_response(jsonify({'error': 'Listing or review not found'}), 404)
-
-    # Verify that the current user is the creator of the review
-    review_found = False
-    for review in listing.get('reviews', []):
-        if str(review['_id']) == r_id and review.get('user') == current_user.get('username'):
-            review_found = True
-            break
-
-    if not review_found:
-        return make_response(jsonify({'error': 'Unauthorized to update this review'}), 403)
 
+    # Only the review's creator matches the update
     try:
-        update_result = listings.update_one(
-            {'_id': ObjectId(l_id), 'reviews._id': ObjectId(r_id)},
-            {'$set': {
-                'reviews.$.review_text': new_review_text,
-                'reviews.$.rating': new_rating,
-                'reviews.$.created_at': datetime.datetime.utcnow()
-            }}
-        )
-    except Exception as e:
-        return make_response(jsonify({'error': 'Invalid ID format', 'details': str(e)}), 400)
-    
-    if update_result.modified_count > 0:
-        return make_response(jsonify({'message': 'Review updated successfully'}), 200)
-    else:
-        return make_response(jsonify({'error': 'No changes made'}), 400)
+        review_repository.update_owned(listing_id, review_id, current_user.get('username'), {
+            'review_text': new_review_text,
+            'rating': new_rating,
+            'created_at': datetime.datetime.utcnow()
+        })
+    except RepositoryError as e:
+        return make_response(jsonify({'error': str(e)}), e.status)
+
+    return make_response(jsonify({'message': 'Review updated successfully'}), 200)
 
 # Delete a review from a listing (only admin)
 @reviews_bp.route('/listings/<string:l_id>/reviews/<string:r_id>', methods=['DELETE'])
 @admin_required
 def delete_review(current_user, l_id, r_id):
     try:
-        listing = listings.find_one({'_id': ObjectId(l_id)})
+        listing_id = ObjectId(l_id)
+        review_id = ObjectId(r_id)
     except Exception as e:
-        return make_response(jsonify({'error': 'Invalid listing ID', 'details': str(e)}), 400)
-    
-    if not listing:
-        return make_response(jsonify({'error': 'Listing not found'}), 404)
-
-    review_exists = any(str(review["_id"]) == r_id for review in listing.get("reviews", []))
-    if not review_exists:
-        return make_response(jsonify({'error': 'Review not found'}), 404)
+        return make_response(jsonify({'error': 'Invalid ID format', 'details': str(e)}), 400)
 
     try:
-        update_result = listings.update_one(
-            {'_id': ObjectId(l_id)},
-            {'$pull': {'reviews': {'_id': ObjectId(r_id)}}}
-        )
-    except Exception as e:
-        return make_response(jsonify({'error': 'Invalid ID format', 'details': str(e)}), 400)
-    
-    if update_result.modified_count == 0:
-        return make_response(jsonify({'error': 'Review not deleted'}), 400)
+        review_repository.delete(listing_id, review_id)
+    except RepositoryError as e:
+        return make_response(jsonify({'error': str(e)}), e.status)
 
     return make_response(jsonify({'message': 'Review deleted successfully'}), 200)
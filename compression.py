@@ -0,0 +1,81 @@
+# Description: gzip/brotli compression of JSON responses. The coding is chosen
+# from the request's Accept-Encoding (brotli preferred when the brotli package is
+# installed), and bodies below COMPRESS_MIN_SIZE are sent as they are.
+import gzip
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {"application/json", "application/x-ndjson", "text/plain", "text/html"}
+
+
+def available_codings():
+    # In order of preference
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def negotiate(accept_encodings):
+    """The best available coding the client accepts (a parsed Accept-Encoding), or None."""
+    best, best_quality = None, 0
+    for coding in available_codings():
+        quality = accept_encodings.quality(coding)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def negotiate_header(value):
+    return negotiate(parse_accept_header(value or ""))
+
+
+def compress(data, coding, gzip_level=6, brotli_quality=5):
+    if coding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+
+def encoded_etag(etag, coding):
+    """A compressed body is a different representation, so it gets its own tag."""
+    return f"{etag}-{coding}"
+
+
+def compress_response(response):
+    etag, weak = response.get_etag()
+    if response.status_code == 304:
+        # Answer with the tag the client holds, which may be a compressed variant
+        if etag and request.if_none_match:
+            for coding in available_codings():
+                if request.if_none_match.contains_weak(encoded_etag(etag, coding)):
+                    response.set_etag(encoded_etag(etag, coding), weak)
+                    break
+        return response
+
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (response.status_code < 200 or response.status_code in (204, 206) or response.direct_passthrough
+            or response.is_streamed or "Content-Encoding" in response.headers):
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    coding = negotiate(request.accept_encodings)
+    if coding is None:
+        return response
+
+    response.set_data(compress(data, coding, current_app.config["COMPRESS_GZIP_LEVEL"],
+                               current_app.config["COMPRESS_BROTLI_QUALITY"]))
+    response.headers["Content-Encoding"] = coding
+    if etag:
+        response.set_etag(encoded_etag(etag, coding), weak)
+    return response
+
+
+def init_app(app):
+    app.after_request(compress_response)
@@ -0,0 +1,76 @@
+# Description: Application configuration. Every setting can be overridden with an
+# environment variable of the same name, or by passing a mapping to create_app().
+import os
+
+
+class Config:
+    # MongoDB connection
+    MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+    MONGO_DB_NAME = os.environ.get("MONGO_DB_NAME", "ebay_used_cars")
+
+    # Connection pool and timeouts (per worker process)
+    MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.environ.get("MONGO_CONNECT_TIMEOUT_MS", 5000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    MONGO_SOCKET_TIMEOUT_MS = int(os.environ["MONGO_SOCKET_TIMEOUT_MS"]) if "MONGO_SOCKET_TIMEOUT_MS" in os.environ else None
+
+    # Read preferences: primary, primaryPreferred, secondary, secondaryPreferred or nearest.
+    # Read-only aggregations (the stats endpoints) use MONGO_STATS_READ_PREFERENCE.
+    MONGO_READ_PREFERENCE = os.environ.get("MONGO_READ_PREFERENCE", "primary")
+    MONGO_STATS_READ_PREFERENCE = os.environ.get("MONGO_STATS_READ_PREFERENCE", "secondaryPreferred")
+
+    # Password hashing (see passwords.py). Workers default to one per CPU; requests
+    # beyond PASSWORD_MAX_PENDING waiting or running operations get a 503.
+    PASSWORD_BCRYPT_ROUNDS = int(os.environ.get("PASSWORD_BCRYPT_ROUNDS", 12))
+    PASSWORD_WORKERS = int(os.environ.get("PASSWORD_WORKERS", os.cpu_count() or 1))
+    PASSWORD_MAX_PENDING = int(os.environ.get("PASSWORD_MAX_PENDING", 4 * (os.cpu_count() or 1)))
+    PASSWORD_TIMEOUT = float(os.environ.get("PASSWORD_TIMEOUT", 10))
+
+    # Response compression (see compression.py): bodies smaller than this are sent uncompressed
+    COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+    COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", 6))
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 5))
+
+
+    # Instrumentation (see metrics.py): commands slower than METRICS_SLOW_COMMAND_MS are
+    # logged, with an explain() summary unless METRICS_EXPLAIN_SLOW is off. Responses
+    # carry a Server-Timing header unless METRICS_SERVER_TIMING is off.
+    METRICS_SLOW_COMMAND_MS = float(os.environ.get("METRICS_SLOW_COMMAND_MS", 100))
+    METRICS_EXPLAIN_SLOW = os.environ.get("METRICS_EXPLAIN_SLOW", "1") != "0"
+    METRICS_SERVER_TIMING = os.environ.get("METRICS_SERVER_TIMING", "1") != "0"
+    # GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>" and is disabled while it is unset
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # Admission control (see ratelimit.py). Token buckets per client IP and per
+    # authenticated user refill at *_RATE tokens per second up to *_BURST; a request
+    # costs 1 to 20 tokens depending on the route. RATELIMIT_MAX_CONCURRENT limits the
+    # requests in flight per process (0 for no limit). RATELIMIT_BACKEND may be set
+    # to another bucket store through create_app(config).
+    RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "1") != "0"
+    RATELIMIT_IP_RATE = float(os.environ.get("RATELIMIT_IP_RATE", 20))
+    RATELIMIT_IP_BURST = float(os.environ.get("RATELIMIT_IP_BURST", 100))
+    RATELIMIT_USER_RATE = float(os.environ.get("RATELIMIT_USER_RATE", 20))
+    RATELIMIT_USER_BURST = float(os.environ.get("RATELIMIT_USER_BURST", 100))
+    RATELIMIT_MAX_CONCURRENT = int(os.environ.get("RATELIMIT_MAX_CONCURRENT", 64))
+    RATELIMIT_BACKEND = None
+
+    # Listing detail cache (see listing_cache.py): whole listings are kept for up to
+    # LISTING_CACHE_TTL seconds, at most LISTING_CACHE_MAX_ENTRIES of them, and dropped by
+    # every write to the listing or its reviews. Each process caches on its own unless
+    # LISTING_CACHE_BACKEND is set to a shared store through create_app(config).
+    LISTING_CACHE_ENABLED = os.environ.get("LISTING_CACHE_ENABLED", "1") != "0"
+    LISTING_CACHE_TTL = float(os.environ.get("LISTING_CACHE_TTL", 10))
+    LISTING_CACHE_MAX_ENTRIES = int(os.environ.get("LISTING_CACHE_MAX_ENTRIES", 10000))
+    LISTING_CACHE_BACKEND = None
+
+    # View counting (see view_counter.py). "batched" buffers views in memory and writes
+    # them every VIEW_FLUSH_INTERVAL seconds, or sooner once VIEW_FLUSH_THRESHOLD
+    # listings have pending views; "exact" reads and increments in one query.
+    VIEW_COUNT_MODE = os.environ.get("VIEW_COUNT_MODE", "batched")
+    VIEW_FLUSH_INTERVAL = float(os.environ.get("VIEW_FLUSH_INTERVAL", 5))
+    VIEW_FLUSH_THRESHOLD = int(os.environ.get("VIEW_FLUSH_THRESHOLD", 1000))
+
+
+# The settings that configure the MongoDB client
+MONGO_SETTINGS = [name for name in vars(Config) if name.startswith("MONGO_")]
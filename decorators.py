@@ -1,13 +1,79 @@
 from flask import request, jsonify, make_response
+import datetime
 import jwt
 from functools import wraps
 import globals
+from cache import TTLCache
+from revocation import revocations
 
 # Use the existing MongoDB connection from globals
-blacklist = globals.db.blacklist
 users = globals.db.users
 SECRET_KEY = globals.SECRET_KEY  # Use SECRET_KEY from globals.py
 
+# Authenticated-principal cache: decoded token payloads keyed by token and user
+# documents keyed by username. Entries written here are invalidated when this
+# process logs the token out or changes/deletes the user; user changes made by
+# other workers become visible within PRINCIPAL_CACHE_TTL. A cached token is
+# still checked against the revocation Bloom filter on every use, so a logout
+# through another worker takes effect within REVOCATION_REFRESH_INTERVAL.
+PRINCIPAL_CACHE_TTL = 60
+PRINCIPAL_CACHE_SIZE = 10000
+token_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+user_cache = TTLCache(maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL)
+
+
+class TokenRevokedError(jwt.InvalidTokenError):
+    pass
+
+
+def decode_token(token):
+    """
+    Return the payload of a valid, non-revoked token. Raises the PyJWT
+    exceptions for bad tokens and TokenRevokedError for blacklisted ones.
+    """
+    data = token_cache.get(token)
+    if data is not None:
+        # An in-memory check unless the filter says the token may be revoked
+        if revocations.is_revoked(token, data):
+            token_cache.delete(token)
+            raise TokenRevokedError('Token is blacklisted')
+        return data
+
+    data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+    if revocations.is_revoked(token, data):
+        raise TokenRevokedError('Token is blacklisted')
+
+    # Never keep a token cached past its own expiry
+    remaining = None
+    if 'exp' in data:
+        remaining = data['exp'] - datetime.datetime.now(datetime.timezone.utc).timestamp()
+    token_cache.set(token, data, ttl=remaining)
+    return data
+
+
+def load_user(username):
+    user = user_cache.get(username)
+    if user is None:
+        user = users.find_one({'username': username})
+        if user is None:
+            return None
+        user_cache.set(username, user)
+    # Handlers get their own copy so they can't alter the cached document
+    return dict(user)
+
+
+def invalidate_token(token):
+    token_cache.delete(token)
+
+
+def invalidate_user(username):
+    user_cache.delete(username)
+
+
+def principal_cache_stats():
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
+
+
 # JWT token required decorator
 def jwt_required(func):
     @wraps(func)
@@ -17,19 +83,17 @@ def jwt_required(func):
             token = request.headers['x-access-token']
         if not token:
             return make_response(jsonify({'error': 'Token is missing'}), 401)
-        
+
         try:
-            data = jwt.decode(token, SECRET_KEY, algorithms=['HS256'])
+            data = decode_token(token)
         except jwt.ExpiredSignatureError:
             return make_response(jsonify({'error': 'Token has expired'}), 401)
+        except TokenRevokedError:
+            return make_response(jsonify({'error': 'Token is blacklisted'}), 401)
         except jwt.InvalidTokenError:
             return make_response(jsonify({'error': 'Token is invalid'}), 401)
 
-        bl_token = blacklist.find_one({'token': token})
-        if bl_token is not None:
-            return make_response(jsonify({'error': 'Token is blacklisted'}), 401)
-
-        current_user = users.find_one({'username': data['user']})
+        current_user = load_user(data['user'])
         if not current_user:
             return make_response(jsonify({'error': 'User not found'}), 401)
 
@@ -0,0 +1,41 @@
+# Description: Strong ETags and If-None-Match handling for the read endpoints.
+# Tags are derived from version counters (see versions.py), so a matching
+# request is answered with 304 before the response body is fetched or encoded.
+import hashlib
+from flask import request, make_response
+from compression import available_codings, encoded_etag
+
+
+def make_etag(*parts):
+    """A strong ETag for the representation identified by parts (name, version, arguments...)."""
+    return hashlib.blake2b(":".join(str(part) for part in parts).encode("utf-8"), digest_size=12).hexdigest()
+
+
+def query_key(args):
+    """Request arguments in a canonical order, so equivalent query strings share a tag."""
+    return "&".join(f"{key}={value}" for key, value in sorted(args.items(multi=True)))
+
+
+def not_modified(etag, weak=False):
+    """
+    A 304 response if the client already holds this representation, or a
+    compressed variant of it, otherwise None. Pass the same weak as for
+    tag_response.
+    """
+    if not request.if_none_match:
+        return None
+    variants = [etag] + [encoded_etag(etag, coding) for coding in available_codings()]
+    if not any(request.if_none_match.contains_weak(variant) for variant in variants):
+        return None
+    return tag_response(make_response("", 304), etag, weak)
+
+
+def tag_response(response, etag, weak=False):
+    """
+    Tag a response. Representations holding unversioned data (view counts)
+    get a weak ETag, since two different bodies can share its version.
+    """
+    response.set_etag(etag, weak)
+    # Let clients keep the body but revalidate before every reuse
+    response.headers["Cache-Control"] = "no-cache"
+    return response
@@ -1,10 +1,141 @@
 # Description: Global variables and constants
-from pymongo import MongoClient
+import os
+import threading
+from pymongo import MongoClient, ReadPreference
+from config import Config, MONGO_SETTINGS
 
 # MongoDB Connection
-client = MongoClient("mongodb://localhost:27017")
-db = client.ebay_used_cars
+# One client per process, created on first use. A process forked after the
+# client was created (e.g. a pre-forking server worker) gets its own client
+# instead of reusing sockets inherited from its parent.
+_settings = {name: getattr(Config, name) for name in MONGO_SETTINGS}
+_client = None
+_client_pid = None
+_async_client = None
+_async_client_pid = None
+_collections = {}
+_lock = threading.Lock()
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def configure(settings):
+    """
+    Apply the MONGO_* settings from a mapping (e.g. app.config). A client
+    created with earlier settings is discarded and rebuilt on next use.
+    """
+    global _client, _async_client
+    with _lock:
+        for name in MONGO_SETTINGS:
+            if name in settings:
+                _settings[name] = settings[name]
+        for name in ("MONGO_READ_PREFERENCE", "MONGO_STATS_READ_PREFERENCE"):
+            if _settings[name] not in READ_PREFERENCES:
+                raise ValueError(f"Unknown read preference for {name}: {_settings[name]}")
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+        _async_client = None
+        _collections.clear()
+
+
+def _client_options():
+    return {
+        "maxPoolSize": _settings["MONGO_MAX_POOL_SIZE"],
+        "minPoolSize": _settings["MONGO_MIN_POOL_SIZE"],
+        "connectTimeoutMS": _settings["MONGO_CONNECT_TIMEOUT_MS"],
+        "serverSelectionTimeoutMS": _settings["MONGO_SERVER_SELECTION_TIMEOUT_MS"],
+        "socketTimeoutMS": _settings["MONGO_SOCKET_TIMEOUT_MS"],
+        "readPreference": _settings["MONGO_READ_PREFERENCE"],
+    }
+
+
+def get_client():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _lock:
+            if _client is None or _client_pid != pid:
+                _collections.clear()
+                _client = MongoClient(_settings["MONGO_URI"], connect=False, **_client_options())
+                _client_pid = pid
+    return _client
+
+
+def get_async_db(read_preference_setting=None):
+    """
+    The database on this process's AsyncMongoClient (used by async_app),
+    configured like the synchronous client. It must only be used from the
+    event loop it was first used on.
+    """
+    global _async_client, _async_client_pid
+    pid = os.getpid()
+    if _async_client is None or _async_client_pid != pid:
+        from pymongo import AsyncMongoClient
+        _async_client = AsyncMongoClient(_settings["MONGO_URI"], connect=False, **_client_options())
+        _async_client_pid = pid
+    options = {}
+    if read_preference_setting:
+        options["read_preference"] = READ_PREFERENCES[_settings[read_preference_setting]]
+    return _async_client.get_database(_settings["MONGO_DB_NAME"], **options)
+
+
+def get_db():
+    return get_client()[_settings["MONGO_DB_NAME"]]
+
+
+def get_collection(name, read_preference_setting=None):
+    client = get_client()
+    key = (name, read_preference_setting)
+    collection = _collections.get(key)
+    if collection is None:
+        options = {}
+        if read_preference_setting:
+            options["read_preference"] = READ_PREFERENCES[_settings[read_preference_setting]]
+        collection = client[_settings["MONGO_DB_NAME"]].get_collection(name, **options)
+        _collections[key] = collection
+    return collection
+
+
+class LazyCollection:
+    """
+    Stands in for a pymongo Collection at module level: every attribute
+    access is forwarded to the collection on the current process's client.
+    """
+
+    def __init__(self, name, read_preference_setting=None):
+        self.name = name
+        self.read_preference_setting = read_preference_setting
+
+    def __getattr__(self, attr):
+        return getattr(get_collection(self.name, self.read_preference_setting), attr)
+
+    def __repr__(self):
+        return f"LazyCollection({self.name!r})"
+
+
+class LazyDatabase:
+    def __init__(self, read_preference_setting=None):
+        self.read_preference_setting = read_preference_setting
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return LazyCollection(name, self.read_preference_setting)
+
+    def __getitem__(self, name):
+        return LazyCollection(name, self.read_preference_setting)
+
+
+db = LazyDatabase()
+# The same collections, read with MONGO_STATS_READ_PREFERENCE (secondaries by default)
+stats_db = LazyDatabase("MONGO_STATS_READ_PREFERENCE")
 
 # Secret Key
 SECRET_KEY = 'mysecret'
-
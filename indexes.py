@@ -0,0 +1,186 @@
+# Description: Declares the MongoDB indexes each endpoint relies on, applies them
+# idempotently and verifies with explain() that no canonical query does a COLLSCAN.
+import datetime
+import sys
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, TEXT, IndexModel
+import globals
+
+# Indexes required per collection. Names are explicit so re-running is a no-op.
+INDEXES = {
+    "listings": [
+        # listings_summary / average_price_by_type ($match status) and status+type filters
+        IndexModel([("status", ASCENDING), ("car_type", ASCENDING), ("price", ASCENDING)],
+                   name="status_car_type_price"),
+        # The admin moderation queue, newest first: by status, and by seller and status
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status_id"),
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)], name="user_id_status_id"),
+        # get_listings equality filters followed by a sort key; the trailing _id
+        # keeps (sort key, _id) ordering index-provided for cursor pagination
+        IndexModel([("car_type", ASCENDING), ("price", ASCENDING), ("_id", ASCENDING)],
+                   name="car_type_price_id"),
+        IndexModel([("vehicle_model", ASCENDING), ("price", ASCENDING), ("_id", ASCENDING)],
+                   name="vehicle_model_price_id"),
+        IndexModel([("location", ASCENDING), ("price", ASCENDING), ("_id", ASCENDING)],
+                   name="location_price_id"),
+        # get_listings range filters and sorts
+        IndexModel([("price", ASCENDING), ("_id", ASCENDING)], name="price_id"),
+        IndexModel([("mileage", ASCENDING), ("_id", ASCENDING)], name="mileage_id"),
+        IndexModel([("listing_age", ASCENDING), ("_id", ASCENDING)], name="listing_age_id"),
+        # search_listings; no stemming or stop words, model names aren't English prose
+        IndexModel([("vehicle_model", TEXT), ("location", TEXT)], name="vehicle_model_location_text",
+                   weights={"vehicle_model": 3, "location": 1}, default_language="none"),
+    ],
+    "reviews": [
+        # get_reviews pages through a listing's reviews newest first
+        IndexModel([("listing_id", ASCENDING), ("_id", ASCENDING)], name="listing_id_id"),
+    ],
+    "users": [
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+        # GET /admin/users?role=, newest first
+        IndexModel([("role", ASCENDING), ("_id", ASCENDING)], name="role_id"),
+    ],
+    "blacklist": [
+        # Revocations are looked up by _id (the token's jti or hash); this TTL
+        # index drops them once the revoked token would have expired anyway
+        IndexModel([("exp", ASCENDING)], name="exp_ttl", expireAfterSeconds=0),
+    ],
+}
+
+# Indexes superseded by the ones above. ensure_indexes drops them so writes
+# stop maintaining them.
+OBSOLETE_INDEXES = {
+    "listings": [
+        # Replaced by the *_id indexes, which end in _id for cursor pagination
+        "car_type_price", "vehicle_model", "location", "price", "mileage",
+        # Replaced by user_id_status_id, which also orders each seller's listings
+        "user_id_status",
+    ],
+    # Revocations are keyed by _id now; the raw token is no longer stored
+    "blacklist": ["token_hashed"],
+}
+
+# The canonical query each endpoint issues, as (endpoint, collection, filter[, sort]).
+CANONICAL_QUERIES = [
+    ("listings.get_listings[vehicle_model]", "listings", {"vehicle_model": "Toyota Corolla"}),
+    ("listings.get_listings[location]", "listings", {"location": "London"}),
+    ("listings.get_listings[car_type]", "listings", {"car_type": "SUV"}),
+    ("listings.get_listings[car_type,price]", "listings", {"car_type": "SUV", "price": 10000.0}),
+    ("listings.get_listings[price]", "listings", {"price": 10000.0}),
+    ("listings.get_listings[mileage]", "listings", {"mileage": 50000.0}),
+    ("listings.get_listings[price range]", "listings", {"price": {"$gte": 5000.0, "$lte": 9000.0}}),
+    ("listings.get_listings[listing_age range]", "listings", {"listing_age": {"$lte": 30.0}}),
+    ("listings.get_listings[car_type, sort=price]", "listings", {"car_type": "SUV"},
+     [("price", 1), ("_id", 1)]),
+    ("listings.get_listings[vehicle_model, sort=-price]", "listings", {"vehicle_model": "Toyota Corolla"},
+     [("price", -1), ("_id", -1)]),
+    ("listings.get_listings[mileage range, sort=mileage]", "listings", {"mileage": {"$lte": 80000.0}},
+     [("mileage", 1), ("_id", 1)]),
+    ("listings.search_listings", "listings", {"$text": {"$search": "corolla"}}),
+    ("listings.search_listings[car_type]", "listings", {"$text": {"$search": "corolla"}, "car_type": "SUV"}),
+    ("listings.average_price_by_type", "listings", {"status": "active"}),
+    ("listings.listings_summary", "listings", {"status": "active"}),
+    ("admin.get_reported_listings", "listings", {"status": {"$in": ["reported", "sold"]}}, [("_id", -1)]),
+    ("admin.get_reported_listings[status]", "listings", {"status": "reported"}, [("_id", -1)]),
+    ("admin.get_reported_listings[seller_id]", "listings",
+     {"status": {"$in": ["reported", "sold"]}, "user_id": "000000000000000000000000"}, [("_id", -1)]),
+    ("admin.get_users", "users", {}, [("_id", -1)]),
+    ("admin.get_users[role]", "users", {"role": "seller"}, [("_id", -1)]),
+    ("reviews.get_reviews", "reviews", {"listing_id": ObjectId("000000000000000000000000")},
+     [("_id", -1)]),
+    ("revocation.refresh", "blacklist", {"exp": {"$gt": datetime.datetime(2000, 1, 1)}}),
+    ("decorators.jwt_required[users]", "users", {"username": "username"}),
+    ("auth.login", "users", {"username": "username"}),
+]
+
+
+class IndexVerificationError(Exception):
+    pass
+
+
+def ensure_indexes(db=None):
+    """
+    Create every declared index and drop the obsolete ones. Existing indexes
+    with the same name and spec are left untouched, so this is safe to call
+    on every startup.
+    """
+    db = globals.db if db is None else db
+    created = {}
+    for collection_name, models in INDEXES.items():
+        created[collection_name] = db[collection_name].create_indexes(models)
+    for collection_name, names in OBSOLETE_INDEXES.items():
+        existing = db[collection_name].index_information()
+        for name in names:
+            if name in existing:
+                db[collection_name].drop_index(name)
+    return created
+
+
+def _plan_nodes(plan):
+    # Walk a (possibly nested) winning plan and yield every stage
+    yield plan
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from _plan_nodes(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_nodes(child)
+
+
+def winning_plan(explanation):
+    """The winning plan of a find, count or aggregate explain() result."""
+    planner = explanation.get("queryPlanner")
+    if planner is None:
+        # Aggregations whose first stage was pushed down to the query system
+        for stage in explanation.get("stages", []):
+            if "$cursor" in stage:
+                planner = stage["$cursor"].get("queryPlanner")
+                break
+    return (planner or {}).get("winningPlan", {})
+
+
+def describe_plan(plan):
+    """A one-line summary of a winning plan, e.g. "FETCH <- IXSCAN(status_car_type_price)"."""
+    stages = []
+    for node in _plan_nodes(plan):
+        if node.get("stage"):
+            stages.append(f"{node['stage']}({node['indexName']})" if "indexName" in node else node["stage"])
+    return " <- ".join(stages) or "unknown"
+
+
+def explain_query(db, collection_name, query_filter, sort=None):
+    cursor = db[collection_name].find(query_filter)
+    if sort:
+        cursor = cursor.sort(sort)
+    plan = winning_plan(cursor.explain())
+    return [node["stage"] for node in _plan_nodes(plan) if node.get("stage")]
+
+
+def verify_indexes(db=None):
+    """
+    Run explain() on every canonical query and raise IndexVerificationError
+    listing the endpoints whose winning plan still contains a COLLSCAN, or
+    an in-memory SORT for queries that specify a sort.
+    """
+    db = globals.db if db is None else db
+    failures = []
+    for endpoint, collection_name, query_filter, *sort in CANONICAL_QUERIES:
+        sort = sort[0] if sort else None
+        stages = explain_query(db, collection_name, query_filter, sort)
+        if "COLLSCAN" in stages or (sort and "SORT" in stages):
+            failures.append(f"{endpoint}: {' <- '.join(stages)}")
+    if failures:
+        raise IndexVerificationError("Queries that are not index-backed:\n  " + "\n  ".join(failures))
+    return True
+
+
+# Usage: python indexes.py [--verify]
+if __name__ == '__main__':
+    for name, index_names in ensure_indexes().items():
+        print(f"{name}: {', '.join(index_names)}")
+    if "--verify" in sys.argv[1:]:
+        try:
+            verify_indexes()
+        except IndexVerificationError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        print("All canonical queries are index-backed")
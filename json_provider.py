@@ -0,0 +1,67 @@
+# Description: Flask JSON provider that serializes MongoDB types (ObjectId,
+# Decimal128, datetime) directly while encoding, so documents can be passed to
+# jsonify as they come from pymongo. Uses orjson when it is installed.
+import time
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+import metrics
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library encoder
+    orjson = None
+
+
+class MongoJSONProvider(DefaultJSONProvider):
+    """
+    Serializes ObjectId as its hex string and Decimal128 as a decimal string,
+    in addition to everything DefaultJSONProvider handles. Datetimes keep
+    Flask's HTTP date format whichever encoder is used.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, Decimal128):
+            return str(o.to_decimal())
+        return DefaultJSONProvider.default(o)
+
+    def _orjson_options(self, indent=None):
+        # Datetimes are passed through to default() to keep the HTTP date format
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps_bytes(self, obj, indent=None):
+        """Serialize to UTF-8 bytes, skipping the str round trip when orjson is available."""
+        started = time.perf_counter()
+        try:
+            return self._dumps_bytes(obj, indent)
+        finally:
+            metrics.record_encode(time.perf_counter() - started)
+
+    def _dumps_bytes(self, obj, indent):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=self.default, option=self._orjson_options(indent))
+            except (orjson.JSONEncodeError, TypeError):
+                # e.g. integers wider than 64 bits; let the standard library try
+                pass
+        if indent:
+            return super().dumps(obj, indent=indent).encode("utf-8")
+        return super().dumps(obj, separators=(",", ":")).encode("utf-8")
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and set(kwargs) <= {"indent", "separators"}:
+            return self.dumps_bytes(obj, kwargs.get("indent")).decode("utf-8")
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        return self._app.response_class(self.dumps_bytes(obj, indent) + b"\n", mimetype=self.mimetype)
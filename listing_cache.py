@@ -0,0 +1,112 @@
+# Description: Read-through cache of whole listing documents for GET
+# /listings/<id> and the listing summary of GET /listings/<id>/reviews. Listings
+# are stored BSON-encoded, so every hit decodes a private copy and a shared store
+# can hold the same bytes. Every write to a listing or its reviews invalidates
+# its entry; concurrent misses for one listing share a single read.
+import threading
+import bson
+from cache import SingleFlight, TTLCache
+from config import Config
+
+LISTING_CACHE_SETTINGS = ["LISTING_CACHE_ENABLED", "LISTING_CACHE_TTL", "LISTING_CACHE_MAX_ENTRIES",
+                          "LISTING_CACHE_BACKEND"]
+
+# An invalidated listing holds a tombstone this long instead of being deleted:
+# a read that fetched the listing before the write then cannot store the old
+# document after it, because it only stores into empty entries
+LISTING_CACHE_TOMBSTONE_TTL = 2
+TOMBSTONE = b""
+
+
+class MemoryBackend(TTLCache):
+    """
+    Entries in this process's memory, least recently used dropped first.
+    Any object with the same get(), set(), add() and delete() methods can
+    replace it, e.g. one keeping the entries in a store shared by every
+    worker; add() must only store into a missing or expired key.
+    """
+
+
+class ListingCache:
+    def __init__(self, settings=None):
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self._flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.configure(settings or {name: getattr(Config, name) for name in LISTING_CACHE_SETTINGS})
+
+    def configure(self, settings):
+        """Apply the LISTING_CACHE_* settings from a mapping (e.g. app.config)."""
+        self.enabled = bool(settings.get("LISTING_CACHE_ENABLED", getattr(self, "enabled", True)))
+        self.ttl = float(settings.get("LISTING_CACHE_TTL", getattr(self, "ttl", 10)))
+        max_entries = int(settings.get("LISTING_CACHE_MAX_ENTRIES", getattr(self, "max_entries", 10000)))
+        if settings.get("LISTING_CACHE_BACKEND") is not None:
+            self.backend = settings["LISTING_CACHE_BACKEND"]
+        elif self.backend is None or isinstance(self.backend, MemoryBackend):
+            self.backend = MemoryBackend(max_entries, self.ttl)
+        self.max_entries = max_entries
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, listing_id, load):
+        """
+        The listing with this id, from the cache or else from load(), which
+        returns the document or None. Each caller gets its own copy.
+        """
+        if not self.enabled:
+            return load()
+        key = str(listing_id)
+        data = self.backend.get(key)
+        self._count(bool(data))
+        if data:
+            return bson.decode(data)
+
+        def fill():
+            listing = load()
+            if listing is None:
+                return None
+            encoded = bson.encode(listing)
+            # Not over a tombstone: the write it marks may be newer than what load() saw
+            if data is None:
+                self.backend.add(key, encoded, self.ttl)
+            return encoded
+        # Concurrent misses share one read; each caller decodes its own copy
+        encoded = self._flight.do(key, fill)
+        return None if encoded is None else bson.decode(encoded)
+
+    def invalidate(self, listing_id):
+        """Drop a listing after a write to it or to its reviews."""
+        if self.enabled:
+            self.backend.set(str(listing_id), TOMBSTONE, LISTING_CACHE_TOMBSTONE_TTL)
+
+    def evict_many(self, listing_ids):
+        """
+        Drop listings without a tombstone, for changes that tolerate a read
+        racing them (flushed view counts).
+        """
+        if self.enabled:
+            for listing_id in listing_ids:
+                self.backend.delete(str(listing_id))
+
+    def stats(self):
+        size = self.backend.stats()["size"] if isinstance(self.backend, TTLCache) else 0
+        with self._lock:
+            return {"size": size, "hits": self.hits, "misses": self.misses}
+
+
+listing_cache = ListingCache()
+
+
+def project(listing, projection):
+    """Apply a top-level inclusion or exclusion projection, as parse_fields builds them, to a cached listing."""
+    if listing is None or not projection:
+        return listing
+    if any(projection.values()):
+        return {field: value for field, value in listing.items() if field == "_id" or projection.get(field)}
+    return {field: value for field, value in listing.items() if field not in projection}
@@ -0,0 +1,383 @@
+# Description: Builds listing search queries from request arguments and checks
+# that the requested sort can be served by one of the declared indexes.
+import logging
+import re
+from bson.objectid import ObjectId
+from indexes import INDEXES
+from utils import encode_cursor, decode_cursor
+
+logger = logging.getLogger(__name__)
+
+# Exact-match filters
+NUMERIC_FIELDS = ["price", "mileage"]
+STRING_FIELDS = ["vehicle_model", "location", "car_type"]
+
+# Range filters: <field>_min / <field>_max
+RANGE_FIELDS = ["price", "mileage", "listing_age"]
+
+# Fields clients may sort on, e.g. sort=price or sort=-price
+SORT_FIELDS = ["_id", "price", "mileage", "listing_age"]
+
+DEFAULT_PAGE_SIZE = 10
+# Larger pages are rejected: one request must not be able to pull the collection
+MAX_PAGE_SIZE = 100
+
+# Listings that predate the reviews collection may still embed a reviews
+# array until the migration has run; never send it to clients
+LISTING_PROJECTION = {"reviews": 0}
+# Search results also carry their relevance
+SEARCH_SCORE = {"score": {"$meta": "textScore"}}
+SEARCH_MAX_LENGTH = 200
+
+# What list views return unless the client asks for other fields (fields=a,b)
+# or for whole documents (fields=*)
+LISTING_LIST_FIELDS = ["vehicle_model", "price", "mileage", "location", "car_type", "listing_age",
+                       "status", "views", "review_count", "average_rating"]
+MAX_FIELDS = 30
+FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class ListingQueryError(ValueError):
+    pass
+
+
+class ListingQuery:
+    """
+    A planned listing search: the Mongo filter with equality predicates
+    first and range predicates after, the sort specification (always
+    tie-broken on _id so cursors are stable), and the index expected to
+    serve it.
+    """
+
+    def __init__(self, filters, equality_fields, sort_field, sort_direction, index_name):
+        self.filters = filters
+        self.equality_fields = equality_fields
+        self.sort_field = sort_field
+        self.sort_direction = sort_direction
+        self.index_name = index_name
+
+    @property
+    def sort(self):
+        if self.sort_field is None:
+            return None
+        if self.sort_field == "_id":
+            return [("_id", self.sort_direction)]
+        return [(self.sort_field, self.sort_direction), ("_id", self.sort_direction)]
+
+    def cursor_token(self, last_doc):
+        position = {"k": self.sort_field, "id": str(last_doc["_id"])}
+        if self.sort_field != "_id":
+            position["v"] = last_doc.get(self.sort_field)
+        return encode_cursor(position)
+
+    def seek_filter(self, token):
+        """
+        Return the filter restricted to documents after the cursor position.
+        The bound on the sort field lets the index seek straight to it; the
+        $or only breaks ties on _id.
+        """
+        position = decode_cursor(token)
+        if position.get("k") != self.sort_field:
+            raise ListingQueryError("Cursor does not match the requested sort")
+        try:
+            last_id = ObjectId(position["id"])
+        except Exception:
+            raise ListingQueryError("Invalid cursor")
+
+        op = "$gt" if self.sort_direction == 1 else "$lt"
+        inclusive = "$gte" if self.sort_direction == 1 else "$lte"
+        if self.sort_field == "_id":
+            seek = {"_id": {op: last_id}}
+        else:
+            value = position.get("v")
+            seek = {
+                self.sort_field: {inclusive: value},
+                "$or": [{self.sort_field: {op: value}}, {"_id": {op: last_id}}]
+            }
+        if not self.filters:
+            return seek
+        return {"$and": [self.filters, seek]}
+
+
+class ListingSearch(ListingQuery):
+    """
+    A full-text search over vehicle_model and location, served by the text
+    index. Without an explicit sort, results come by relevance.
+    """
+
+    def __init__(self, text, filters, equality_fields, sort_field, sort_direction):
+        super().__init__({"$text": {"$search": text}, **filters}, equality_fields, sort_field, sort_direction,
+                         "vehicle_model_location_text")
+        self.text = text
+
+    @property
+    def sort(self):
+        if self.sort_field is None:
+            return [("score", {"$meta": "textScore"}), ("_id", 1)]
+        return super().sort
+
+
+def _parse_number(args, key):
+    try:
+        return float(args[key])
+    except ValueError:
+        raise ListingQueryError(f"Invalid value for {key}")
+
+
+def parse_fields(args, default=None):
+    """
+    Turn fields=a,b,c into an inclusion projection, so fields nobody asked
+    for never leave the database. Without fields= the default field list is
+    used; fields=* (or no default) returns whole documents.
+    """
+    value = args.get("fields")
+    if value is None:
+        fields = default
+    elif value.strip() == "*":
+        fields = None
+    else:
+        fields = [field.strip() for field in value.split(",") if field.strip()]
+    if fields is None:
+        return dict(LISTING_PROJECTION)
+
+    if not fields or len(fields) > MAX_FIELDS:
+        raise ListingQueryError(f"fields must list between 1 and {MAX_FIELDS} field names")
+    for field in fields:
+        if not FIELD_NAME.match(field) or field == "reviews":
+            raise ListingQueryError(f"Invalid field name: {field}")
+    return {field: 1 for field in fields}
+
+
+def parse_listing_filters(args):
+    """
+    Translate request arguments into (filters, equality_fields). Equality
+    predicates are inserted before range predicates.
+    """
+    filters = {}
+    # For numeric fields
+    for key in NUMERIC_FIELDS:
+        if key in args:
+            try:
+                filters[key] = float(args[key])
+            except ValueError:
+                filters[key] = args[key]
+    # For string fields
+    for key in STRING_FIELDS:
+        if key in args:
+            filters[key] = args[key]
+    equality_fields = list(filters)
+
+    # Range fields
+    for key in RANGE_FIELDS:
+        bounds = {}
+        if f"{key}_min" in args:
+            bounds["$gte"] = _parse_number(args, f"{key}_min")
+        if f"{key}_max" in args:
+            bounds["$lte"] = _parse_number(args, f"{key}_max")
+        if not bounds:
+            continue
+        if key in filters:
+            raise ListingQueryError(f"Cannot combine {key} with {key}_min/{key}_max")
+        if "$gte" in bounds and "$lte" in bounds and bounds["$gte"] > bounds["$lte"]:
+            raise ListingQueryError(f"{key}_min is greater than {key}_max")
+        filters[key] = bounds
+
+    return filters, equality_fields
+
+
+def parse_sort(args, default=None):
+    sort = args.get("sort", default)
+    if sort is None:
+        return None, 1
+    direction = 1
+    if sort.startswith("-"):
+        sort, direction = sort[1:], -1
+    if sort not in SORT_FIELDS:
+        raise ListingQueryError(f"Invalid sort field, expected one of: {', '.join(SORT_FIELDS)}")
+    return sort, direction
+
+
+def find_sort_index(equality_fields, sort_field):
+    """
+    Return the name of a listings index that yields documents already in
+    (sort_field, _id) order once the equality predicates are applied, i.e.
+    one whose key pattern is some equality fields, then the sort field,
+    then _id. Indexes that also consume more equality predicates are
+    preferred. Returns None if only an in-memory SORT could serve the query.
+    """
+    if sort_field == "_id":
+        return "_id_"
+    best_name, best_prefix = None, -1
+    for model in INDEXES["listings"]:
+        keys = list(model.document["key"])
+        for position, field in enumerate(keys):
+            if field == sort_field:
+                if keys[position + 1:position + 2] == ["_id"] and position > best_prefix:
+                    best_name, best_prefix = model.document["name"], position
+                break
+            if field not in equality_fields:
+                break
+    return best_name
+
+
+def _index_uses_equality(index_name, equality_fields):
+    for model in INDEXES["listings"]:
+        if model.document["name"] == index_name:
+            return next(iter(model.document["key"])) in equality_fields
+    return False
+
+
+def plan_listing_query(args, default_sort=None):
+    """
+    Build a ListingQuery from request arguments. Sorts that no index can
+    provide are rejected when nothing narrows the result set (they would
+    sort the whole collection in memory) and logged as a warning otherwise.
+    """
+    filters, equality_fields = parse_listing_filters(args)
+    sort_field, sort_direction = parse_sort(args, default_sort)
+    if sort_field is None:
+        return ListingQuery(filters, equality_fields, None, 1, None)
+    index_name = find_sort_index(equality_fields, sort_field)
+
+    if index_name is None:
+        if not equality_fields:
+            raise ListingQueryError(f"Sorting by {sort_field} requires an exact-match filter "
+                                    f"that an index can use together with it")
+        logger.warning("Listing query on %s sorted by %s is not index-backed and will sort in memory",
+                       ", ".join(equality_fields), sort_field)
+    elif equality_fields and index_name != "_id_" and not _index_uses_equality(index_name, equality_fields):
+        # The order comes from the index but the filters are only applied after
+        # fetching, so a selective filter may still walk much of the index
+        logger.warning("Listing query on %s sorted by %s walks index %s without using the filters",
+                       ", ".join(equality_fields), sort_field, index_name)
+
+    return ListingQuery(filters, equality_fields, sort_field, sort_direction, index_name)
+
+
+class ListingPage:
+    """
+    One page of a listing search, parsed from request arguments: either a
+    page-number page (page, page_size) or, when "cursor" is passed (empty
+    for the first page), a keyset page that seeks past the cursor position.
+    """
+
+    def __init__(self, query, page, page_size, cursor_mode, query_filter, include_total,
+                 projection=LISTING_PROJECTION):
+        self.query = query
+        self.page = page
+        self.page_size = page_size
+        self.cursor_mode = cursor_mode
+        self.filter = query_filter
+        self.include_total = include_total
+        self.projection = projection
+
+    @property
+    def sort(self):
+        return self.query.sort
+
+    @property
+    def skip(self):
+        return 0 if self.cursor_mode else (self.page - 1) * self.page_size
+
+    @property
+    def limit(self):
+        # Cursor pages fetch one extra document to know whether another page exists
+        return self.page_size + 1 if self.cursor_mode else self.page_size
+
+    @property
+    def use_estimated_count(self):
+        # An unfiltered cursor count comes from collection metadata instead of a scan
+        return self.cursor_mode and not self.query.filters
+
+    def response(self, listings_list, total_count=None):
+        if not self.cursor_mode:
+            return {
+                "listings": listings_list,
+                "page": self.page,
+                "page_size": self.page_size,
+                "total_count": total_count,
+                "total_pages": (total_count + self.page_size - 1) // self.page_size
+            }
+
+        has_more = len(listings_list) > self.page_size
+        listings_list = listings_list[:self.page_size]
+        response = {
+            "listings": listings_list,
+            "page_size": self.page_size,
+            "next_cursor": self.query.cursor_token(listings_list[-1]) if has_more else None
+        }
+        if total_count is not None:
+            response["total_count"] = total_count
+        return response
+
+
+def _parse_page_numbers(args):
+    # Pagination parameters: page (default 1) and page_size (default 10, at most MAX_PAGE_SIZE)
+    try:
+        page, page_size = int(args.get("page", 1)), int(args.get("page_size", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise ListingQueryError("Invalid pagination parameters")
+    if page < 1 or page_size < 1:
+        raise ListingQueryError("Invalid pagination parameters")
+    if page_size > MAX_PAGE_SIZE:
+        raise ListingQueryError(f"page_size is limited to {MAX_PAGE_SIZE}")
+    return page, page_size
+
+
+def _cursor_page(query, page, page_size, args, projection=LISTING_PROJECTION):
+    query_filter = query.filters
+    token = args.get("cursor")
+    if token:
+        try:
+            query_filter = query.seek_filter(token)
+        except ValueError as e:
+            raise ListingQueryError(f"Invalid cursor: {e}")
+    # Counting is the expensive part, so cursor pages only count on request
+    include_total = args.get("include_total", "").lower() == "true"
+    return ListingPage(query, page, page_size, True, query_filter, include_total, projection)
+
+
+def parse_listing_page(args):
+    """
+    Parse the pagination, filter and sort arguments of GET /listings.
+    Raises ListingQueryError for anything invalid.
+    """
+    page, page_size = _parse_page_numbers(args)
+    cursor_mode = "cursor" in args
+    query = plan_listing_query(args, default_sort="_id" if cursor_mode else None)
+    projection = _page_projection(args, query)
+    if not cursor_mode:
+        return ListingPage(query, page, page_size, False, query.filters, True, projection)
+    return _cursor_page(query, page, page_size, args, projection)
+
+
+def _page_projection(args, query):
+    projection = parse_fields(args, LISTING_LIST_FIELDS)
+    # Cursor tokens are built from the sort field
+    if query.sort_field and 1 in projection.values():
+        projection[query.sort_field] = 1
+    return projection
+
+
+def parse_search_page(args):
+    """
+    Parse GET /listings/search: the text to search for in "q" plus the
+    filters, sort and pagination of GET /listings. Relevance-ordered
+    results are paged by number; cursor pages need an explicit sort.
+    """
+    text = " ".join(args.get("q", "").split())
+    if not text:
+        raise ListingQueryError("Missing search text q")
+    if len(text) > SEARCH_MAX_LENGTH:
+        raise ListingQueryError(f"Search text is limited to {SEARCH_MAX_LENGTH} characters")
+
+    page, page_size = _parse_page_numbers(args)
+    filters, equality_fields = parse_listing_filters(args)
+    sort_field, sort_direction = parse_sort(args)
+    query = ListingSearch(text, filters, equality_fields, sort_field, sort_direction)
+    projection = {**_page_projection(args, query), **SEARCH_SCORE}
+    if "cursor" not in args:
+        return ListingPage(query, page, page_size, False, query.filters, True, projection)
+    if sort_field is None:
+        raise ListingQueryError("Cursor pagination of search results requires a sort")
+    return _cursor_page(query, page, page_size, args, projection)
@@ -0,0 +1,448 @@
+# Description: Per-request and per-query instrumentation. Each request (Flask or
+# async_app) is timed per endpoint. A pymongo CommandListener adds the number of
+# MongoDB commands and the time spent in them to the endpoint that issued them,
+# and the JSON provider reports encoding time. Commands slower than
+# METRICS_SLOW_COMMAND_MS are logged with their filter and an explain() summary.
+# render() exposes everything, with cache and pool stats, in the Prometheus
+# text format for GET /metrics. Metrics are kept per process.
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson import SON, json_util
+from flask import current_app, request
+from pymongo import monitoring
+import autocomplete
+import globals
+import similar
+import stats
+from cache import TTLCache
+from decorators import token_cache, user_cache
+from indexes import describe_plan, winning_plan
+from listing_cache import listing_cache
+from passwords import passwords
+from view_counter import view_counter
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds: seconds, and commands per request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Endpoint label of commands issued outside a request (view flushes, background reloads)
+NO_ENDPOINT = "none"
+# Endpoint label of requests that matched no route
+UNMATCHED_ENDPOINT = "unmatched"
+
+# Commands that can be explained, and where each keeps its filter
+EXPLAINABLE_COMMANDS = {"find": "filter", "aggregate": "pipeline", "count": "query",
+                        "distinct": "query", "findAndModify": "query"}
+# Session and transaction fields are not part of the query and explain() rejects them
+COMMAND_SESSION_FIELDS = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern"}
+# A slow query shape is explained at most once per this many seconds
+EXPLAIN_INTERVAL = 300
+# Logged filters are cut to this many characters
+LOGGED_FILTER_LENGTH = 1000
+
+
+# ---- metric types ----
+
+INF_BUCKET = 'le="+Inf"'
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=""):
+    labels = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket..., sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[position] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((labels, list(values)) for labels, values in self._series.items())
+        for labels, values in series:
+            for position, bound in enumerate(self.buckets):
+                le = _format_labels(self.labels, labels, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{le} {values[position]}"
+            yield f"{self.name}_bucket{_format_labels(self.labels, labels, INF_BUCKET)} {values[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(values[-2])}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {values[-1]}"
+
+
+def _render_sampled(name, kind, documentation, labels, samples):
+    # Values read when scraped: samples maps label values to a number
+    yield f"# HELP {name} {documentation}"
+    yield f"# TYPE {name} {kind}"
+    for values, value in samples.items():
+        yield f"{name}{_format_labels(labels, values)} {_format_value(value)}"
+
+
+request_duration = Histogram("http_request_duration_seconds", "Time to handle a request.",
+                             ("endpoint", "method", "status"))
+request_db_time = Histogram("http_request_db_seconds", "Time a request spent waiting on MongoDB commands.",
+                            ("endpoint",))
+request_db_commands = Histogram("http_request_db_commands", "MongoDB commands issued by a request.",
+                                ("endpoint",), COMMAND_COUNT_BUCKETS)
+request_encode_time = Histogram("http_request_encode_seconds", "Time a request spent encoding JSON.",
+                                ("endpoint",))
+command_duration = Histogram("mongodb_command_duration_seconds", "MongoDB command round trip time.",
+                             ("endpoint", "command"))
+command_failures = Counter("mongodb_command_failures_total", "MongoDB commands that returned an error.",
+                           ("endpoint", "command"))
+slow_commands = Counter("mongodb_slow_commands_total", "MongoDB commands slower than METRICS_SLOW_COMMAND_MS.",
+                        ("endpoint", "command"))
+pool_checkout_wait = Histogram("mongodb_pool_checkout_seconds", "Time spent waiting for a pooled connection.",
+                               ("address",))
+pool_checkout_failures = Counter("mongodb_pool_checkout_failures_total", "Connection checkouts that failed.",
+                                 ("address", "reason"))
+rejected_requests = Counter("http_requests_rejected_total", "Requests turned away by admission control.",
+                            ("endpoint", "reason"))
+
+RECORDED_METRICS = [request_duration, request_db_time, request_db_commands, request_encode_time,
+                   command_duration, command_failures, slow_commands, pool_checkout_wait, pool_checkout_failures,
+                   rejected_requests]
+
+
+# ---- request timing ----
+
+class RequestTiming:
+    __slots__ = ("endpoint", "started", "db_seconds", "db_commands", "encode_seconds")
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.db_seconds = 0.0
+        self.db_commands = 0
+        self.encode_seconds = 0.0
+
+
+# A context variable rather than a thread local, so async_app's tasks each get their own
+_current = contextvars.ContextVar("request_timing", default=None)
+
+
+def start_request(endpoint):
+    timing = RequestTiming(endpoint or UNMATCHED_ENDPOINT)
+    _current.set(timing)
+    return timing
+
+
+def finish_request(method, status):
+    """Record the current request's metrics and return its timing (None outside a request)."""
+    timing = _current.get()
+    if timing is None:
+        return None
+    _current.set(None)
+    elapsed = time.perf_counter() - timing.started
+    request_duration.observe((timing.endpoint, method, str(status)), elapsed)
+    request_db_time.observe((timing.endpoint,), timing.db_seconds)
+    request_db_commands.observe((timing.endpoint,), timing.db_commands)
+    request_encode_time.observe((timing.endpoint,), timing.encode_seconds)
+    return timing
+
+
+def record_encode(seconds):
+    timing = _current.get()
+    if timing is not None:
+        timing.encode_seconds += seconds
+
+
+def server_timing(timing):
+    """A Server-Timing header value splitting the request into db, encode and app time."""
+    total = (time.perf_counter() - timing.started) * 1000
+    db = timing.db_seconds * 1000
+    encode = timing.encode_seconds * 1000
+    return (f'db;dur={db:.1f};desc="{timing.db_commands} commands", encode;dur={encode:.1f}, '
+            f'app;dur={max(total - db - encode, 0):.1f}, total;dur={total:.1f}')
+
+
+# ---- MongoDB monitoring ----
+
+def _shape(value):
+    # The structure of a filter without its values: queries differing only in values share a shape
+    if isinstance(value, dict):
+        return {key: _shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shape(item) for item in value]
+    return 1
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Attributes every command to the endpoint being served and reports slow
+    ones. Events are published on the thread (or task) that ran the command,
+    so the current request is the one that issued it.
+    """
+
+    def __init__(self, slow_ms=100, explain=True):
+        self.slow_ms = slow_ms
+        self.explain = explain
+        # The started event carries the command; it is kept until the command finishes
+        self._commands = {}
+        self._explained = TTLCache(maxsize=1024, ttl=EXPLAIN_INTERVAL)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        if event.command_name in EXPLAINABLE_COMMANDS:
+            self._commands[(event.connection_id, event.request_id)] = event.command
+
+    def succeeded(self, event):
+        command = self._commands.pop((event.connection_id, event.request_id), None)
+        endpoint = self._record(event)
+        if event.duration_micros >= self.slow_ms * 1000:
+            slow_commands.inc((endpoint, event.command_name))
+            self._report_slow(event, command, endpoint)
+
+    def failed(self, event):
+        self._commands.pop((event.connection_id, event.request_id), None)
+        endpoint = self._record(event)
+        command_failures.inc((endpoint, event.command_name))
+
+    def _record(self, event):
+        seconds = event.duration_micros / 1e6
+        timing = _current.get()
+        if timing is None:
+            endpoint = NO_ENDPOINT
+        else:
+            endpoint = timing.endpoint
+            timing.db_seconds += seconds
+            timing.db_commands += 1
+        command_duration.observe((endpoint, event.command_name), seconds)
+        return endpoint
+
+    def _report_slow(self, event, command, endpoint):
+        milliseconds = event.duration_micros / 1000
+        if command is None:
+            logger.warning("Slow %s on %s from %s (%.1f ms)", event.command_name, event.database_name,
+                           endpoint, milliseconds)
+            return
+        name = event.command_name
+        query = command.get(EXPLAINABLE_COMMANDS[name], {})
+        described = json_util.dumps(query)[:LOGGED_FILTER_LENGTH]
+        target = f"{event.database_name}.{command.get(name)}"
+        key = (target, name, repr(_shape(query)))
+        if not self.explain or self._explained.get(key) is not None:
+            logger.warning("Slow %s on %s from %s (%.1f ms): %s", name, target, endpoint, milliseconds, described)
+            return
+        self._explained.set(key, True)
+        # Never issue commands from inside the listener; explain on a background thread
+        self._get_executor().submit(self._explain_and_log, event.database_name, command,
+                                    name, target, endpoint, milliseconds, described)
+
+    def _get_executor(self):
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="explain")
+                    self._executor_pid = pid
+        return self._executor
+
+    def _explain_and_log(self, database_name, command, name, target, endpoint, milliseconds, described):
+        try:
+            query = {key: value for key, value in command.items()
+                     if key not in COMMAND_SESSION_FIELDS and not key.startswith("$")}
+            explanation = globals.get_client()[database_name].command(
+                SON([("explain", query), ("verbosity", "queryPlanner")]))
+            plan = describe_plan(winning_plan(explanation))
+        except Exception as e:
+            plan = f"explain failed: {e}"
+        logger.warning("Slow %s on %s from %s (%.1f ms): %s; plan: %s",
+                       name, target, endpoint, milliseconds, described, plan)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Open and checked out connections per server, and checkout waits."""
+
+    def __init__(self):
+        self.open = {}
+        self.checked_out = {}
+        self._lock = threading.Lock()
+
+    def _add(self, gauge, event, amount):
+        address = "%s:%s" % event.address
+        with self._lock:
+            gauge[address] = gauge.get(address, 0) + amount
+
+    def connection_created(self, event):
+        self._add(self.open, event, 1)
+
+    def connection_closed(self, event):
+        self._add(self.open, event, -1)
+
+    def connection_checked_out(self, event):
+        self._add(self.checked_out, event, 1)
+        if getattr(event, "duration", None) is not None:
+            pool_checkout_wait.observe(("%s:%s" % event.address,), event.duration)
+
+    def connection_checked_in(self, event):
+        self._add(self.checked_out, event, -1)
+
+    def connection_check_out_failed(self, event):
+        pool_checkout_failures.inc(("%s:%s" % event.address, str(event.reason)))
+
+    # Pool lifecycle events carry nothing worth counting
+    def pool_cleared(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def samples(self):
+        with self._lock:
+            return ({(address,): count for address, count in self.open.items()},
+                    {(address,): count for address, count in self.checked_out.items()})
+
+
+command_metrics = CommandMetrics()
+pool_metrics = PoolMetrics()
+_registered = False
+
+
+def configure(settings):
+    """Apply the METRICS_* settings and start listening to every MongoClient created afterwards."""
+    global _registered
+    command_metrics.slow_ms = float(settings.get("METRICS_SLOW_COMMAND_MS", command_metrics.slow_ms))
+    command_metrics.explain = bool(settings.get("METRICS_EXPLAIN_SLOW", command_metrics.explain))
+    if not _registered:
+        monitoring.register(command_metrics)
+        monitoring.register(pool_metrics)
+        _registered = True
+
+
+# ---- Prometheus exposition ----
+
+def _cache_samples():
+    caches = {"tokens": token_cache.stats(), "users": user_cache.stats(), "stats": stats.cache_stats(),
+              "listings": listing_cache.stats()}
+    return {field: {(name,): cache[field] for name, cache in caches.items()} for field in ("size", "hits", "misses")}
+
+
+def render():
+    lines = []
+    for metric in RECORDED_METRICS:
+        lines.extend(metric.render())
+
+    caches = _cache_samples()
+    lines.extend(_render_sampled("cache_entries", "gauge", "Entries held by an in-process cache.",
+                                 ("cache",), caches["size"]))
+    lines.extend(_render_sampled("cache_hits_total", "counter", "Lookups answered by an in-process cache.",
+                                 ("cache",), caches["hits"]))
+    lines.extend(_render_sampled("cache_misses_total", "counter", "Lookups an in-process cache could not answer.",
+                                 ("cache",), caches["misses"]))
+    lines.extend(_render_sampled("autocomplete_index_keys", "gauge", "Keys in the loaded autocomplete index.",
+                                 (), {(): autocomplete.index_size()}))
+    lines.extend(_render_sampled("similar_index_rows", "gauge", "Rows in the loaded similar listings index.",
+                                 (), {(): similar.index_size()}))
+    lines.extend(_render_sampled("view_counter_pending_listings", "gauge", "Listings with views not yet flushed.",
+                                 (), {(): view_counter.pending_listings()}))
+
+    open_connections, checked_out = pool_metrics.samples()
+    lines.extend(_render_sampled("mongodb_pool_connections", "gauge", "Open pooled connections.",
+                                 ("address",), open_connections))
+    lines.extend(_render_sampled("mongodb_pool_checked_out", "gauge", "Pooled connections in use.",
+                                 ("address",), checked_out))
+
+    pool = passwords.stats()
+    for field, kind, documentation in (("workers", "gauge", "Password hashing worker threads."),
+                              ("max_pending", "gauge", "Password operations allowed to wait or run."),
+                              ("in_flight", "gauge", "Password operations waiting or running."),
+                              ("rejected", "counter", "Password operations turned away with a 503.")):
+        name = f"password_pool_{field}" + ("_total" if kind == "counter" else "")
+        lines.extend(_render_sampled(name, kind, documentation, (), {(): pool[field]}))
+    return "\n".join(lines) + "\n"
+
+
+# ---- Flask integration ----
+
+def _before_request():
+    start_request(request.endpoint)
+
+
+def _after_request(response):
+    timing = finish_request(request.method, response.status_code)
+    if timing is not None and current_app.config.get("METRICS_SERVER_TIMING", True):
+        response.headers["Server-Timing"] = server_timing(timing)
+    return response
+
+
+def _teardown_request(exc):
+    # Commands after the response (e.g. streamed exports) are not charged to a finished request
+    _current.set(None)
+
+
+def init_app(app):
+    """
+    Register the timing hooks. Call before registering other after_request
+    hooks: they run in reverse order, so the timing then includes them.
+    """
+    configure(app.config)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
@@ -0,0 +1,146 @@
+# Description: One-off data migrations, run from the command line.
+import argparse
+import jwt
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import BulkWriteError
+import globals
+from autocomplete import AUTOCOMPLETE_FIELDS, term_id
+from revocation import revocation_key, revocation_expiry
+from utils import rating_summary_update
+
+DUPLICATE_KEY = 11000
+
+
+def migrate_embedded_reviews(db=None, batch_size=500):
+    """
+    Move reviews embedded in listing documents into the reviews collection,
+    batch_size listings at a time. Each listing's summary is adjusted and
+    its reviews array removed in a single update, so the migration can be
+    interrupted and re-run: reviews already copied are skipped as duplicates
+    and listings already migrated no longer match.
+    """
+    db = globals.db if db is None else db
+    listings = db.listings
+    reviews = db.reviews
+    migrated_listings = migrated_reviews = 0
+
+    while True:
+        batch = list(listings.find({"reviews": {"$exists": True}}, {"reviews": 1}).limit(batch_size))
+        if not batch:
+            break
+
+        review_docs = []
+        listing_updates = []
+        for listing in batch:
+            embedded = listing.get("reviews") or []
+            for review in embedded:
+                review_docs.append(dict(review, listing_id=listing["_id"]))
+            rating_total = sum(review.get("rating", 0) for review in embedded)
+            pipeline = rating_summary_update(len(embedded), rating_total) + [{"$unset": "reviews"}]
+            listing_updates.append(UpdateOne({"_id": listing["_id"], "reviews": {"$exists": True}}, pipeline))
+
+        if review_docs:
+            try:
+                reviews.insert_many(review_docs, ordered=False)
+            except BulkWriteError as e:
+                # Reviews copied by an earlier, interrupted run
+                errors = [err for err in e.details["writeErrors"] if err["code"] != DUPLICATE_KEY]
+                if errors:
+                    raise
+        listings.bulk_write(listing_updates, ordered=False)
+
+        migrated_listings += len(batch)
+        migrated_reviews += len(review_docs)
+        print(f"Migrated {migrated_listings} listings, {migrated_reviews} reviews")
+
+    return migrated_listings, migrated_reviews
+
+
+def migrate_legacy_blacklist(db=None, batch_size=500):
+    """
+    Convert blacklist entries that store the raw token into compact
+    revocation records keyed like revocation.revocation_key, with the
+    token's expiry so the TTL index can remove them.
+    """
+    db = globals.db if db is None else db
+    blacklist = db.blacklist
+    migrated = 0
+
+    while True:
+        batch = list(blacklist.find({"token": {"$exists": True}}).limit(batch_size))
+        if not batch:
+            break
+
+        requests = []
+        for entry in batch:
+            token = entry["token"]
+            try:
+                payload = jwt.decode(token, options={"verify_signature": False})
+            except jwt.InvalidTokenError:
+                payload = {}
+            requests.append(UpdateOne({"_id": revocation_key(token, payload)},
+                                      {"$set": {"exp": revocation_expiry(payload)}}, upsert=True))
+            requests.append(DeleteOne({"_id": entry["_id"]}))
+        blacklist.bulk_write(requests)
+
+        migrated += len(batch)
+        print(f"Migrated {migrated} blacklist entries")
+
+    return migrated
+
+
+def rebuild_autocomplete_terms(db=None, batch_size=500):
+    """
+    Recount the autocomplete terms from the active listings, writing
+    batch_size terms per round trip, and drop terms no listing uses any
+    more. Needed once for listings created before autocomplete existed;
+    safe to re-run.
+    """
+    db = globals.db if db is None else db
+    terms = db.autocomplete_terms
+    # Every term written by this run is stamped with its id, so the unused
+    # ones are those left with another stamp (or none)
+    run = ObjectId()
+    written = 0
+    requests = []
+
+    def flush():
+        if requests:
+            terms.bulk_write(requests, ordered=False)
+            print(f"Wrote {written} autocomplete terms")
+            requests.clear()
+
+    for field in AUTOCOMPLETE_FIELDS:
+        pipeline = [
+            {"$match": {"status": "active", field: {"$type": "string"}}},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}}
+        ]
+        for group in db.listings.aggregate(pipeline, allowDiskUse=True):
+            if not group["_id"].strip():
+                continue
+            written += 1
+            requests.append(UpdateOne({"_id": term_id(field, group["_id"])},
+                                      {"$set": {"field": field, "value": group["_id"], "count": group["count"],
+                                                "run": run}},
+                                      upsert=True))
+            if len(requests) >= batch_size:
+                flush()
+    flush()
+    terms.delete_many({"run": {"$ne": run}})
+    return written
+
+
+MIGRATIONS = {
+    "reviews": migrate_embedded_reviews,
+    "blacklist": migrate_legacy_blacklist,
+    "autocomplete": rebuild_autocomplete_terms,
+}
+
+# Usage: python migrations.py {reviews,blacklist,autocomplete} [--batch-size N]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a data migration")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+    MIGRATIONS[args.migration](batch_size=args.batch_size)
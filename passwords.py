@@ -0,0 +1,123 @@
+# Description: Password hashing and verification off the request threads. bcrypt
+# runs on a small bounded worker pool (bcrypt releases the GIL while it works), so
+# a burst of logins occupies at most PASSWORD_WORKERS cores, and requests beyond
+# PASSWORD_MAX_PENDING are refused straight away instead of queueing behind it.
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import bcrypt
+from config import Config
+
+PASSWORD_SETTINGS = ["PASSWORD_BCRYPT_ROUNDS", "PASSWORD_WORKERS", "PASSWORD_MAX_PENDING", "PASSWORD_TIMEOUT"]
+
+
+class PasswordPoolBusy(Exception):
+    """The pool is saturated; the caller should answer 503 and ask the client to retry."""
+    pass
+
+
+def hash_cost(hashed):
+    """The work factor a bcrypt hash was created with ($2b$<cost>$...)."""
+    if isinstance(hashed, str):
+        hashed = hashed.encode("utf-8")
+    return int(hashed.split(b"$")[2])
+
+
+class PasswordHasher:
+    def __init__(self, settings=None):
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        # Operations waiting or running, and operations turned away since startup
+        self.in_flight = 0
+        self.rejected = 0
+        self.configure(settings or {name: getattr(Config, name) for name in PASSWORD_SETTINGS})
+
+    def configure(self, settings):
+        """Apply the PASSWORD_* settings from a mapping (e.g. app.config)."""
+        rounds = int(settings.get("PASSWORD_BCRYPT_ROUNDS", getattr(self, "rounds", 12)))
+        if not 4 <= rounds <= 31:
+            raise ValueError(f"PASSWORD_BCRYPT_ROUNDS must be between 4 and 31, got {rounds}")
+        with self._lock:
+            self.rounds = rounds
+            self.workers = max(1, int(settings.get("PASSWORD_WORKERS", getattr(self, "workers", 1))))
+            self.max_pending = max(self.workers, int(settings.get("PASSWORD_MAX_PENDING", getattr(self, "max_pending", 1))))
+            self.timeout = float(settings.get("PASSWORD_TIMEOUT", getattr(self, "timeout", 10)))
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=False)
+            self._executor = None
+            self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def _get_executor(self):
+        # Created on first use in each process: threads don't survive a fork
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self._lock:
+                if self._executor is None or self._executor_pid != pid:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+                    self._executor_pid = pid
+        return self._executor
+
+    def _run(self, func, *args):
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            self._count(rejected=1)
+            raise PasswordPoolBusy("Too many password operations in progress")
+        self._count(in_flight=1)
+        try:
+            future = self._get_executor().submit(func, *args)
+        except Exception:
+            self._release(slots)
+            raise
+        # The slot is held until the work finishes, even if the caller gives up waiting
+        future.add_done_callback(lambda _: self._release(slots))
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            self._count(rejected=1)
+            raise PasswordPoolBusy("Timed out waiting for a password worker")
+
+    def _count(self, in_flight=0, rejected=0):
+        with self._lock:
+            self.in_flight += in_flight
+            self.rejected += rejected
+
+    def _release(self, slots):
+        self._count(in_flight=-1)
+        slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {"workers": self.workers, "max_pending": self.max_pending,
+                    "in_flight": self.in_flight, "rejected": self.rejected}
+
+    def needs_rehash(self, hashed):
+        return hash_cost(hashed) != self.rounds
+
+    def _hash(self, password, rounds):
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds))
+
+    def _verify(self, password, hashed, rounds):
+        if isinstance(hashed, str):
+            hashed = hashed.encode("utf-8")
+        if not bcrypt.checkpw(password.encode("utf-8"), hashed):
+            return False, None
+        if hash_cost(hashed) != rounds:
+            # Upgrade (or downgrade) to the configured cost while we have the password
+            return True, self._hash(password, rounds)
+        return True, None
+
+    def hash(self, password):
+        """Hash a password with the configured work factor."""
+        return self._run(self._hash, password, self.rounds)
+
+    def verify(self, password, hashed):
+        """
+        Check a password against a stored hash. Returns (matches, new_hash);
+        new_hash is set when the stored hash used a different work factor and
+        should replace it.
+        """
+        return self._run(self._verify, password, hashed, self.rounds)
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,315 @@
+# Description: Price and mileage distributions of active listings per car_type and
+# per location, for GET /listings/stats/price_distribution. Each group has a
+# rollup document in the price_rollups collection holding fine fixed-width
+# histograms, from which coarser histograms and percentiles are derived per
+# request. Listing writes only mark the groups they touch as dirty; a periodic
+# refresh recomputes just those groups from the listings, and a less frequent
+# full rebuild repairs anything missed. Both run on a background thread, and
+# requests are served the current rollups meanwhile.
+import datetime
+import logging
+import threading
+from pymongo import UpdateOne
+import globals
+from cache import SingleFlight, TTLCache
+
+logger = logging.getLogger(__name__)
+
+# One document per group: {_id: "<dimension>:<value>", dimension, value, dirty,
+# price: {count, min, max, buckets: [[bucket index, count], ...]}, mileage: {...}}
+rollups_collection = globals.db.price_rollups
+rollups_reads = globals.stats_db.price_rollups
+rollup_state = globals.db.stats_state
+# Rebuilds read every active listing, so they tolerate replication lag like the
+# stats aggregations: groups changed meanwhile stay dirty and are refreshed later.
+# A dirty group is refreshed from the primary, which has the write that marked it.
+listings_reads = globals.stats_db.listings
+listings_collection = globals.db.listings
+
+ROLLUP_DIMENSIONS = ["car_type", "location"]
+# Stored bucket widths. Requested widths must be multiples of these, and
+# percentiles are accurate to within one stored bucket.
+ROLLUP_BASE_WIDTHS = {"price": 100, "mileage": 1000}
+ROLLUP_DEFAULT_WIDTHS = {"price": 1000, "mileage": 10000}
+ROLLUP_PERCENTILES = [25, 50, 75, 90]
+# A response may hold at most this many histogram buckets per distribution
+ROLLUP_MAX_BUCKETS = 500
+# Dirty groups are recomputed at most this often; every group every ROLLUP_REBUILD_INTERVAL
+ROLLUP_REFRESH_INTERVAL = 60
+ROLLUP_REBUILD_INTERVAL = 3600
+# How long rollup documents are served from memory
+ROLLUP_CACHE_TTL = 5
+ROLLUP_STATE_ID = "price_rollups"
+
+# The fields whose change moves a listing between, or within, distributions
+_TRACKED_FIELDS = ["status", *ROLLUP_DIMENSIONS, *ROLLUP_BASE_WIDTHS]
+
+_flight = SingleFlight()
+_cache = TTLCache(maxsize=len(ROLLUP_DIMENSIONS), ttl=ROLLUP_CACHE_TTL)
+_refresh_lock = threading.Lock()
+_background = {"running": False}
+_background_lock = threading.Lock()
+
+
+class PriceDistributionError(ValueError):
+    pass
+
+
+def group_id(dimension, value):
+    return f"{dimension}:{value}"
+
+
+# ---- write path hooks ----
+
+def _groups_of(listing):
+    if listing is None or listing.get("status") != "active":
+        return []
+    return [(dimension, listing[dimension]) for dimension in ROLLUP_DIMENSIONS
+            if isinstance(listing.get(dimension), str)]
+
+
+def _mark_dirty(groups):
+    groups = set(groups)
+    if not groups:
+        return
+    rollups_collection.bulk_write([
+        UpdateOne({"_id": group_id(dimension, value)},
+                  {"$set": {"dirty": True}, "$setOnInsert": {"dimension": dimension, "value": value}},
+                  upsert=True)
+        for dimension, value in groups
+    ], ordered=False)
+
+
+def record_added_many(listings):
+    _mark_dirty(group for listing in listings for group in _groups_of(listing))
+
+
+def record_added(listing):
+    _mark_dirty(_groups_of(listing))
+
+
+def record_removed(listing):
+    _mark_dirty(_groups_of(listing))
+
+
+def record_changed(before, after):
+    if before is not None and after is not None and all(before.get(f) == after.get(f) for f in _TRACKED_FIELDS):
+        return
+    _mark_dirty(_groups_of(before) + _groups_of(after))
+
+
+# ---- recomputation ----
+
+def _histograms(dimension, field, value=None, listings=listings_reads):
+    """{group value: distribution of field} over active listings, optionally of one group only."""
+    width = ROLLUP_BASE_WIDTHS[field]
+    # Non-negative numbers only; this also leaves out NaN
+    match = {"status": "active", field: {"$type": "number", "$gte": 0}}
+    if value is not None:
+        match[dimension] = value
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"value": f"${dimension}", "bucket": {"$floor": {"$divide": [f"${field}", width]}}},
+            "count": {"$sum": 1},
+            "min": {"$min": f"${field}"},
+            "max": {"$max": f"${field}"},
+        }},
+    ]
+    distributions = {}
+    for row in listings.aggregate(pipeline, allowDiskUse=True):
+        group_value = row["_id"]["value"]
+        if not isinstance(group_value, str):
+            continue
+        distribution = distributions.setdefault(group_value, {"count": 0, "min": row["min"], "max": row["max"],
+                                                              "buckets": []})
+        distribution["count"] += row["count"]
+        distribution["min"] = min(distribution["min"], row["min"])
+        distribution["max"] = max(distribution["max"], row["max"])
+        distribution["buckets"].append([int(row["_id"]["bucket"]), row["count"]])
+    for distribution in distributions.values():
+        distribution["buckets"].sort()
+    return distributions
+
+
+def _store(dimension, value, distributions, now):
+    # $set rather than replace: a write that marked the group dirty again since
+    # it was claimed keeps its mark
+    rollups_collection.update_one({"_id": group_id(dimension, value)}, {"$set": {
+        "dimension": dimension,
+        "value": value,
+        **{field: distributions.get(field) for field in ROLLUP_BASE_WIDTHS},
+        "refreshed_at": now,
+    }}, upsert=True)
+
+
+def refresh_dirty():
+    """Recompute the groups marked dirty. Returns how many were recomputed."""
+    refreshed = 0
+    while True:
+        # Claimed one at a time, so concurrent refreshes never recompute the same group
+        group = rollups_collection.find_one_and_update({"dirty": True}, {"$set": {"dirty": False}},
+                                                       {"dimension": 1, "value": 1})
+        if group is None:
+            break
+        dimension, value = group["dimension"], group["value"]
+        distributions = {field: _histograms(dimension, field, value, listings_collection).get(value)
+                         for field in ROLLUP_BASE_WIDTHS}
+        if any(distributions.values()):
+            _store(dimension, value, distributions, datetime.datetime.utcnow())
+        else:
+            rollups_collection.delete_one({"_id": group["_id"], "dirty": False})
+        refreshed += 1
+    return refreshed
+
+
+def rebuild_all():
+    """
+    Recompute every group from the listings and drop groups with no active
+    listings. Dirty marks are kept: the secondary read may predate the writes
+    that set them, so those groups are still refreshed from the primary.
+    """
+    now = datetime.datetime.utcnow()
+    seen = []
+    for dimension in ROLLUP_DIMENSIONS:
+        by_field = {field: _histograms(dimension, field) for field in ROLLUP_BASE_WIDTHS}
+        for value in set().union(*by_field.values()):
+            _store(dimension, value, {field: by_field[field].get(value) for field in ROLLUP_BASE_WIDTHS}, now)
+            seen.append(group_id(dimension, value))
+    rollups_collection.delete_many({"_id": {"$nin": seen}, "dirty": False})
+    rollup_state.update_one({"_id": ROLLUP_STATE_ID}, {"$set": {"rebuilt_at": now, "refreshed_at": now}},
+                            upsert=True)
+    _cache.clear()
+    return len(seen)
+
+
+def refresh_due(state):
+    """"rebuild", "refresh" or None for the rollup state document."""
+    if not state or "rebuilt_at" not in state:
+        return "rebuild"
+    now = datetime.datetime.utcnow()
+    if (now - state["rebuilt_at"]).total_seconds() > ROLLUP_REBUILD_INTERVAL:
+        return "rebuild"
+    if (now - state["refreshed_at"]).total_seconds() > ROLLUP_REFRESH_INTERVAL:
+        return "refresh"
+    return None
+
+
+def refresh_if_due():
+    with _refresh_lock:
+        due = refresh_due(rollup_state.find_one({"_id": ROLLUP_STATE_ID}))
+        if due == "rebuild":
+            rebuild_all()
+            refresh_dirty()
+        elif due == "refresh":
+            refresh_dirty()
+            rollup_state.update_one({"_id": ROLLUP_STATE_ID},
+                                    {"$set": {"refreshed_at": datetime.datetime.utcnow()}}, upsert=True)
+
+
+def _run_refresh():
+    try:
+        refresh_if_due()
+        _cache.clear()
+    except Exception:
+        logger.exception("Price rollup refresh failed")
+    finally:
+        with _background_lock:
+            _background["running"] = False
+
+
+def refresh_in_background():
+    """Start refresh_if_due() on a thread unless one is already running in this process."""
+    with _background_lock:
+        if _background["running"]:
+            return
+        _background["running"] = True
+    threading.Thread(target=_run_refresh, name="price-rollups-refresh", daemon=True).start()
+
+
+# ---- reads ----
+
+def get_rollups(dimension):
+    """The rollup documents of one dimension, from memory while fresh."""
+    docs = _cache.get(dimension)
+    if docs is not None:
+        return docs
+
+    def load():
+        # Served as they are while the refresh runs
+        if refresh_due(rollup_state.find_one({"_id": ROLLUP_STATE_ID})):
+            refresh_in_background()
+        result = list(rollups_reads.find({"dimension": dimension}, {"dirty": 0}))
+        _cache.set(dimension, result)
+        return result
+    # Concurrent misses share one read (and refresh)
+    return _flight.do(dimension, load)
+
+
+def parse_width(args, field):
+    name = f"{field}_width"
+    base = ROLLUP_BASE_WIDTHS[field]
+    try:
+        width = int(args.get(name, ROLLUP_DEFAULT_WIDTHS[field]))
+    except ValueError:
+        raise PriceDistributionError(f"Invalid {name}")
+    if width < base or width % base:
+        raise PriceDistributionError(f"{name} must be a positive multiple of {base}")
+    return width
+
+
+def _percentile(distribution, base_width, percentile):
+    # Interpolated within the stored bucket holding the rank, then clamped to the observed range
+    rank = percentile / 100 * distribution["count"]
+    seen = 0
+    for index, count in distribution["buckets"]:
+        if seen + count >= rank:
+            value = (index + (rank - seen) / count) * base_width
+            return round(min(max(value, distribution["min"]), distribution["max"]), 2)
+        seen += count
+    return distribution["max"]
+
+
+def describe(distribution, field, width):
+    """Percentiles and a histogram of buckets width wide, from a stored distribution."""
+    if not distribution or not distribution["count"]:
+        return None
+    base_width = ROLLUP_BASE_WIDTHS[field]
+    factor = width // base_width
+    merged = {}
+    for index, count in distribution["buckets"]:
+        merged[index // factor] = merged.get(index // factor, 0) + count
+    if len(merged) > ROLLUP_MAX_BUCKETS:
+        raise PriceDistributionError(f"{field}_width {width} gives more than {ROLLUP_MAX_BUCKETS} buckets, "
+                                     f"pass a larger {field}_width")
+    return {
+        "count": distribution["count"],
+        "min": distribution["min"],
+        "max": distribution["max"],
+        "percentiles": {f"p{p}": _percentile(distribution, base_width, p) for p in ROLLUP_PERCENTILES},
+        "histogram": [{"from": index * width, "to": (index + 1) * width, "count": count}
+                      for index, count in sorted(merged.items())],
+    }
+
+
+def price_distribution(args):
+    """
+    The response of GET /listings/stats/price_distribution. Raises
+    PriceDistributionError for invalid arguments.
+    """
+    dimension = args.get("by", "car_type")
+    if dimension not in ROLLUP_DIMENSIONS:
+        raise PriceDistributionError(f"Invalid by, expected one of: {', '.join(ROLLUP_DIMENSIONS)}")
+    widths = {field: parse_width(args, field) for field in ROLLUP_BASE_WIDTHS}
+    value = args.get("value")
+
+    groups = []
+    for doc in get_rollups(dimension):
+        if value is not None and doc["value"] != value:
+            continue
+        group = {"value": doc["value"]}
+        for field, width in widths.items():
+            group[field] = describe(doc.get(field), field, width)
+        groups.append(group)
+    groups.sort(key=lambda group: (-((group["price"] or {}).get("count", 0)), group["value"]))
+    return {"by": dimension, **{f"{field}_width": width for field, width in widths.items()}, "groups": groups}
@@ -0,0 +1,198 @@
+# Description: Admission control. Each request takes tokens from a token bucket
+# for its client IP and, when it carries a valid JWT, one for its user; routes
+# that cause more work (login, stats, search) cost more tokens. A request over
+# its rate gets 429, and one arriving while RATELIMIT_MAX_CONCURRENT requests are
+# already in flight in this process gets 503. Both carry Retry-After instead of
+# queuing. Bucket state lives in a pluggable backend: MemoryBackend keeps it in
+# this process, so each worker limits on its own.
+import math
+import threading
+import time
+from collections import OrderedDict
+import jwt
+from flask import g, jsonify, make_response, request
+from pymongo.errors import PyMongoError
+import metrics
+from config import Config
+from decorators import decode_token
+
+RATELIMIT_SETTINGS = ["RATELIMIT_ENABLED", "RATELIMIT_IP_RATE", "RATELIMIT_IP_BURST", "RATELIMIT_USER_RATE",
+                      "RATELIMIT_USER_BURST", "RATELIMIT_MAX_CONCURRENT", "RATELIMIT_BACKEND"]
+
+# Tokens a request to each endpoint costs. Unlisted endpoints cost DEFAULT_COST;
+# a cost of 0 is never rate limited (but still counts towards concurrency).
+ROUTE_COSTS = {
+    "auth_bp.login": 10,
+    "auth_bp.register": 10,
+    "listings.create_listings_bulk": 10,
+    "admin_bp.export_listings": 20,
+    "admin_bp.export_users": 20,
+    "listings.average_price_by_type": 5,
+    "listings.listings_summary": 5,
+    "listings.price_distribution": 5,
+    "listings.search_listings": 3,
+    "listings.get_listings": 2,
+    "listings.similar_listings": 2,
+    "metrics_bp.get_metrics": 0,
+    "static": 0,
+}
+DEFAULT_COST = 1
+
+# Buckets of clients that have been idle the longest are dropped beyond this many
+MEMORY_BACKEND_MAX_KEYS = 100000
+
+
+class MemoryBackend:
+    """
+    Token buckets in this process's memory, least recently used dropped
+    first. Any object with the same acquire() method can replace it, e.g.
+    one keeping the buckets in a store shared by every worker.
+    """
+
+    def __init__(self, max_keys=MEMORY_BACKEND_MAX_KEYS):
+        self.max_keys = max_keys
+        # key -> [tokens, monotonic time of the last refill]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, charges, now=None):
+        """
+        Take tokens from several buckets at once. charges is a list of
+        (key, cost, rate, burst): a bucket holds at most burst tokens and
+        refills at rate tokens per second. Every bucket is charged or none
+        is. Returns None when admitted, else (key, seconds until it would be).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = []
+            for key, cost, rate, burst in charges:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = [burst, now]
+                else:
+                    bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                    bucket[1] = now
+                    self._buckets.move_to_end(key)
+                # A route costing more than the burst would never be admitted
+                cost = min(cost, burst)
+                if bucket[0] < cost:
+                    return key, (cost - bucket[0]) / rate
+                buckets.append((bucket, cost))
+            for bucket, cost in buckets:
+                bucket[0] -= cost
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return None
+
+
+class Rejected(Exception):
+    """A request turned away: 429 when over its rate, 503 when the process is at capacity."""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.error = "Too many requests, please retry later" if status == 429 else "Server busy, please retry"
+
+
+class Limiter:
+    def __init__(self, settings=None):
+        self.backend = None
+        self.configure(settings or {name: getattr(Config, name) for name in RATELIMIT_SETTINGS})
+
+    def configure(self, settings):
+        """Apply the RATELIMIT_* settings from a mapping (e.g. app.config)."""
+        self.enabled = bool(settings.get("RATELIMIT_ENABLED", getattr(self, "enabled", True)))
+        for name in ("ip_rate", "ip_burst", "user_rate", "user_burst"):
+            value = float(settings.get(f"RATELIMIT_{name.upper()}", getattr(self, name, 1)))
+            if value <= 0:
+                raise ValueError(f"RATELIMIT_{name.upper()} must be positive, got {value}")
+            setattr(self, name, value)
+        self.max_concurrent = int(settings.get("RATELIMIT_MAX_CONCURRENT", getattr(self, "max_concurrent", 0)))
+        self._slots = threading.BoundedSemaphore(self.max_concurrent) if self.max_concurrent > 0 else None
+        # A new backend starts with full buckets; keep the current one unless another is given
+        if settings.get("RATELIMIT_BACKEND") is not None:
+            self.backend = settings["RATELIMIT_BACKEND"]
+        elif self.backend is None:
+            self.backend = MemoryBackend()
+
+    def check_rate(self, endpoint, ip, user=None):
+        """Charge the request's buckets; raises Rejected when one is empty."""
+        cost = ROUTE_COSTS.get(endpoint, DEFAULT_COST)
+        if not self.enabled or cost <= 0:
+            return
+        charges = [(f"ip:{ip}", cost, self.ip_rate, self.ip_burst)]
+        if user is not None:
+            charges.append((f"user:{user}", cost, self.user_rate, self.user_burst))
+        limited = self.backend.acquire(charges)
+        if limited is not None:
+            key, retry_after = limited
+            raise Rejected(429, "rate_user" if key.startswith("user:") else "rate_ip", retry_after)
+
+    def enter(self):
+        """
+        Take a concurrency slot without waiting; raises Rejected when none
+        is free. Returns the slot to pass to leave(), or None when unlimited.
+        """
+        slots = self._slots
+        if not self.enabled or slots is None:
+            return None
+        if not slots.acquire(blocking=False):
+            raise Rejected(503, "concurrency", 1)
+        return slots
+
+    @staticmethod
+    def leave(slot):
+        if slot is not None:
+            slot.release()
+
+
+limiter = Limiter()
+
+
+def token_user(token):
+    """
+    The user a valid JWT belongs to, else None (the endpoint itself rejects bad
+    tokens). Checking revocation may query MongoDB; if that fails the request is
+    limited by its IP only, so endpoints that need no database keep working.
+    """
+    if not token:
+        return None
+    try:
+        return decode_token(token).get("user")
+    except (jwt.InvalidTokenError, PyMongoError):
+        return None
+
+
+def rejected_response(rejected):
+    response = make_response(jsonify({"error": rejected.error}), rejected.status)
+    response.headers["Retry-After"] = str(rejected.retry_after)
+    return response
+
+
+# ---- Flask integration ----
+
+def _before_request():
+    endpoint = request.endpoint or metrics.UNMATCHED_ENDPOINT
+    try:
+        g.ratelimit_slot = limiter.enter()
+        limiter.check_rate(endpoint, request.remote_addr, token_user(request.headers.get("x-access-token")))
+    except Rejected as e:
+        metrics.rejected_requests.inc((endpoint, e.reason))
+        return rejected_response(e)
+
+
+def _teardown_request(exc):
+    limiter.leave(g.pop("ratelimit_slot", None))
+
+
+def init_app(app):
+    """
+    Configure the limiter and check every request before it is dispatched.
+    Behind a reverse proxy, wrap the app in werkzeug's ProxyFix so that
+    request.remote_addr is the client's address.
+    """
+    limiter.configure(app.config)
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
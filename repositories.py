@@ -0,0 +1,306 @@
+# Description: Data access for listings and reviews. Write methods put the
+# ownership or status check in the write's own filter, so a mutation is a single
+# round trip with no window between check and write; only when nothing matched
+# is a second query made to tell "not found" from "forbidden".
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+import autocomplete
+import globals
+import view_counter
+import price_rollups
+import similar
+import stats
+import versions
+from listing_cache import listing_cache, project
+from listing_query import LISTING_PROJECTION
+from utils import rating_summary_update
+from view_counter import read_and_count, record_view, count_view
+
+# The fields the stats counters, autocomplete terms, price rollups and similar listings index need from a
+# listing's previous state
+PREVIOUS_STATE_PROJECTION = {"status": 1, "car_type": 1, "price": 1, "mileage": 1, "vehicle_model": 1, "location": 1,
+                             "listing_age": 1}
+
+# Statuses an admin may delete
+INACTIVE_STATUSES = ["reported", "sold"]
+
+# Statuses counted per seller by seller_summary, and the orders it can return sellers in
+SELLER_SUMMARY_STATUSES = ["active", "sold", "reported"]
+SELLER_SUMMARY_SORTS = SELLER_SUMMARY_STATUSES + ["total"]
+
+
+# Each error carries the HTTP status the blueprints answer with
+class RepositoryError(Exception):
+    status = 400
+
+
+class NotFound(RepositoryError):
+    status = 404
+
+
+class Forbidden(RepositoryError):
+    status = 403
+
+
+class NotModified(RepositoryError):
+    status = 400
+
+
+def cached_listing(listings, listing_id):
+    """A whole listing from the listing cache, read from listings on a miss."""
+    return listing_cache.get(listing_id, lambda: listings.find_one({"_id": listing_id}, LISTING_PROJECTION))
+
+
+class ListingRepository:
+    def __init__(self, collection, reviews_collection):
+        self.collection = collection
+        self.reviews = reviews_collection
+
+    def _missing_or_forbidden(self, listing_id):
+        # Failure path only: the filtered write matched nothing
+        if self.collection.find_one({"_id": listing_id}, {"_id": 1}) is None:
+            return NotFound("Listing not found")
+        return Forbidden("Unauthorized")
+
+    # ---- reads ----
+
+    def find_page(self, page):
+        cursor = self.collection.find(page.filter, page.projection)
+        if page.sort:
+            cursor = cursor.sort(page.sort)
+        return list(cursor.skip(page.skip).limit(page.limit))
+
+    def count(self, page):
+        if page.use_estimated_count:
+            return self.collection.estimated_document_count()
+        return self.collection.count_documents(page.query.filters)
+
+    def get_for_view(self, listing_id, projection=LISTING_PROJECTION):
+        """Fetch a listing for display, counting the view."""
+        # Exact view counts increment in the same query, so they can't come from the cache
+        if view_counter.view_counter.exact or not listing_cache.enabled:
+            return read_and_count({"_id": ObjectId(listing_id)}, projection)
+        return count_view(project(cached_listing(self.collection, ObjectId(listing_id)), projection))
+
+    def get_version(self, listing_id):
+        """The listing's version, or None if it doesn't exist."""
+        if listing_cache.enabled:
+            listing = cached_listing(self.collection, ObjectId(listing_id))
+        else:
+            # Fetches nothing else
+            listing = self.collection.find_one({"_id": ObjectId(listing_id)}, {"version": 1})
+        return None if listing is None else listing.get("version", 0)
+
+    def count_view(self, listing_id):
+        record_view(ObjectId(listing_id))
+
+    def find(self, query, projection=None):
+        return self.collection.find(query, projection)
+
+    def find_newest(self, query, projection, limit):
+        """Listings matching query, newest first."""
+        return list(self.collection.find(query, projection).sort([("_id", -1)]).limit(limit))
+
+    def seller_summary(self, sort="reported", limit=100):
+        """
+        Per seller counts of active, sold and reported listings, the sellers
+        with the most of sort first, with their usernames. One aggregation,
+        read with MONGO_STATS_READ_PREFERENCE.
+        """
+        counts = {status: {"$sum": {"$cond": [{"$eq": ["$status", status]}, 1, 0]}}
+                  for status in SELLER_SUMMARY_STATUSES}
+        pipeline = [
+            # Walking user_id_status_id in order lets the scan read only the index
+            {"$sort": {"user_id": 1}},
+            {"$group": {"_id": "$user_id", **counts, "total": {"$sum": 1}}},
+            {"$sort": {sort: -1, "_id": 1}},
+            {"$limit": limit},
+            # Usernames only for the sellers returned. user_id holds the user's _id as a
+            # string; converted back, the lookup is an _id index match
+            {"$set": {"user_oid": {"$convert": {"input": "$_id", "to": "objectId", "onError": None, "onNull": None}}}},
+            {"$lookup": {"from": "users", "localField": "user_oid", "foreignField": "_id", "as": "user"}},
+            {"$project": {"_id": 0, "seller_id": "$_id", "username": {"$arrayElemAt": ["$user.username", 0]},
+                          **{field: 1 for field in SELLER_SUMMARY_SORTS}}},
+        ]
+        return list(globals.stats_db.listings.aggregate(pipeline))
+
+    # ---- writes ----
+
+    def insert(self, listing):
+        listing_id = self.collection.insert_one(listing).inserted_id
+        stats.record_added(listing)
+        autocomplete.record_added(listing)
+        price_rollups.record_added(listing)
+        similar.record_added(listing)
+        versions.bump(versions.LISTINGS)
+        return listing_id
+
+    def insert_many(self, listings):
+        """
+        Insert unordered. Returns {position: write error} for the documents
+        that failed; every other document was inserted and has its _id set.
+        """
+        failed = {}
+        try:
+            self.collection.insert_many(listings, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get("writeErrors", []):
+                failed[error["index"]] = error
+        inserted = [doc for position, doc in enumerate(listings) if position not in failed]
+        stats.record_added_many(inserted)
+        autocomplete.record_added_many(inserted)
+        price_rollups.record_added_many(inserted)
+        similar.record_added_many(inserted)
+        if inserted:
+            versions.bump(versions.LISTINGS)
+        return failed
+
+    def update_owned(self, listing_id, user_id, changes):
+        """Set client-editable fields (the caller filters them); raises NotModified if none would change."""
+        listing_id = ObjectId(listing_id)
+        projection = {**PREVIOUS_STATE_PROJECTION, **{field: 1 for field in changes}}
+        # Only matches when some field differs, so a no-op writes nothing and keeps the version
+        before = self.collection.find_one_and_update(
+            {"_id": listing_id, "user_id": user_id,
+             "$or": [{field: {"$ne": value}} for field, value in changes.items()]},
+            {"$set": changes, "$inc": {"version": 1}},
+            projection, return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            listing = self.collection.find_one({"_id": listing_id}, {"user_id": 1})
+            if listing is None:
+                raise NotFound("Listing not found")
+            if listing.get("user_id") != user_id:
+                raise Forbidden("Unauthorized")
+            raise NotModified("No updates made")
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+        stats.record_changed(before, {**before, **changes})
+        autocomplete.record_changed(before, {**before, **changes})
+        price_rollups.record_changed(before, {**before, **changes})
+        similar.record_changed(before, {**before, **changes})
+
+    def mark_sold(self, listing_id, user_id):
+        listing_id = ObjectId(listing_id)
+        before = self.collection.find_one_and_update(
+            {"_id": listing_id, "user_id": user_id, "status": {"$ne": "sold"}},
+            {"$set": {"status": "sold"}, "$inc": {"version": 1}},
+            PREVIOUS_STATE_PROJECTION, return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            listing = self.collection.find_one({"_id": listing_id}, {"user_id": 1})
+            if listing is None:
+                raise NotFound("Listing not found")
+            if listing.get("user_id") != user_id:
+                raise Forbidden("Unauthorized")
+            raise NotModified("No changes made")
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+        stats.record_removed(before)
+        autocomplete.record_removed(before)
+        price_rollups.record_removed(before)
+        similar.record_removed(before)
+
+    def delete_owned(self, listing_id, user_id):
+        listing_id = ObjectId(listing_id)
+        deleted = self.collection.find_one_and_delete({"_id": listing_id, "user_id": user_id},
+                                                      PREVIOUS_STATE_PROJECTION)
+        if deleted is None:
+            raise self._missing_or_forbidden(listing_id)
+        self.reviews.delete_many({"listing_id": listing_id})
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+        stats.record_removed(deleted)
+        autocomplete.record_removed(deleted)
+        price_rollups.record_removed(deleted)
+        similar.record_removed(deleted)
+
+    def delete_inactive(self, listing_id):
+        """Delete a reported or sold listing and its reviews (admin)."""
+        listing_id = ObjectId(listing_id)
+        deleted = self.collection.find_one_and_delete({"_id": listing_id, "status": {"$in": INACTIVE_STATUSES}},
+                                                      {"_id": 1})
+        if deleted is None:
+            if self.collection.find_one({"_id": listing_id}, {"_id": 1}) is None:
+                raise NotFound("Listing not found")
+            raise Forbidden("Only reported or inactive listings can be deleted")
+        self.reviews.delete_many({"listing_id": listing_id})
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+
+    def report(self, listing_id, reported_by):
+        listing_id = ObjectId(listing_id)
+        before = self.collection.find_one_and_update(
+            {"_id": listing_id},
+            {"$set": {"status": "reported", "reported_by": reported_by}, "$inc": {"version": 1}},
+            PREVIOUS_STATE_PROJECTION, return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            raise NotFound("Listing not found")
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+        # A no-op for listings that were not active
+        stats.record_removed(before)
+        autocomplete.record_removed(before)
+        price_rollups.record_removed(before)
+        similar.record_removed(before)
+
+
+class ReviewRepository:
+    def __init__(self, collection, listings_collection):
+        self.collection = collection
+        self.listings = listings_collection
+
+    def listing_summary(self, listing_id, projection):
+        if listing_cache.enabled:
+            return project(cached_listing(self.listings, listing_id), projection)
+        return self.listings.find_one({"_id": listing_id}, projection)
+
+    def find_page(self, listing_id, seek, limit, projection, sort):
+        query = {"listing_id": listing_id}
+        if seek:
+            query["_id"] = seek
+        return list(self.collection.find(query, projection).sort(sort).limit(limit))
+
+    # Every review write updates the listing's summary, which also bumps its
+    # version; the listings collection version is bumped after both writes.
+    # The review is written first, so a failed review write leaves the summary as it was.
+
+    def add(self, review):
+        if self.listings.find_one({"_id": review["listing_id"]}, {"_id": 1}) is None:
+            raise NotFound("Listing not found")
+        self.collection.insert_one(review)
+        self.listings.update_one({"_id": review["listing_id"]}, rating_summary_update(1, review["rating"]))
+        listing_cache.invalidate(review["listing_id"])
+        versions.bump(versions.LISTINGS)
+
+    def update_owned(self, listing_id, review_id, username, changes):
+        before = self.collection.find_one_and_update(
+            {"_id": review_id, "listing_id": listing_id, "user": username},
+            {"$set": changes},
+            {"rating": 1}, return_document=ReturnDocument.BEFORE
+        )
+        if before is None:
+            if self.collection.find_one({"_id": review_id, "listing_id": listing_id}, {"_id": 1}) is None:
+                raise NotFound("Listing or review not found")
+            raise Forbidden("Unauthorized to update this review")
+        # Also needed when the rating is unchanged: the listing's reviews changed
+        rating_delta = changes.get("rating", before["rating"]) - before["rating"]
+        self.listings.update_one({"_id": listing_id}, rating_summary_update(0, rating_delta))
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+
+    def delete(self, listing_id, review_id):
+        review = self.collection.find_one_and_delete({"_id": review_id, "listing_id": listing_id}, {"rating": 1})
+        if review is None:
+            if self.listings.find_one({"_id": listing_id}, {"_id": 1}) is None:
+                raise NotFound("Listing not found")
+            raise NotFound("Review not found")
+        self.listings.update_one({"_id": listing_id}, rating_summary_update(-1, -review["rating"]))
+        listing_cache.invalidate(listing_id)
+        versions.bump(versions.LISTINGS)
+
+
+listing_repository = ListingRepository(globals.db.listings, globals.db.reviews)
+review_repository = ReviewRepository(globals.db.reviews, globals.db.listings)
@@ -0,0 +1,109 @@
+# Description: Token revocation store. A revoked token is recorded by its jti
+# (or a hash of the token) together with its expiry, and a TTL index removes
+# the record once the token would have expired anyway. An in-process Bloom
+# filter, rebuilt from the store periodically, answers the common "not revoked"
+# case without a database query.
+import datetime
+import hashlib
+import math
+import threading
+import time
+import jwt
+import globals
+from cache import SingleFlight
+
+blacklist = globals.db.blacklist
+
+# How often the Bloom filter is rebuilt from the store. Tokens revoked by other
+# worker processes are only detected once this process has refreshed.
+REVOCATION_REFRESH_INTERVAL = 30
+# Target false positive rate; a false positive only costs one lookup
+REVOCATION_FALSE_POSITIVE_RATE = 0.01
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=REVOCATION_FALSE_POSITIVE_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing: derive every probe position from two 64-bit halves
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+def revocation_key(token, payload=None):
+    """The jti claim if the token has one, otherwise a SHA-256 of the token."""
+    if payload and payload.get("jti"):
+        return payload["jti"]
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def revocation_expiry(payload):
+    """When the revocation record may be dropped: the token's own expiry."""
+    if "exp" in payload:
+        return datetime.datetime.fromtimestamp(payload["exp"], datetime.timezone.utc).replace(tzinfo=None)
+    return datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+
+class RevocationStore:
+    def __init__(self, collection):
+        self.collection = collection
+        self._filter = None
+        self._refreshed_at = 0
+        self._recent = set()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+
+    def refresh(self):
+        """Rebuild the Bloom filter from every unexpired revocation."""
+        with self._lock:
+            # Keys revoked locally while the rebuild runs are carried over
+            self._recent = set()
+        now = datetime.datetime.utcnow()
+        keys = [doc["_id"] for doc in self.collection.find({"exp": {"$gt": now}}, {"_id": 1})]
+        bloom = BloomFilter(capacity=max(2 * len(keys), 1024))
+        for key in keys:
+            bloom.add(key)
+        with self._lock:
+            for key in self._recent:
+                bloom.add(key)
+            self._filter = bloom
+            self._refreshed_at = time.monotonic()
+
+    def _current_filter(self):
+        if self._filter is None or time.monotonic() - self._refreshed_at > REVOCATION_REFRESH_INTERVAL:
+            self._flight.do("refresh", self.refresh)
+        return self._filter
+
+    def revoke(self, token, payload=None):
+        if payload is None:
+            # The token has already been verified by jwt_required
+            payload = jwt.decode(token, options={"verify_signature": False})
+        key = revocation_key(token, payload)
+        self.collection.update_one({"_id": key}, {"$set": {"exp": revocation_expiry(payload)}}, upsert=True)
+        with self._lock:
+            self._recent.add(key)
+            if self._filter is not None:
+                self._filter.add(key)
+
+    def is_revoked(self, token, payload=None):
+        key = revocation_key(token, payload)
+        if key not in self._current_filter():
+            return False
+        # Possibly revoked: confirm against the store
+        return self.collection.find_one({"_id": key}, {"_id": 1}) is not None
+
+
+revocations = RevocationStore(blacklist)
@@ -0,0 +1,321 @@
+# Description: Similar listings for GET /listings/<id>/similar. Each process
+# holds the active listings' price, mileage, listing_age, car_type and
+# vehicle_model in NumPy arrays and scores every one of them against the
+# requested listing in a single vectorized pass, so a query never touches
+# MongoDB once the index is loaded. This process's listing writes update the
+# index in place; writes made by other processes are picked up by a background
+# reload once the listings version has moved and the index is
+# SIMILAR_RELOAD_INTERVAL old.
+import math
+import threading
+import time
+from bson.objectid import ObjectId
+import numpy as np
+import globals
+import versions
+from cache import SingleFlight
+
+# Loading reads every active listing, so it tolerates replication lag like the stats aggregations
+listings_reads = globals.stats_db.listings
+listings_collection = globals.db.listings
+
+SIMILAR_FEATURES = ["price", "mileage", "listing_age"]
+# Price and mileage are compared on a log scale: £5,000 is as far from £6,000 as
+# £50,000 is from £60,000. Each feature is divided by its standard deviation
+# over the loaded listings and then weighted.
+SIMILAR_LOG_FEATURES = {"price", "mileage"}
+SIMILAR_WEIGHTS = {"price": 1.0, "mileage": 1.0, "listing_age": 0.5}
+# Added to the distance of a listing of another car_type or vehicle_model
+SIMILAR_CAR_TYPE_PENALTY = 1.0
+SIMILAR_MODEL_PENALTY = 0.5
+SIMILAR_DEFAULT_LIMIT = 10
+SIMILAR_MAX_LIMIT = 50
+SIMILAR_RELOAD_INTERVAL = 300
+
+SIMILAR_PROJECTION = {"status": 1, "car_type": 1, "vehicle_model": 1, **{field: 1 for field in SIMILAR_FEATURES}}
+
+_flight = SingleFlight()
+_lock = threading.Lock()
+# replay holds the writes made while a reload is reading the listings, applied to the new index before it is used
+_loaded = {"index": None, "at": 0, "version": None, "reloading": False, "replay": None}
+
+
+class ListingNotFound(LookupError):
+    pass
+
+
+def _indexable(listing):
+    return all(isinstance(listing.get(field), (int, float)) and not isinstance(listing.get(field), bool)
+               and math.isfinite(listing[field]) for field in SIMILAR_FEATURES)
+
+
+def _transform(raw):
+    """Features as compared, before scaling: log1p for the SIMILAR_LOG_FEATURES."""
+    values = np.array(raw, dtype=np.float64).reshape(-1, len(SIMILAR_FEATURES))
+    for column, field in enumerate(SIMILAR_FEATURES):
+        if field in SIMILAR_LOG_FEATURES:
+            values[:, column] = np.log1p(np.maximum(values[:, column], 0))
+    return values
+
+
+def _number(value):
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+
+class SimilarIndex:
+    """
+    Row-per-listing arrays with spare capacity for listings added later.
+    Rows are never removed: a listing that is sold, reported or deleted
+    is only marked inactive until the next reload drops it.
+    """
+
+    def __init__(self, listings):
+        listings = [listing for listing in listings if _indexable(listing)]
+        size = len(listings)
+        raw = _transform([[listing[field] for field in SIMILAR_FEATURES] for listing in listings])
+        scale = raw.std(axis=0) if size else np.ones(len(SIMILAR_FEATURES))
+        scale[~(scale > 0)] = 1
+        # Scaling and weighting folded into one factor per feature, so a distance is a plain squared sum
+        self.factors = np.array([math.sqrt(SIMILAR_WEIGHTS[field]) for field in SIMILAR_FEATURES]) / scale
+
+        capacity = size + max(1024, size // 4)
+        # One contiguous row per feature: a query then streams through each column once
+        self.features = np.zeros((len(SIMILAR_FEATURES), capacity), dtype=np.float32)
+        self.raw = np.zeros((capacity, len(SIMILAR_FEATURES)), dtype=np.float64)
+        self.car_types = np.zeros(capacity, dtype=np.int32)
+        self.models = np.zeros(capacity, dtype=np.int32)
+        self.active = np.zeros(capacity, dtype=bool)
+        self.ids = []
+        self.rows = {}
+        self.size = 0
+        # value -> code, and code -> value, per categorical field
+        self.codes = {"car_type": {}, "vehicle_model": {}}
+        self.values = {"car_type": [], "vehicle_model": []}
+        self._lock = threading.Lock()
+
+        if size:
+            self.features[:, :size] = (raw * self.factors).T
+            self.raw[:size] = [[listing[field] for field in SIMILAR_FEATURES] for listing in listings]
+            self.car_types[:size] = [self._code("car_type", listing.get("car_type")) for listing in listings]
+            self.models[:size] = [self._code("vehicle_model", listing.get("vehicle_model")) for listing in listings]
+            self.active[:size] = [listing.get("status") == "active" for listing in listings]
+            self.ids = [str(listing["_id"]) for listing in listings]
+            self.rows = {listing_id: row for row, listing_id in enumerate(self.ids)}
+            self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def _code(self, field, value):
+        codes = self.codes[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(self.values[field])
+            self.values[field].append(value)
+        return code
+
+    def _grow(self):
+        capacity = 2 * len(self.active)
+        features = np.zeros((len(SIMILAR_FEATURES), capacity), dtype=np.float32)
+        features[:, :self.size] = self.features[:, :self.size]
+        self.features = features
+        for name in ("raw", "car_types", "models", "active"):
+            old = getattr(self, name)
+            new = np.zeros((capacity, *old.shape[1:]), dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def upsert(self, listing):
+        """Add or overwrite a listing's row; it needs every SIMILAR_PROJECTION field."""
+        listing_id = str(listing["_id"])
+        with self._lock:
+            row = self.rows.get(listing_id)
+            if not _indexable(listing):
+                if row is not None:
+                    self.active[row] = False
+                return
+            if row is None:
+                if listing.get("status") != "active":
+                    return
+                if self.size == len(self.active):
+                    self._grow()
+                row = self.size
+                self.size += 1
+                self.ids.append(listing_id)
+                self.rows[listing_id] = row
+            values = [listing[field] for field in SIMILAR_FEATURES]
+            self.features[:, row] = _transform(values)[0] * self.factors
+            self.raw[row] = values
+            self.car_types[row] = self._code("car_type", listing.get("car_type"))
+            self.models[row] = self._code("vehicle_model", listing.get("vehicle_model"))
+            self.active[row] = listing.get("status") == "active"
+
+    def deactivate(self, listing_id):
+        with self._lock:
+            row = self.rows.get(str(listing_id))
+            if row is not None:
+                self.active[row] = False
+
+    def source(self, listing_id):
+        """The indexed fields of a listing as a dict, or None if it has no row."""
+        with self._lock:
+            row = self.rows.get(str(listing_id))
+            if row is None:
+                return None
+            return self._describe(row)
+
+    def _describe(self, row):
+        return {
+            "_id": self.ids[row],
+            **{field: _number(value) for field, value in zip(SIMILAR_FEATURES, self.raw[row])},
+            "car_type": self.values["car_type"][self.car_types[row]],
+            "vehicle_model": self.values["vehicle_model"][self.models[row]],
+        }
+
+    def nearest(self, listing, limit):
+        """The limit active listings closest to listing (itself excluded), closest first."""
+        if not _indexable(listing):
+            return []
+        with self._lock:
+            size = self.size
+            features, car_types, models, active = (self.features[:, :size], self.car_types[:size],
+                                                   self.models[:size], self.active[:size])
+            exclude = self.rows.get(str(listing["_id"]))
+            car_type = self.codes["car_type"].get(listing.get("car_type"), -1)
+            model = self.codes["vehicle_model"].get(listing.get("vehicle_model"), -1)
+        if not size:
+            return []
+
+        query = (_transform([listing[field] for field in SIMILAR_FEATURES])[0] * self.factors).astype(np.float32)
+        # Squared distance summed column by column, in place, in float32
+        distances = np.empty(size, dtype=np.float32)
+        scratch = np.empty(size, dtype=np.float32)
+        for column, value in enumerate(query):
+            target = distances if column == 0 else scratch
+            np.subtract(features[column], value, out=target)
+            np.square(target, out=target)
+            if column:
+                distances += scratch
+        distances += np.multiply(car_types != car_type, np.float32(SIMILAR_CAR_TYPE_PENALTY), dtype=np.float32)
+        distances += np.multiply(models != model, np.float32(SIMILAR_MODEL_PENALTY), dtype=np.float32)
+        distances[~active] = np.inf
+        if exclude is not None:
+            distances[exclude] = np.inf
+
+        # Only the limit best are sorted
+        if limit < size:
+            candidates = np.argpartition(distances, limit)[:limit]
+        else:
+            candidates = np.arange(size)
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")]
+        with self._lock:
+            return [{**self._describe(row), "distance": round(float(math.sqrt(distances[row])), 4)}
+                    for row in candidates if np.isfinite(distances[row])]
+
+
+# ---- loading ----
+
+def _read_index():
+    return SimilarIndex(listings_reads.find({"status": "active"}, SIMILAR_PROJECTION).batch_size(10000))
+
+
+def load_index():
+    """Build the index from the listings and make it this process's index."""
+    with _lock:
+        _loaded["replay"] = []
+    version = versions.current(versions.LISTINGS)
+    index = _read_index()
+    with _lock:
+        for operation, argument in _loaded["replay"]:
+            getattr(index, operation)(argument)
+        _loaded.update(index=index, at=time.monotonic(), version=version, replay=None)
+    return index
+
+
+def _reload():
+    try:
+        version = versions.current(versions.LISTINGS)
+        with _lock:
+            unchanged = _loaded["version"] == version
+            if unchanged:
+                _loaded["at"] = time.monotonic()
+        if not unchanged:
+            load_index()
+    finally:
+        with _lock:
+            _loaded["reloading"] = False
+
+
+def get_index():
+    """This process's index, loading it on first use and reloading it in the background when stale."""
+    with _lock:
+        index = _loaded["index"]
+        stale = index is not None and time.monotonic() - _loaded["at"] >= SIMILAR_RELOAD_INTERVAL
+        start_reload = stale and not _loaded["reloading"]
+        if start_reload:
+            _loaded["reloading"] = True
+    if index is None:
+        # Concurrent requests share the first load
+        return _flight.do("load", load_index)
+    if start_reload:
+        # Requests keep using the current index meanwhile
+        threading.Thread(target=_reload, name="similar-reload", daemon=True).start()
+    return index
+
+
+def index_size():
+    """Rows in this process's loaded index, 0 before the first lookup."""
+    with _lock:
+        index = _loaded["index"]
+    return 0 if index is None else len(index)
+
+
+# ---- write path hooks: they only touch an index this process has loaded ----
+
+def _apply(operation, argument):
+    with _lock:
+        index = _loaded["index"]
+        if _loaded["replay"] is not None:
+            _loaded["replay"].append((operation, argument))
+    if index is not None:
+        getattr(index, operation)(argument)
+
+
+def record_added_many(listings):
+    for listing in listings:
+        _apply("upsert", listing)
+
+
+def record_added(listing):
+    _apply("upsert", listing)
+
+
+def record_removed(listing):
+    _apply("deactivate", listing["_id"])
+
+
+def record_changed(before, after):
+    # after merges the update into the PREVIOUS_STATE_PROJECTION fields, which
+    # include every SIMILAR_PROJECTION field
+    _apply("upsert", after)
+
+
+# ---- queries ----
+
+def similar_to(listing_id, limit=SIMILAR_DEFAULT_LIMIT):
+    """
+    The listing's indexed fields and the active listings most like it.
+    Raises ListingNotFound; bson's InvalidId for a malformed listing_id.
+    """
+    index = get_index()
+    listing = index.source(listing_id)
+    if listing is None:
+        # Sold, reported or not indexable listings have no row, but still have similar listings
+        listing = listings_collection.find_one({"_id": ObjectId(listing_id)}, SIMILAR_PROJECTION)
+        if listing is None:
+            raise ListingNotFound("Listing not found")
+        # Same fields as an indexed listing's source()
+        listing.pop("status", None)
+        listing["_id"] = str(listing["_id"])
+    return {"listing": listing, "similar": index.nearest(listing, limit)}
@@ -0,0 +1,362 @@
+# Description: Incrementally maintained statistics for active listings.
+# Per car_type counters live in the listing_stats collection and are updated by
+# every write path; the /listings/stats endpoints read them instead of
+# aggregating over all active listings, and a periodic full recompute repairs drift.
+import datetime
+import logging
+import threading
+import time
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+import globals
+import versions
+from cache import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+listings_collection = globals.db.listings
+# One document per car_type: {_id, count, priced_count, price_sum, min_price, max_price,
+# writes[, dirty]}. writes counts the updates made by the write paths, so a
+# recompute can tell whether a counter changed while it was aggregating. dirty
+# marks a min_price or max_price that may belong to a listing no longer counted.
+stats_collection = globals.db.listing_stats
+stats_state = globals.db.stats_state
+# Untagged aggregations tolerate replication lag, so they may be served by
+# secondaries (MONGO_STATS_READ_PREFERENCE). Counters behind a versioned response
+# and repairs, which overwrite the counters, read from the primary.
+stats_listings_reads = globals.stats_db.listings
+
+# Serve from the maintained counters; when False every cache miss aggregates
+STATS_USE_COUNTERS = True
+# How long computed stats are served from memory before re-reading the counters
+STATS_CACHE_TTL = 5
+# How often the counters are rebuilt from the listings collection
+STATS_RECOMPUTE_INTERVAL = 600
+
+_flight = SingleFlight()
+_cache_lock = threading.Lock()
+_cached = {"docs": None, "version": None, "expires": 0, "hits": 0, "misses": 0}
+_background = {"running": False, "repairing": False, "repair_requested": False}
+
+
+def _is_price(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _counts_toward_stats(listing):
+    return listing is not None and listing.get("status") == "active"
+
+
+def invalidate():
+    with _cache_lock:
+        _cached["expires"] = 0
+
+
+# ---- write path hooks ----
+
+def record_added(listing):
+    """Count a listing that has become (or was created) active."""
+    if not _counts_toward_stats(listing):
+        return
+    update = {"$inc": {"count": 1, "writes": 1}}
+    price = listing.get("price")
+    if _is_price(price):
+        update["$inc"].update({"priced_count": 1, "price_sum": price})
+        update["$min"] = {"min_price": price}
+        update["$max"] = {"max_price": price}
+    stats_collection.update_one({"_id": listing.get("car_type")}, update, upsert=True)
+    invalidate()
+
+
+def record_added_many(listings):
+    """Count a batch of new listings with one counter update per car_type."""
+    totals = {}
+    for listing in listings:
+        if not _counts_toward_stats(listing):
+            continue
+        update = totals.setdefault(listing.get("car_type"), {"$inc": {"count": 0, "writes": 1}})
+        update["$inc"]["count"] += 1
+        price = listing.get("price")
+        if _is_price(price):
+            update["$inc"]["priced_count"] = update["$inc"].get("priced_count", 0) + 1
+            update["$inc"]["price_sum"] = update["$inc"].get("price_sum", 0) + price
+            update["$min"] = {"min_price": min(price, update.get("$min", {}).get("min_price", price))}
+            update["$max"] = {"max_price": max(price, update.get("$max", {}).get("max_price", price))}
+    if not totals:
+        return
+    stats_collection.bulk_write([UpdateOne({"_id": car_type}, update, upsert=True)
+                                 for car_type, update in totals.items()], ordered=False)
+    invalidate()
+
+
+def record_removed(listing):
+    """
+    Uncount a listing that is no longer active. Sums and counts are simply
+    decremented; min/max cannot be, so if the removed price was an extreme
+    the counter is marked dirty and repaired in the background. Until then
+    its min/max may still include the removed price.
+    """
+    if not _counts_toward_stats(listing):
+        return
+    car_type = listing.get("car_type")
+    update = {"$inc": {"count": -1, "writes": 1}}
+    price = listing.get("price")
+    if _is_price(price):
+        update["$inc"].update({"priced_count": -1, "price_sum": -price})
+    counters = stats_collection.find_one_and_update({"_id": car_type}, update,
+                                                    return_document=ReturnDocument.AFTER)
+
+    if counters is None or counters.get("count", 0) <= 0:
+        stats_collection.delete_one({"_id": car_type, "count": {"$lte": 0}})
+    elif _is_price(price) and (price <= counters.get("min_price", price) or price >= counters.get("max_price", price)):
+        stats_collection.update_one({"_id": car_type}, {"$set": {"dirty": True}})
+        repair_in_background()
+    invalidate()
+
+
+def record_changed(before, after):
+    """Move a listing between counters after an update of status, car_type or price."""
+    fields = ("status", "car_type", "price")
+    if before is not None and after is not None and all(before.get(f) == after.get(f) for f in fields):
+        return
+    record_removed(before)
+    record_added(after)
+
+
+# ---- recomputation ----
+
+def _group_stage():
+    return {"$group": {
+        "_id": "$car_type",
+        "count": {"$sum": 1},
+        "priced_count": {"$sum": {"$cond": [{"$isNumber": "$price"}, 1, 0]}},
+        "price_sum": {"$sum": "$price"},
+        "min_price": {"$min": {"$cond": [{"$isNumber": "$price"}, "$price", None]}},
+        "max_price": {"$max": {"$cond": [{"$isNumber": "$price"}, "$price", None]}}
+    }}
+
+
+# Attempts per dirty counter before leaving it to the next repair or recompute
+STATS_REPAIR_ATTEMPTS = 3
+
+
+def repair_extremes(car_type, writes):
+    """
+    Recompute one car_type's min_price and max_price from the listings on the
+    primary and clear its dirty mark, unless the counter was written to since
+    writes was read. Counts and sums are exact and left alone. Returns whether
+    it was repaired.
+    """
+    pipeline = [{"$match": {"status": "active", "car_type": car_type}}, _group_stage()]
+    result = list(listings_collection.aggregate(pipeline))
+    extremes = {field: result[0][field] if result else None for field in ("min_price", "max_price")}
+    return stats_collection.update_one({"_id": car_type, "writes": writes},
+                                       {"$set": extremes, "$unset": {"dirty": ""}}).matched_count > 0
+
+
+def repair_dirty():
+    """Repair the min/max of every counter marked dirty; returns how many were repaired."""
+    repaired = 0
+    for doc in stats_collection.find({"dirty": True}, {"writes": 1}):
+        for _ in range(STATS_REPAIR_ATTEMPTS):
+            if repair_extremes(doc["_id"], doc.get("writes")):
+                repaired += 1
+                break
+            # Written to meanwhile: a $min/$max the aggregation missed would be overwritten
+            doc = stats_collection.find_one({"_id": doc["_id"], "dirty": True}, {"writes": 1})
+            if doc is None:
+                break
+    if repaired:
+        invalidate()
+    return repaired
+
+
+def active_stats_pipeline():
+    return [{"$match": {"status": "active"}}, _group_stage()]
+
+
+def aggregate_stats(listings=stats_listings_reads):
+    """
+    Compute the per car_type counters straight from the listings collection.
+    Both endpoints are derived from this one pipeline.
+    """
+    return list(listings.aggregate(active_stats_pipeline()))
+
+
+def recompute_all():
+    """
+    Rebuild every counter document from the listings on the primary. A
+    counter written to while the aggregation ran is left alone, since the
+    aggregation may predate that write; the next recompute repairs it.
+    """
+    writes = {doc["_id"]: doc.get("writes") for doc in stats_collection.find({}, {"writes": 1})}
+    by_type = list(listings_collection.aggregate(active_stats_pipeline()))
+    for counters in by_type:
+        car_type = counters["_id"]
+        try:
+            # Matches a missing writes field too, i.e. a car_type without counters
+            stats_collection.replace_one({"_id": car_type, "writes": writes.get(car_type)},
+                                         {**counters, "writes": writes.get(car_type) or 0}, upsert=True)
+        except DuplicateKeyError:
+            # Its counters were created since they were read
+            pass
+    seen = {counters["_id"] for counters in by_type}
+    for car_type, count in writes.items():
+        if car_type not in seen:
+            stats_collection.delete_one({"_id": car_type, "writes": count})
+    stats_state.update_one({"_id": "listing_stats"},
+                           {"$set": {"recomputed_at": datetime.datetime.utcnow()}}, upsert=True)
+    invalidate()
+    return by_type
+
+
+def _run_recompute():
+    try:
+        recompute_all()
+    except Exception:
+        logger.exception("Stats recompute failed")
+    finally:
+        with _cache_lock:
+            _background["running"] = False
+
+
+def recompute_in_background():
+    """Start recompute_all() on a thread unless one is already running in this process."""
+    with _cache_lock:
+        if _background["running"]:
+            return
+        _background["running"] = True
+    threading.Thread(target=_run_recompute, name="stats-recompute", daemon=True).start()
+
+
+def _run_repair():
+    # Runs until no repair was requested since the last pass began, so marks
+    # made during a pass are not missed
+    while True:
+        with _cache_lock:
+            if not _background["repair_requested"]:
+                _background["repairing"] = False
+                return
+            _background["repair_requested"] = False
+        try:
+            repair_dirty()
+        except Exception:
+            logger.exception("Stats repair failed")
+
+
+def repair_in_background():
+    """Start repair_dirty() on a thread, or have the running one do another pass."""
+    with _cache_lock:
+        _background["repair_requested"] = True
+        if _background["repairing"]:
+            return
+        _background["repairing"] = True
+    threading.Thread(target=_run_repair, name="stats-repair", daemon=True).start()
+
+
+def recompute_due(state):
+    """Whether the counters were never built or are due for their periodic repair."""
+    if not state:
+        return True
+    age = (datetime.datetime.utcnow() - state["recomputed_at"]).total_seconds()
+    return age > STATS_RECOMPUTE_INTERVAL
+
+
+def _load_counters():
+    # Read before the counters, so the counters are at least this recent
+    version = versions.current(versions.LISTINGS)
+    return _read_counters(), version
+
+
+def _read_counters():
+    # From the primary: a secondary could still hold counters from before the
+    # version they are tagged with, and clients would keep them through 304s
+    if not STATS_USE_COUNTERS:
+        return aggregate_stats(listings_collection)
+    state = stats_state.find_one({"_id": "listing_stats"})
+    if recompute_due(state):
+        recompute_in_background()
+        if not state:
+            # The counters were never built: aggregate rather than serve them empty
+            return aggregate_stats(listings_collection)
+    return list(stats_collection.find())
+
+
+def cached_entry():
+    """(counters, listings version) while the cached counters are fresh, else None."""
+    now = time.monotonic()
+    with _cache_lock:
+        if _cached["docs"] is not None and now < _cached["expires"]:
+            _cached["hits"] += 1
+            return _cached["docs"], _cached["version"]
+        _cached["misses"] += 1
+    return None
+
+
+def cache_stats():
+    with _cache_lock:
+        return {"size": 0 if _cached["docs"] is None else len(_cached["docs"]),
+                "hits": _cached["hits"], "misses": _cached["misses"]}
+
+
+def cached_counters():
+    entry = cached_entry()
+    return None if entry is None else entry[0]
+
+
+def store_counters(docs, version=None):
+    with _cache_lock:
+        _cached["docs"] = docs
+        _cached["version"] = version
+        _cached["expires"] = time.monotonic() + STATS_CACHE_TTL
+    return docs
+
+
+def get_versioned_counters():
+    """
+    Return the per car_type counters and the listings version they reflect,
+    from memory while fresh. Concurrent misses share a single read (or
+    recompute) instead of each issuing one.
+    """
+    entry = cached_entry()
+    if entry is not None:
+        return entry
+
+    def load():
+        docs, version = _load_counters()
+        store_counters(docs, version)
+        return docs, version
+    return _flight.do("counters", load)
+
+
+def get_counters():
+    return get_versioned_counters()[0]
+
+
+# ---- responses ----
+
+def average_price_by_type(counters=None):
+    counters = get_counters() if counters is None else counters
+    stats = [
+        {"_id": str(c["_id"]), "average_price": round(c["price_sum"] / c["priced_count"], 2)}
+        for c in counters if c.get("priced_count")
+    ]
+    return sorted(stats, key=lambda stat: stat["average_price"])
+
+
+def summary(counters=None):
+    counters = get_counters() if counters is None else counters
+    active = [c for c in counters if c.get("count", 0) > 0]
+    result = {}
+    if active:
+        priced = [c for c in active if c.get("priced_count")]
+        priced_count = sum(c["priced_count"] for c in priced)
+        result = {
+            "total_listings": sum(c["count"] for c in active),
+            "average_price": round(sum(c["price_sum"] for c in priced) / priced_count, 2) if priced_count else None,
+            "max_price": round(max(c["max_price"] for c in priced), 2) if priced else None,
+            "min_price": round(min(c["min_price"] for c in priced), 2) if priced else None
+        }
+    counts_by_type = sorted(({"_id": str(c["_id"]), "count": c["count"]} for c in active),
+                            key=lambda item: item["count"], reverse=True)
+    return {"summary": result, "counts_by_type": counts_by_type}
@@ -1,3 +1,5 @@
+import base64
+import json
 from bson.objectid import ObjectId
 
 # Function to convert ObjectId to string
@@ -14,3 +16,49 @@ def convert_object_ids(doc):
         return str(doc)
     else:
         return doc
+
+# Functions to build and read opaque pagination cursors
+def encode_cursor(position):
+    """
+    Encode the last seen sort position (a dict of JSON-safe values) as an
+    opaque, URL-safe continuation token.
+    """
+    raw = json.dumps(position, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Decode a token produced by encode_cursor. Raises ValueError if the token
+    has been tampered with or is otherwise unreadable.
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(position, dict):
+        raise ValueError("Invalid cursor")
+    return position
+
+# Function to build the update that keeps a listing's review summary in step
+def rating_summary_update(count_delta, rating_delta):
+    """
+    Return an update pipeline that adjusts a listing's review_count and
+    rating_sum by the given deltas, recomputes average_rating and bumps the
+    listing's version.
+    """
+    return [
+        {"$set": {
+            "review_count": {"$add": [{"$ifNull": ["$review_count", 0]}, count_delta]},
+            "rating_sum": {"$add": [{"$ifNull": ["$rating_sum", 0]}, rating_delta]},
+            "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]}
+        }},
+        {"$set": {
+            "average_rating": {"$cond": [
+                {"$gt": ["$review_count", 0]},
+                {"$round": [{"$divide": ["$rating_sum", "$review_count"]}, 2]},
+                None
+            ]}
+        }}
+    ]
@@ -0,0 +1,40 @@
+# Description: Version counters for conditional GETs. Each listing carries a
+# "version" field that every listing and review write increments, and the
+# versions collection holds one counter per collection for responses built from
+# many documents (listing pages, stats). Writers bump a collection counter after
+# their write and readers read it before their query, so a response is never
+# tagged with a version newer than its content.
+import globals
+from cache import TTLCache
+
+versions_collection = globals.db.versions
+
+LISTINGS = "listings"
+
+# recent() serves a counter from memory this long, and may miss writes made by
+# other processes in that time. Tagging a response with it only makes the tag
+# older than the content, but a 304 decided with it could hide such a write, so
+# conditional requests must compare against current().
+VERSION_CACHE_TTL = 1
+
+_recent = TTLCache(maxsize=16, ttl=VERSION_CACHE_TTL)
+
+
+def bump(name):
+    versions_collection.update_one({"_id": name}, {"$inc": {"version": 1}}, upsert=True)
+    # This process's writers see their own writes in the next tag
+    _recent.delete(name)
+
+
+def current(name):
+    doc = versions_collection.find_one({"_id": name})
+    return doc["version"] if doc else 0
+
+
+def recent(name):
+    """current(), read at most once per VERSION_CACHE_TTL seconds; only for tagging 200s."""
+    version = _recent.get(name)
+    if version is None:
+        version = current(name)
+        _recent.set(name, version)
+    return version
@@ -0,0 +1,140 @@
+# Description: Write-behind view counting for GET /listings/<id>. Views are
+# accumulated in memory per listing and flushed with one unordered bulk_write.
+import atexit
+import logging
+import threading
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+import globals
+from config import Config
+from listing_cache import listing_cache
+
+logger = logging.getLogger(__name__)
+
+listings_collection = globals.db.listings
+
+VIEW_COUNTER_SETTINGS = ["VIEW_COUNT_MODE", "VIEW_FLUSH_INTERVAL", "VIEW_FLUSH_THRESHOLD"]
+VIEW_COUNT_MODES = ("batched", "exact")
+
+
+class ViewCounter:
+    def __init__(self, collection, settings=None):
+        self.collection = collection
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        self.configure(settings or {name: getattr(Config, name) for name in VIEW_COUNTER_SETTINGS})
+
+    def configure(self, settings):
+        """Apply the VIEW_* settings from a mapping (e.g. app.config)."""
+        mode = settings.get("VIEW_COUNT_MODE", getattr(self, "mode", "batched"))
+        if mode not in VIEW_COUNT_MODES:
+            raise ValueError(f"VIEW_COUNT_MODE must be one of {', '.join(VIEW_COUNT_MODES)}, got {mode!r}")
+        self.mode = mode
+        self.flush_interval = float(settings.get("VIEW_FLUSH_INTERVAL", getattr(self, "flush_interval", 5)))
+        self.flush_threshold = int(settings.get("VIEW_FLUSH_THRESHOLD", getattr(self, "flush_threshold", 1000)))
+
+    @property
+    def exact(self):
+        return self.mode == "exact"
+
+    def increment(self, listing_id, count=1, autoflush=True):
+        """
+        Buffer a view. With autoflush=False the caller never blocks on a
+        flush (e.g. inside an event loop); the background timer writes it.
+        """
+        with self._lock:
+            self._pending[listing_id] = self._pending.get(listing_id, 0) + count
+            size = len(self._pending)
+            if self._timer is None:
+                self._schedule()
+        if autoflush and size >= self.flush_threshold:
+            self.flush()
+
+    def pending(self, listing_id):
+        with self._lock:
+            return self._pending.get(listing_id, 0)
+
+    def pending_listings(self):
+        """How many listings have views waiting to be flushed."""
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write every pending increment in a single unordered bulk_write."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            requests = [UpdateOne({"_id": listing_id}, {"$inc": {"views": count}})
+                        for listing_id, count in pending.items()]
+            try:
+                self.collection.bulk_write(requests, ordered=False)
+            except PyMongoError:
+                logger.exception("Failed to flush %d view counts, will retry", len(pending))
+                # Put the counts back so the next flush retries them
+                with self._lock:
+                    for listing_id, count in pending.items():
+                        self._pending[listing_id] = self._pending.get(listing_id, 0) + count
+                return 0
+            # Cached listings hold the views from before this flush
+            listing_cache.evict_many(pending)
+            return len(requests)
+
+    def _schedule(self):
+        # Called with self._lock held
+        self._timer = threading.Timer(self.flush_interval, self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self):
+        self.flush()
+        with self._lock:
+            self._timer = None
+            if self._pending:
+                self._schedule()
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+
+
+view_counter = ViewCounter(listings_collection)
+# Don't lose buffered views on shutdown
+atexit.register(view_counter.close)
+
+
+def read_and_count(query, projection=None):
+    """
+    Fetch a listing for display and count the view. In "exact" mode this is
+    a single find_one_and_update; in "batched" mode the increment is buffered
+    and the returned document includes views not yet flushed.
+    """
+    if view_counter.exact:
+        return listings_collection.find_one_and_update(query, {"$inc": {"views": 1}}, projection,
+                                                      return_document=ReturnDocument.AFTER)
+
+    listing = listings_collection.find_one(query, projection)
+    return count_view(listing)
+
+
+def count_view(listing, autoflush=True):
+    """Buffer a view of a fetched listing and include unflushed views in its count."""
+    if listing is not None:
+        view_counter.increment(listing["_id"], autoflush=autoflush)
+        if "views" in listing:
+            listing["views"] += view_counter.pending(listing["_id"])
+    return listing
+
+
+def record_view(listing_id):
+    """Count a view of a listing that was not fetched (e.g. a 304 response)."""
+    if view_counter.exact:
+        listings_collection.update_one({"_id": listing_id}, {"$inc": {"views": 1}})
+    else:
+        view_counter.increment(listing_id)